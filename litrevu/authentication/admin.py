@@ -1,12 +1,14 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
+from reviews.admin import TombstoneAdminMixin, UploadAdminMixin
+
 from .models import User
 
 
 @admin.register(User)
-class UserCustomAdmin(UserAdmin):
+class UserCustomAdmin(TombstoneAdminMixin, UploadAdminMixin, UserAdmin):
     """ Class User for the admin interface """
-    list_display = ("username", "email", "is_staff", "is_active")
+    list_display = ("username", "email", "is_staff", "is_active",
+                    "deleted_at")
     list_filter = ("is_staff", "is_active")
-
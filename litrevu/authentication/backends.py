@@ -0,0 +1,55 @@
+"""
+Cached resolution of the logged-in user.
+
+AuthenticationMiddleware loads request.user on every request through the
+backend's get_user. CachedModelBackend serves it from the cache instead:
+the user is stored with the version it was loaded under, and every user
+has a version in the cache that changes whenever the stored copy gets
+stale (profile, password, active flag, groups or permissions, counters;
+see authentication.signals and reviews.counters). Both keys are read in
+one cache round trip; a version mismatch or a lost entry only means one
+database read.
+
+Versions change once the write commits, so a concurrent request can not
+store the old row under the new version.
+"""
+import time
+
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.db import transaction
+
+USER_KEY = "auth-user:{}"
+VERSION_KEY = "auth-user-version:{}"
+USER_TIMEOUT = 60 * 60
+
+
+def invalidate(user_ids):
+    """ Give the users a new version once the transaction commits """
+    user_ids = set(user_ids)
+    if user_ids:
+        transaction.on_commit(lambda: cache.set_many(
+            {VERSION_KEY.format(user_id): time.time_ns()
+             for user_id in user_ids}, USER_TIMEOUT))
+
+
+class CachedModelBackend(ModelBackend):
+    """ ModelBackend whose get_user reads a versioned cache entry """
+
+    def get_user(self, user_id):
+        user_key, version_key = (USER_KEY.format(user_id),
+                                 VERSION_KEY.format(user_id))
+        found = cache.get_many([user_key, version_key])
+        version = found.get(version_key)
+        if version is not None and user_key in found:
+            cached_version, user = found[user_key]
+            if cached_version == version:
+                return user
+        if version is None:
+            version = time.time_ns()
+            if not cache.add(version_key, version, USER_TIMEOUT):
+                version = cache.get(version_key, version)
+        user = super().get_user(user_id)
+        if user is not None:
+            cache.set(user_key, (version, user), USER_TIMEOUT)
+        return user
@@ -0,0 +1,42 @@
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    """ Delete the expired sessions in small chunks """
+    help = ("Delete the expired sessions of the database, one short "
+            "transaction per chunk so that logins are never blocked for "
+            "long. Meant to run periodically (cron), unlike clearsessions "
+            "which deletes everything in a single statement.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--pause", type=float, default=0,
+                            help="Seconds to wait between chunks.")
+
+    def handle(self, *args, chunk_size, pause, **options):
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        if not hasattr(store, "get_model_class"):
+            self.stdout.write(f"{settings.SESSION_ENGINE} stores no session "
+                              f"in the database, nothing to purge.")
+            return
+        expired = store.get_model_class().objects.filter(
+            expire_date__lt=timezone.now())
+        deleted = chunks = 0
+        while True:
+            with transaction.atomic():
+                keys = list(expired.values_list("pk", flat=True)
+                            [:chunk_size])
+                if not keys:
+                    break
+                deleted += expired.filter(pk__in=keys).delete()[0]
+            chunks += 1
+            if pause:
+                time.sleep(pause)
+        self.stdout.write(self.style.SUCCESS(
+            f"{deleted} expired session(s) deleted in {chunks} chunk(s)."))
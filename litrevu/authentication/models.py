@@ -2,10 +2,39 @@ from django.db import models
 from django.contrib.auth.models import AbstractUser
 
 
-class User(AbstractUser):
+class CounterFieldsMixin:
+    """
+    Keep the denormalized counters (counter_fields, updated with F()
+    expressions by reviews.counters) out of the saves of an existing row
+    that do not name them in update_fields: a stale instance saved in
+    full (edit form, admin, cached request.user) would write back its old
+    counts.
+    """
+    counter_fields = ()
+
+    def save(self, *args, update_fields=None, **kwargs):
+        if update_fields is None and not self._state.adding \
+                and not kwargs.get('force_insert'):
+            skipped = set(self.counter_fields) | self.get_deferred_fields()
+            update_fields = [field.name
+                             for field in self._meta.concrete_fields
+                             if not field.primary_key
+                             and field.name not in skipped
+                             and field.attname not in skipped]
+        super().save(*args, update_fields=update_fields, **kwargs)
+
+
+class User(CounterFieldsMixin, AbstractUser):
     """ Custom User Model """
+    counter_fields = ('follower_count', 'following_count', 'post_count')
     profile_picture = models.ImageField(
         upload_to="avatars/",
         null=True,
         blank=True
     )
+    # Denormalized counters, maintained by reviews.counters
+    follower_count = models.PositiveIntegerField(default=0, editable=False)
+    following_count = models.PositiveIntegerField(default=0, editable=False)
+    post_count = models.PositiveIntegerField(default=0, editable=False)
+    # Set when the user is deleted, the rows go later (reviews.deletion)
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
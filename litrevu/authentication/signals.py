@@ -0,0 +1,45 @@
+"""
+Invalidate the cached logged-in user (authentication.backends) whenever
+the stored copy gets stale.
+"""
+from django.contrib.auth.models import Group
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import backends
+from .models import User
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    """ Profile, password, active flag... or deletion """
+    backends.invalidate([instance.pk])
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def user_rights_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """ Groups or permissions added to or removed from users """
+    if action == 'pre_clear' and reverse:
+        users = instance.user_set.values_list('pk', flat=True)
+    elif action in ('post_add', 'post_remove', 'pre_clear'):
+        users = pk_set if reverse else [instance.pk]
+    else:
+        return
+    backends.invalidate(users)
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def group_permissions_changed(sender, instance, action, reverse, pk_set,
+                              **kwargs):
+    """ The permissions of a group change for each of its users """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        groups = instance.group_set.all() if action == 'pre_clear' \
+            else Group.objects.filter(pk__in=pk_set)
+    else:
+        groups = [instance]
+    backends.invalidate(User.objects.filter(groups__in=groups)
+                        .values_list('pk', flat=True))
@@ -1,3 +1,91 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
 
-# Create your tests here.
+from django.contrib.auth.models import Group, Permission
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .backends import CachedModelBackend
+from .models import User
+
+
+class CachedUserTests(TestCase):
+    """ Tests for the cached sessions and logged-in user """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+
+    def setUp(self):
+        cache.clear()
+        self.backend = CachedModelBackend()
+
+    def get_user(self):
+        """ Load alice through the backend, as AuthenticationMiddleware """
+        return self.backend.get_user(self.alice.pk)
+
+    def test_request_reads_no_session_nor_user(self):
+        self.client.login(username="alice", password="pwd")
+        self.client.get(reverse("reviews:search_user"), {"q": "a"})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("reviews:search_user"),
+                                       {"q": "a"})
+        self.assertEqual(response.status_code, 200)
+        tables = " ".join(query["sql"] for query in queries.captured_queries)
+        self.assertNotIn("django_session", tables)
+        self.assertNotIn("authentication_user", tables)
+
+    def test_changes_invalidate_the_cached_user(self):
+        self.get_user()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_user().first_name, "")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.first_name = "Alice"
+            self.alice.save()
+        self.assertEqual(self.get_user().first_name, "Alice")
+
+        group = Group.objects.create(name="moderators")
+        permission = Permission.objects.get(codename="delete_ticket")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.groups.add(group)
+        self.assertFalse(self.get_user().has_perm("reviews.delete_ticket"))
+        with self.captureOnCommitCallbacks(execute=True):
+            group.permissions.add(permission)
+        self.assertTrue(self.get_user().has_perm("reviews.delete_ticket"))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.groups.clear()
+        self.assertFalse(self.get_user().has_perm("reviews.delete_ticket"))
+
+    def test_password_change_logs_out(self):
+        self.client.login(username="alice", password="pwd")
+        self.assertEqual(self.client.get(reverse("reviews:feed"))
+                         .status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.set_password("new")
+            self.alice.save()
+        self.assertEqual(self.client.get(reverse("reviews:feed"))
+                         .status_code, 302)
+
+    def test_purge_sessions_in_chunks(self):
+        now = timezone.now()
+        for number in range(7):
+            Session.objects.create(
+                session_key=f"key{number}", session_data="",
+                expire_date=now + timedelta(days=1 if number < 2 else -1))
+        output = StringIO()
+        call_command("purge_sessions", "--chunk-size", "2", stdout=output)
+        self.assertIn("5 expired session(s) deleted in 3 chunk(s)",
+                      output.getvalue())
+        self.assertEqual(Session.objects.count(), 2)
+
+        cookies = "django.contrib.sessions.backends.signed_cookies"
+        with override_settings(SESSION_ENGINE=cookies):
+            call_command("purge_sessions", stdout=output)
+        self.assertIn("nothing to purge", output.getvalue())
@@ -0,0 +1,7 @@
+from django.contrib.staticfiles.apps import StaticFilesConfig
+
+
+class StaticConfig(StaticFilesConfig):
+    """ staticfiles, without the uploads stored under static/pictures """
+    ignore_patterns = StaticFilesConfig.ignore_patterns + [
+        'pictures/tickets/*', 'pictures/avatars/*', 'pictures/renditions/*']
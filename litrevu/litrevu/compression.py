@@ -0,0 +1,231 @@
+"""
+Compression of the dynamic responses (HTML pages, JSON).
+
+CompressionMiddleware negotiates the encoding from Accept-Encoding,
+among COMPRESSION_ENCODINGS in the server's order of preference: zstd
+and brotli need the optional `zstandard` and `brotli` packages, gzip is
+always available. It leaves alone the responses already encoded (the
+precompressed static files), partial ones, the types that do not shrink
+(images) and the bodies under COMPRESSION_MIN_SIZE bytes.
+
+Streamed bodies (StreamingHttpResponse, sync or async) are compressed
+chunk by chunk, and flushed every COMPRESSION_FLUSH_SIZE bytes of input
+so that the client receives the JSON feed as it is produced instead of
+the whole body being buffered; flushing every chunk (one post of the
+JSON feed) would double the compressed size. Levels (COMPRESSION_LEVELS)
+favour speed: these bodies are compressed at every request, unlike the
+static files. The benchmark_compression command measures the CPU cost
+and bytes saved of each encoding and level on generated feed pages.
+
+The CSRF token is masked differently in every response, which keeps
+it out of reach of compression side channels (BREACH).
+"""
+import re
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'application/xml', 'image/svg+xml')
+
+_CODING = re.compile(r'\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([\d.]+))?\s*$')
+
+
+class GzipEncoder:
+    """ gzip stream """
+
+    def __init__(self, level):
+        # wbits 31: gzip header and trailer, mtime 0
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliEncoder:
+    """ brotli stream """
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdEncoder:
+    """ zstd stream, a flush ends a block """
+
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+def encoders():
+    """ Return {Content-Encoding: encoder class} of the installed ones """
+    available = {'gzip': GzipEncoder}
+    if brotli is not None:
+        available['br'] = BrotliEncoder
+    if zstandard is not None:
+        available['zstd'] = ZstdEncoder
+    return available
+
+
+def compress(encoding, data, level=None):
+    """ Return data compressed in one go """
+    encoder = encoders()[encoding](
+        level if level is not None else settings.COMPRESSION_LEVELS[encoding])
+    return encoder.compress(data) + encoder.finish()
+
+
+def encode_stream(encoder, chunks):
+    """
+    Compress an iterable of chunks, flushing after every
+    COMPRESSION_FLUSH_SIZE bytes of input
+    """
+    pending = 0
+    for data in chunks:
+        compressed = encoder.compress(data)
+        pending += len(data)
+        if pending >= settings.COMPRESSION_FLUSH_SIZE:
+            compressed += encoder.flush()
+            pending = 0
+        if compressed:
+            yield compressed
+    yield encoder.finish()
+
+
+async def encode_async_stream(encoder, chunks):
+    """ encode_stream for an async iterable """
+    pending = 0
+    async for data in chunks:
+        compressed = encoder.compress(data)
+        pending += len(data)
+        if pending >= settings.COMPRESSION_FLUSH_SIZE:
+            compressed += encoder.flush()
+            pending = 0
+        if compressed:
+            yield compressed
+    yield encoder.finish()
+
+
+def negotiate(accept_encoding, encodings=None):
+    """
+    Return the first of encodings (default: the installed ones, in the
+    COMPRESSION_ENCODINGS order) that the Accept-Encoding header allows,
+    or None. An encoding refused with q=0 is never chosen.
+    """
+    accepted = {}
+    for coding in accept_encoding.lower().split(','):
+        match = _CODING.match(coding)
+        if match:
+            try:
+                accepted[match.group(1)] = float(match.group(2) or 1)
+            except ValueError:
+                continue
+    if encodings is None:
+        available = encoders()
+        encodings = [encoding for encoding in settings.COMPRESSION_ENCODINGS
+                     if encoding in available]
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def _compressible(response):
+    if response.has_header('Content-Encoding') \
+            or response.has_header('Content-Range') \
+            or 'no-transform' in response.get('Cache-Control', ''):
+        return False
+    content_type = response.get('Content-Type', '').lower()
+    if not content_type.startswith(COMPRESSIBLE_TYPES):
+        return False
+    if response.streaming:
+        # only the streams of a known, small size are skipped
+        length = response.get('Content-Length')
+        return not (length and length.isdigit()
+                    and int(length) < settings.COMPRESSION_MIN_SIZE)
+    return len(response.content) >= settings.COMPRESSION_MIN_SIZE
+
+
+class CompressionMiddleware:
+    """ Compress the HTML and JSON responses, streamed ones included """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.compress(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.compress(request, await self.get_response(request))
+
+    def compress(self, request, response):
+        """ Return the response compressed if the client accepts it """
+        if not _compressible(response):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = negotiate(request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            encoder = encoders()[encoding](
+                settings.COMPRESSION_LEVELS[encoding])
+            encode = encode_async_stream if response.is_async \
+                else encode_stream
+            response.streaming_content = encode(encoder,
+                                                response.streaming_content)
+            del response['Content-Length']
+        else:
+            compressed = compress(encoding, response.content)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        # the encoded body is no longer byte for byte the tagged one
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,155 @@
+"""
+Database profiles, selected from the environment by settings.py.
+
+LITREVU_DB=sqlite (default)
+    SQLite file LITREVU_SQLITE_PATH (default BASE_DIR / 'db.sqlite3'),
+    hardened by the `apply_pragmas` connection hook: WAL journal (readers
+    no longer wait for the writer), synchronous=NORMAL (safe with WAL),
+    memory mapped reads and a busy timeout. Write transactions start
+    IMMEDIATE so that concurrent writers queue on the busy timeout instead
+    of failing when upgrading a read lock. LITREVU_SQLITE_TUNING=0 keeps
+    the SQLite defaults (rollback journal), for comparison.
+    The journal mode is stored in the database file: the db.sqlite3
+    checked into the repository keeps its rollback journal (so that
+    running a command does not modify it) unless LITREVU_SQLITE_WAL=1;
+    the files set by LITREVU_SQLITE_PATH and the replicas get WAL.
+
+LITREVU_DB=postgres
+    PostgreSQL through psycopg (optional dependency, `pip install
+    "psycopg[binary,pool]"`) configured by POSTGRES_DB, POSTGRES_USER,
+    POSTGRES_PASSWORD, POSTGRES_HOST and POSTGRES_PORT. Connections are
+    pooled (psycopg_pool, LITREVU_DB_POOL_MIN / LITREVU_DB_POOL_MAX) or,
+    with LITREVU_DB_POOL=0, persistent for LITREVU_DB_CONN_MAX_AGE
+    seconds with health checks.
+
+Read replicas (see litrevu.routers) are added as aliases replica_1,
+replica_2... from LITREVU_SQLITE_REPLICAS (comma separated SQLite files,
+copies of the primary refreshed by `refresh_sqlite_replicas`) or
+POSTGRES_REPLICA_HOSTS (comma separated hosts, same credentials).
+"""
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+}
+
+
+def _flag(environ, name, default):
+    return environ.get(name, default).lower() not in ('0', 'false', 'no', '')
+
+
+def sqlite_database(path, tuned=True, wal=True):
+    """
+    Return the settings of an SQLite database, hardened if tuned; without
+    wal, the file keeps its journal mode (and synchronous stays FULL)
+    """
+    database = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': path,
+    }
+    if tuned:
+        database['OPTIONS'] = {'transaction_mode': 'IMMEDIATE'}
+        # read by apply_pragmas, ignored by Django
+        database['PRAGMAS'] = dict(SQLITE_PRAGMAS)
+        if not wal:
+            del database['PRAGMAS']['journal_mode']
+            del database['PRAGMAS']['synchronous']
+    return database
+
+
+def postgres_database(environ):
+    """ Return the settings of the PostgreSQL database of the environment """
+    database = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': environ.get('POSTGRES_DB', 'litrevu'),
+        'USER': environ.get('POSTGRES_USER', 'litrevu'),
+        'PASSWORD': environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': environ.get('POSTGRES_HOST', 'localhost'),
+        'PORT': environ.get('POSTGRES_PORT', '5432'),
+    }
+    if _flag(environ, 'LITREVU_DB_POOL', '1'):
+        # Django refuses persistent connections with a pool
+        database['CONN_MAX_AGE'] = 0
+        database['OPTIONS'] = {'pool': {
+            'min_size': int(environ.get('LITREVU_DB_POOL_MIN', 2)),
+            'max_size': int(environ.get('LITREVU_DB_POOL_MAX', 10)),
+            'timeout': 10,
+        }}
+    else:
+        database['CONN_MAX_AGE'] = int(
+            environ.get('LITREVU_DB_CONN_MAX_AGE', 60))
+        database['CONN_HEALTH_CHECKS'] = True
+    return database
+
+
+def replica(database):
+    """
+    Mark a database as a read replica of the default one: read by the
+    router, and the same database as the default one in tests.
+    """
+    return {**database, 'REPLICA': True, 'TEST': {'MIRROR': 'default'}}
+
+
+def _split(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def databases(base_dir, environ=os.environ):
+    """ Return settings.DATABASES for the profile of the environment """
+    profile = environ.get('LITREVU_DB', 'sqlite')
+    tuned = _flag(environ, 'LITREVU_SQLITE_TUNING', '1')
+    if profile == 'sqlite':
+        path = environ.get('LITREVU_SQLITE_PATH')
+        default = sqlite_database(
+            path or base_dir / 'db.sqlite3', tuned=tuned,
+            wal=bool(path) or _flag(environ, 'LITREVU_SQLITE_WAL', '0'))
+        replicas = [sqlite_database(path, tuned=tuned) for path
+                    in _split(environ.get('LITREVU_SQLITE_REPLICAS', ''))]
+    elif profile == 'postgres':
+        default = postgres_database(environ)
+        replicas = [{**default, 'HOST': host} for host
+                    in _split(environ.get('POSTGRES_REPLICA_HOSTS', ''))]
+    else:
+        raise ImproperlyConfigured(
+            f"LITREVU_DB must be 'sqlite' or 'postgres', not {profile!r}.")
+    aliases = {'default': default}
+    for number, database in enumerate(replicas, start=1):
+        aliases[f'replica_{number}'] = replica(database)
+    return aliases
+
+
+def refresh_sqlite_replicas(source='default'):
+    """
+    Copy the SQLite database source onto every SQLite replica (online
+    backup), standing in for replication in development and tests.
+    Return the refreshed aliases.
+    """
+    refreshed = []
+    for alias, database in connections.settings.items():
+        if database.get('REPLICA') and connections[alias].vendor == 'sqlite':
+            connections[source].ensure_connection()
+            connections[alias].ensure_connection()
+            connections[source].connection.backup(
+                connections[alias].connection)
+            refreshed.append(alias)
+    return refreshed
+
+
+@receiver(connection_created)
+def apply_pragmas(sender, connection, **kwargs):
+    """ Apply the PRAGMAS of an SQLite database to each new connection """
+    pragmas = connection.settings_dict.get('PRAGMAS')
+    if connection.vendor != 'sqlite' or not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
@@ -0,0 +1,285 @@
+"""
+Per-request performance instrumentation.
+
+InstrumentationMiddleware measures each request: number and time of the
+SQL queries (an execute_wrapper on every database connection), template
+rendering time (queries run while rendering are counted as SQL only)
+and response size. Rendering is timed by a Template.render wrapper that
+is installed only while instrumented requests are running (reference
+counted, `timed_rendering`) and measures only the request of the
+current context: Django sends no signal around the rendering outside
+of the test runner. The figures are sent back
+in a Server-Timing header and aggregated per view, in memory, into the
+histograms of `registry`, served as JSON to staff users by
+`metrics_view`.
+
+The same SQL statement run INSTRUMENTATION_N_PLUS_ONE times or more in
+one request is flagged (and logged) as a likely N+1 query.
+
+Like the other middlewares of the project (litrevu.compression,
+litrevu.staticfiles, litrevu.ratelimit, litrevu.routers), it is sync and
+async capable, so that ASGI requests reach the async views without
+going through a thread.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, \
+    sync_to_async
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connections
+from django.http import JsonResponse
+from django.template.base import Template
+
+from . import ratelimit
+
+logger = logging.getLogger(__name__)
+
+TIME_BOUNDS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+QUERY_BOUNDS = (1, 2, 5, 10, 20, 50, 100)
+SIZE_BOUNDS = (1024, 4096, 16384, 65536, 262144, 1048576)
+# distinct N+1 statements kept per view
+N_PLUS_ONE_SAMPLES = 5
+
+_current = ContextVar('request_metrics', default=None)
+_render_lock = threading.Lock()
+_render_users = 0
+_original_render = None
+
+
+class RequestMetrics:
+    """ Measures of one request, the execute_wrapper of its queries """
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.rendering = False
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - start
+            self.queries += 1
+            self.statements[sql] += 1
+
+    def repeated(self, threshold):
+        """ Return the (sql, count) of the statements run threshold times """
+        return [(sql, count) for sql, count in self.statements.most_common()
+                if count >= threshold]
+
+
+def _timed_render(self, context):
+    """ Template.render, timing the outermost render of a request """
+    metrics = _current.get()
+    if metrics is None or metrics.rendering:
+        return _original_render(self, context)
+    metrics.rendering = True
+    start, sql_time = time.perf_counter(), metrics.sql_time
+    try:
+        return _original_render(self, context)
+    finally:
+        metrics.rendering = False
+        metrics.render_time += time.perf_counter() - start \
+            - (metrics.sql_time - sql_time)
+
+
+@contextmanager
+def timed_rendering():
+    """ Install the Template.render timer while the block runs """
+    global _original_render, _render_users
+    with _render_lock:
+        if not _render_users:
+            _original_render = Template.render
+            Template.render = _timed_render
+        _render_users += 1
+    try:
+        yield
+    finally:
+        with _render_lock:
+            _render_users -= 1
+            if not _render_users:
+                Template.render = _original_render
+
+
+class Histogram:
+    """ Counts of observations per bucket (upper bounds, then +Inf) """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += 1
+        self.sum += value
+
+    def as_dict(self):
+        labels = [f"<={bound}" for bound in self.bounds] + ["+Inf"]
+        return {
+            "count": self.total,
+            "mean": round(self.sum / self.total, 2) if self.total else 0,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class ViewMetrics:
+    """ Aggregated measures of the requests of one view """
+
+    def __init__(self):
+        self.histograms = {
+            "total_ms": Histogram(TIME_BOUNDS),
+            "sql_ms": Histogram(TIME_BOUNDS),
+            "render_ms": Histogram(TIME_BOUNDS),
+            "queries": Histogram(QUERY_BOUNDS),
+            "response_bytes": Histogram(SIZE_BOUNDS),
+        }
+        self.n_plus_one = 0
+        self.samples = {}
+
+    def as_dict(self):
+        return {
+            **{name: histogram.as_dict()
+               for name, histogram in self.histograms.items()},
+            "n_plus_one": self.n_plus_one,
+            "n_plus_one_samples": [
+                {"sql": sql, "count": count}
+                for sql, count in self.samples.items()],
+        }
+
+
+class MetricsRegistry:
+    """ In-memory, per process, measures of every instrumented view """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def record(self, view, measures, repeated=()):
+        with self.lock:
+            metrics = self.views.setdefault(view, ViewMetrics())
+            for name, value in measures.items():
+                if value is not None:
+                    metrics.histograms[name].observe(value)
+            if repeated:
+                metrics.n_plus_one += 1
+                for sql, count in repeated:
+                    if sql in metrics.samples \
+                            or len(metrics.samples) < N_PLUS_ONE_SAMPLES:
+                        metrics.samples[sql] = count
+
+    def snapshot(self):
+        with self.lock:
+            return {view: metrics.as_dict()
+                    for view, metrics in sorted(self.views.items())}
+
+    def reset(self):
+        with self.lock:
+            self.views.clear()
+
+
+registry = MetricsRegistry()
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.view_name or match._func_path
+
+
+def _databases():
+    """ The connections of the current thread """
+    return [connections[alias] for alias in connections]
+
+
+class InstrumentationMiddleware:
+    """ Measure each request, add Server-Timing, feed the registry """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    @contextmanager
+    def measuring(self, metrics, databases):
+        """ Count the queries and time the rendering of the block """
+        token = _current.set(metrics)
+        try:
+            with ExitStack() as stack:
+                stack.enter_context(timed_rendering())
+                for database in databases:
+                    stack.enter_context(database.execute_wrapper(metrics))
+                yield
+        finally:
+            _current.reset(token)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        start = time.perf_counter()
+        with self.measuring(metrics, _databases()):
+            response = self.get_response(request)
+        return self.record(request, response, metrics,
+                           time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        start = time.perf_counter()
+        # connections are per thread: the queries run in the sync thread
+        # of the request (sync_to_async)
+        databases = await sync_to_async(_databases)()
+        with self.measuring(metrics, databases):
+            response = await self.get_response(request)
+        return self.record(request, response, metrics,
+                           time.perf_counter() - start)
+
+    def record(self, request, response, metrics, total):
+        """ Add the Server-Timing header, feed the registry """
+        size = None if response.streaming else len(response.content)
+        repeated = metrics.repeated(settings.INSTRUMENTATION_N_PLUS_ONE)
+        view = _view_name(request)
+        for sql, count in repeated:
+            logger.warning("Likely N+1 in %s: %d x %s", view, count, sql)
+        registry.record(view, {
+            "total_ms": total * 1000,
+            "sql_ms": metrics.sql_time * 1000,
+            "render_ms": metrics.render_time * 1000,
+            "queries": metrics.queries,
+            "response_bytes": size,
+        }, repeated)
+        response['Server-Timing'] = ", ".join([
+            f'sql;dur={metrics.sql_time * 1000:.1f};'
+            f'desc="{metrics.queries} queries"',
+            f'render;dur={metrics.render_time * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ] + ([f'n-plus-one;desc="{len(repeated)} repeated statement(s)"']
+             if repeated else []))
+        return response
+
+
+@staff_member_required
+def metrics_view(request):
+    """
+    Histograms of the instrumented views and allowed / rejected request
+    counts of litrevu.ratelimit (JSON), POST resets the histograms
+    """
+    if request.method == 'POST':
+        registry.reset()
+    return JsonResponse({"views": registry.snapshot(),
+                         "rate_limits": ratelimit.counts()})
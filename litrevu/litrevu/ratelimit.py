@@ -0,0 +1,241 @@
+"""
+Rate limiting and admission control.
+
+`rate_limited(scope)` limits a view per user (per IP for anonymous
+requests) with a token bucket kept in the shared cache: RATE_LIMITS maps
+each scope to a refill rate (requests per second) and a burst (bucket
+size). The bucket is stored as the single time at which it will be full
+again (GCRA), so a check costs one cache read and one write. Under
+concurrency, requests racing on the same bucket may all be admitted:
+the limit is approximate, never stricter than configured.
+
+Over the limit, the view answers 429 with Retry-After.
+
+AdmissionMiddleware sheds load before any session or database work: at
+most ADMISSION_MAX_CONCURRENT requests run at once per process, and a
+request is answered 503 with Retry-After as soon as its queueing time
+(in the proxy, from an X-Request-Start header, plus waiting for a slot)
+exceeds ADMISSION_MAX_QUEUE_MS. A streamed response keeps its slot until
+it is closed, once its body is produced. Under ASGI the middleware runs
+on the event loop and waits for a slot with asyncio, without holding a
+thread.
+
+Allowed and rejected requests are counted per scope in the cache, see
+`counts` (shown by litrevu.instrumentation.metrics_view).
+"""
+import asyncio
+import math
+import threading
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, \
+    sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+
+BUCKET_KEY = "ratelimit:{}:{}"
+COUNT_KEY = "ratelimit-count:{}:{}"
+# scope of the requests shed by AdmissionMiddleware
+SHED_SCOPE = "admission"
+
+
+def _count(scope, outcome):
+    key = COUNT_KEY.format(scope, outcome)
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:  # evicted in between
+            cache.add(key, 1, None)
+
+
+def counts():
+    """ Return {scope: {"allowed": n, "rejected": n}} """
+    scopes = [*settings.RATE_LIMITS, SHED_SCOPE]
+    keys = {COUNT_KEY.format(scope, outcome): (scope, outcome)
+            for scope in scopes for outcome in ("allowed", "rejected")}
+    found = cache.get_many(keys)
+    result = {scope: {"allowed": 0, "rejected": 0} for scope in scopes}
+    for key, value in found.items():
+        scope, outcome = keys[key]
+        result[scope][outcome] = value
+    return result
+
+
+def client_id(request):
+    """ The user for authenticated requests, else the client IP """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f"user-{user.pk}"
+    return f"ip-{request.META.get('REMOTE_ADDR', '')}"
+
+
+def hit(scope, client, now=None):
+    """
+    Take a token from the client's bucket of scope. Return 0 if the
+    request is allowed, else the seconds before a token is available.
+    """
+    limit = settings.RATE_LIMITS.get(scope)
+    if not limit:
+        return 0
+    interval = 1 / limit['rate']
+    window = limit['burst'] * interval
+    now = time.time() if now is None else now
+    key = BUCKET_KEY.format(scope, client)
+    full_at = max(cache.get(key, now), now) + interval
+    wait = full_at - window - now
+    if wait > 0:
+        _count(scope, "rejected")
+        return wait
+    cache.set(key, full_at, math.ceil(window) + 1)
+    _count(scope, "allowed")
+    return 0
+
+
+def too_many_requests(wait):
+    response = JsonResponse(
+        {"error": "Trop de requêtes, réessayez dans quelques secondes."},
+        status=429)
+    response['Retry-After'] = str(max(1, math.ceil(wait)))
+    return response
+
+
+def rate_limited(scope, methods=None):
+    """
+    Limit a view (sync or async) with the buckets of scope, only for
+    the given HTTP methods if any.
+    """
+    def decorator(view_func):
+        def wait_for(request):
+            if methods and request.method not in methods:
+                return 0
+            return hit(scope, client_id(request))
+
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def wrapper(request, *args, **kwargs):
+                # the cache and request.user are sync, see async_views
+                wait = await sync_to_async(wait_for)(request)
+                if wait:
+                    return too_many_requests(wait)
+                return await view_func(request, *args, **kwargs)
+        else:
+            @wraps(view_func)
+            def wrapper(request, *args, **kwargs):
+                wait = wait_for(request)
+                if wait:
+                    return too_many_requests(wait)
+                return view_func(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def upstream_delay(request, now=None):
+    """
+    Seconds the request waited before reaching Django, from the
+    X-Request-Start header of the proxy (t=<seconds, ms or µs>), else 0.
+    """
+    value = request.headers.get('X-Request-Start', '').removeprefix('t=')
+    try:
+        start = float(value)
+    except ValueError:
+        return 0
+    # nginx sends seconds, other proxies milli or microseconds
+    while start > 1e11:
+        start /= 1000
+    now = time.time() if now is None else now
+    return max(0, now - start)
+
+
+class AdmissionMiddleware:
+    """ Bound the concurrent requests, shed those queued for too long """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.limit = settings.ADMISSION_MAX_CONCURRENT
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self.slots = threading.BoundedSemaphore(self.limit) \
+            if self.limit else None
+        self.loop = self.async_slots = None
+
+    def shed(self):
+        _count(SHED_SCOPE, "rejected")
+        response = JsonResponse(
+            {"error": "Serveur surchargé, réessayez dans un instant."},
+            status=503)
+        response['Retry-After'] = '1'
+        return response
+
+    def budget(self, request):
+        """ Seconds the request may still wait for a slot """
+        return settings.ADMISSION_MAX_QUEUE_MS / 1000 \
+            - upstream_delay(request)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        budget = self.budget(request)
+        if budget <= 0:
+            return self.shed()
+        if self.slots is None:
+            return self.get_response(request)
+        if not self.slots.acquire(timeout=budget):
+            return self.shed()
+        _count(SHED_SCOPE, "allowed")
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            self.slots.release()
+            raise
+        return _release_when_done(response, self.slots.release)
+
+    def semaphore(self):
+        """
+        The slots of the running event loop: one per process under
+        ASGI, the tests run several
+        """
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.async_slots = asyncio.BoundedSemaphore(self.limit)
+        return self.async_slots
+
+    async def __acall__(self, request):
+        budget = self.budget(request)
+        if budget <= 0:
+            return await sync_to_async(self.shed)()
+        if not self.limit:
+            return await self.get_response(request)
+        slots = self.semaphore()
+        try:
+            await asyncio.wait_for(slots.acquire(), budget)
+        except asyncio.TimeoutError:
+            return await sync_to_async(self.shed)()
+        await sync_to_async(_count)(SHED_SCOPE, "allowed")
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            slots.release()
+            raise
+        # a streamed response is closed from a thread (sync_to_async)
+        loop = asyncio.get_running_loop()
+        return _release_when_done(
+            response, lambda: loop.call_soon_threadsafe(slots.release))
+
+
+def _release_when_done(response, release):
+    """
+    Release the slot of a request once its response is produced: when
+    it is closed for a streamed body, which is produced after the view
+    returned (JSON feed, compression)
+    """
+    if response.streaming:
+        response._resource_closers.append(release)
+    else:
+        release()
+    return response
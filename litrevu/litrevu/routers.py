@@ -0,0 +1,118 @@
+"""
+Read replica routing.
+
+ReplicaRouter keeps every write on the default (primary) database and
+sends reads to a replica (an alias marked REPLICA, see litrevu.db) only
+inside `use_replica()`. ReplicaMiddleware opens that scope for the GET
+requests of the views marked with `replica_reads`, unless the session
+wrote recently: after a successful write request (POST...), the user is
+pinned to the primary for REPLICA_PIN_SECONDS, so they always see their
+own writes despite the replication lag. The timeline pages, validated
+by version (reviews.versions), always read the primary.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, \
+    sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.urls import Resolver404, resolve
+
+PIN_SESSION_KEY = '_primary_pinned_until'
+
+_reading_replica = ContextVar('reading_replica', default=False)
+
+
+def replicas():
+    """ Return the aliases of the configured read replicas """
+    return [alias for alias, database in connections.settings.items()
+            if database.get('REPLICA')]
+
+
+@contextmanager
+def use_replica(enabled=True):
+    """ Route the reads of the block to a replica (if any) """
+    token = _reading_replica.set(enabled)
+    try:
+        yield
+    finally:
+        _reading_replica.reset(token)
+
+
+def replica_reads(view):
+    """ Mark a view (function or class) whose GET can read a replica """
+    view.replica_reads = True
+    return view
+
+
+class ReplicaRouter:
+    """ Writes to the primary, reads to a replica inside use_replica() """
+
+    def db_for_read(self, model, **hints):
+        if _reading_replica.get():
+            aliases = replicas()
+            if aliases:
+                return random.choice(aliases)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replicas():
+            return False
+        return None
+
+
+class ReplicaMiddleware:
+    """ Replica reads for marked views, primary pinning after writes """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def reads_replica(self, request):
+        if request.method not in ('GET', 'HEAD') or not replicas() \
+                or request.session.get(PIN_SESSION_KEY, 0) > time.time():
+            return False
+        try:
+            match = resolve(request.path_info,
+                            getattr(request, 'urlconf', None))
+        except Resolver404:
+            return False
+        view = getattr(match.func, 'view_class', match.func)
+        return getattr(view, 'replica_reads', False)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with use_replica(self.reads_replica(request)):
+            response = self.get_response(request)
+        return self.pin(request, response)
+
+    async def __acall__(self, request):
+        if not replicas():
+            return await self.get_response(request)
+        # the session is loaded from the database
+        with use_replica(await sync_to_async(self.reads_replica)(request)):
+            response = await self.get_response(request)
+        return await sync_to_async(self.pin)(request, response)
+
+    def pin(self, request, response):
+        """ Pin the session to the primary after a successful write """
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') \
+                and response.status_code < 400 and replicas():
+            request.session[PIN_SESSION_KEY] = \
+                time.time() + settings.REPLICA_PIN_SECONDS
+        return response
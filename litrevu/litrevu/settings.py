@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from .db import databases
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -34,17 +37,22 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
-    'django.contrib.staticfiles',
+    'litrevu.apps.StaticConfig',
     'authentication',
     'reviews',
 ]
 
 MIDDLEWARE = [
+    'litrevu.instrumentation.InstrumentationMiddleware',
+    'litrevu.compression.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'litrevu.staticfiles.StaticFilesMiddleware',
+    'litrevu.ratelimit.AdmissionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'litrevu.routers.ReplicaMiddleware',
     'django.contrib.auth.middleware.LoginRequiredMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -52,6 +60,40 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'litrevu.urls'
 
+# Per-request SQL / rendering measures (Server-Timing, /instrumentation/):
+# a statement run this many times in one request is flagged as an N+1
+INSTRUMENTATION_N_PLUS_ONE = 5
+
+# Rate limits per user (per IP when anonymous), see litrevu.ratelimit:
+# `rate` requests per second on average, bursts of up to `burst`.
+# A scope missing here is not limited.
+RATE_LIMITS = {
+    'autocomplete': {'rate': 10, 'burst': 30},
+    'search': {'rate': 2, 'burst': 20},
+    'follow': {'rate': 2, 'burst': 20},
+    'write': {'rate': 0.5, 'burst': 20},
+}
+# Admission control: requests running at once per process (0: no limit),
+# and the queueing time (proxy + wait for a slot) after which a request
+# is answered 503 instead
+ADMISSION_MAX_CONCURRENT = int(os.environ.get('LITREVU_MAX_CONCURRENT', 32))
+ADMISSION_MAX_QUEUE_MS = 2000
+
+# Background deletion of tickets and users (reviews.deletion): first
+# batch size, then resized so that each batch transaction holds its
+# locks for about DELETION_MAX_LOCK_MS
+DELETION_BATCH_SIZE = 500
+DELETION_MAX_LOCK_MS = 200
+
+# Compression of the HTML and JSON responses (litrevu.compression):
+# encodings by preference (br and zstd need the brotli and zstandard
+# packages), levels chosen for speed, smaller bodies sent as they are,
+# streamed bodies flushed to the client every COMPRESSION_FLUSH_SIZE bytes
+COMPRESSION_ENCODINGS = ['zstd', 'br', 'gzip']
+COMPRESSION_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+COMPRESSION_MIN_SIZE = 512
+COMPRESSION_FLUSH_SIZE = 16 * 1024
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -71,14 +113,34 @@ WSGI_APPLICATION = 'litrevu.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
+# SQLite (WAL) by default, PostgreSQL with LITREVU_DB=postgres, see litrevu.db
+
+DATABASES = databases(BASE_DIR)
 
-DATABASES = {
+# Writes go to the primary, the views marked replica_reads read a replica
+# (if any), except for REPLICA_PIN_SECONDS after a write of the session
+DATABASE_ROUTERS = ['litrevu.routers.ReplicaRouter']
+REPLICA_PIN_SECONDS = 10
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Local-memory by default, any backend can be plugged here (Redis, Memcached)
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'litrevu',
     }
 }
 
+# Sessions are read from the cache and written through to the database;
+# LITREVU_SESSIONS=signed_cookies keeps them client-side (no table at all)
+SESSION_ENGINE = 'django.contrib.sessions.backends.' \
+    + os.environ.get('LITREVU_SESSIONS', 'cached_db')
+
+# request.user is resolved from a versioned cache entry
+AUTHENTICATION_BACKENDS = ['authentication.backends.CachedModelBackend']
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -112,6 +174,26 @@ USE_TZ = True
 MEDIA_ROOT = 'static/pictures'
 STATIC_URL = 'static/'
 STATICFILES_DIRS = [BASE_DIR / "static"]
+# collectstatic output: minified, hashed and precompressed (litrevu.staticfiles)
+STATIC_ROOT = BASE_DIR / "staticfiles"
+STORAGES = {
+    'default': {
+        # uploads stored once per content, reference counted
+        'BACKEND': 'reviews.uploads.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'litrevu.staticfiles.PipelineStorage',
+    },
+}
+# collected images wider than this are resized, then re-encoded
+STATIC_IMAGE_MAX_WIDTH = 1600
+STATIC_IMAGE_QUALITY = 80
+# Uploads (reviews.uploads): images only, checked from their first bytes,
+# hashed while spooled
+FILE_UPLOAD_HANDLERS = ['reviews.uploads.ImageUploadHandler']
+UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+UPLOAD_MAX_PIXELS = 40_000_000
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -124,3 +206,7 @@ AUTH_USER_MODEL = 'authentication.User'
 LOGIN_URL = '/auth/login/'
 LOGIN_REDIRECT_URL = '/reviews/'
 LOGOUT_REDIRECT_URL = '/auth/login/'
+
+# Routes the read-heavy reviews views to their async versions
+# (reviews.async_views), for an ASGI deployment (litrevu.asgi)
+REVIEWS_ASYNC_VIEWS = os.environ.get('LITREVU_ASYNC_VIEWS') == '1'
@@ -0,0 +1,253 @@
+"""
+Static files pipeline.
+
+`collectstatic` with PipelineStorage:
+- minifies the CSS and re-encodes the images wider than
+  STATIC_IMAGE_MAX_WIDTH, always from the source files so that running
+  it again never degrades them;
+- then, like ManifestStaticFilesStorage, copies every file under a
+  content-hashed name (base.3f2a9c1e.css) listed in staticfiles.json;
+- writes gzip (and brotli, if the optional `brotli` package is
+  installed) variants next to the text files, when smaller.
+
+StaticFilesMiddleware serves STATIC_ROOT itself (DEBUG off, or
+`runserver --nostatic`): hashed names with far-future immutable cache
+headers, the smallest precompressed variant the client accepts.
+"""
+import gzip
+import mimetypes
+import os
+import re
+from io import BytesIO
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, \
+    sync_to_async
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, \
+    staticfiles_storage
+from django.core.files.base import ContentFile
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+from PIL import Image, UnidentifiedImageError
+
+from . import compression
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.txt', '.json', '.map', '.html')
+# smaller files are not worth a compressed variant
+COMPRESS_MIN_SIZE = 256
+IMAGE_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG'}
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# unhashed names may change at the next deployment
+SHORT_MAX_AGE = 'public, max-age=60'
+# (suffix, Content-Encoding), best first
+VARIANTS = (('.br', 'br'), ('.gz', 'gzip'))
+
+_CSS_TOKENS = re.compile(
+    r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|/\*(?!!).*?\*/', re.S)
+_CSS_PUNCTUATION = re.compile(r'\s*([{};,>])\s*')
+
+
+def minify_css(css):
+    """
+    Remove the comments (except /*! ... */) and the useless whitespace
+    of a stylesheet, leaving the strings untouched.
+    """
+    strings = []
+
+    def protect(match):
+        if match.group().startswith('/*'):
+            return ''
+        strings.append(match.group())
+        return f'\x00{len(strings) - 1}\x00'
+
+    css = _CSS_TOKENS.sub(protect, css)
+    css = re.sub(r'\s+', ' ', css)
+    css = _CSS_PUNCTUATION.sub(r'\1', css)
+    css = re.sub(r':\s+', ':', css).replace(';}', '}').strip()
+    return re.sub('\x00(\\d+)\x00',
+                  lambda match: strings[int(match.group(1))], css)
+
+
+def reencode_image(data, extension):
+    """
+    Return the image data resized to STATIC_IMAGE_MAX_WIDTH and
+    re-encoded, or None if it is not an image or would not shrink.
+    """
+    try:
+        image = Image.open(BytesIO(data))
+        image.load()
+    except (OSError, UnidentifiedImageError):
+        return None
+    max_width = settings.STATIC_IMAGE_MAX_WIDTH
+    if image.width > max_width:
+        height = max(1, round(image.height * max_width / image.width))
+        image = image.resize((max_width, height), Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    if IMAGE_FORMATS[extension] == 'JPEG':
+        image.convert('RGB').save(
+            buffer, 'JPEG', quality=settings.STATIC_IMAGE_QUALITY,
+            optimize=True, progressive=True)
+    else:
+        image.save(buffer, 'PNG', optimize=True)
+    encoded = buffer.getvalue()
+    return encoded if len(encoded) < len(data) else None
+
+
+def compress(data):
+    """ Return the {suffix: bytes} compressed variants worth keeping """
+    variants = {}
+    if len(data) < COMPRESS_MIN_SIZE:
+        return variants
+    # mtime=0: the same file always gives the same bytes
+    variants['.gz'] = gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data, quality=11)
+    return {suffix: compressed for suffix, compressed in variants.items()
+            if len(compressed) < len(data)}
+
+
+class PipelineStorage(ManifestStaticFilesStorage):
+    """ Minified, re-encoded, hashed and precompressed static files """
+
+    def _replace(self, name, data):
+        self.delete(name)
+        self._save(name, ContentFile(data))
+
+    def _optimize(self, paths):
+        """
+        Rewrite the collected copies from their sources, and point paths
+        at the copies: the hashed names are computed from the paths.
+        """
+        for name, (storage, path) in paths.items():
+            extension = os.path.splitext(name)[1].lower()
+            if extension != '.css' and extension not in IMAGE_FORMATS:
+                continue
+            with storage.open(path) as source:
+                data = source.read()
+            if extension == '.css':
+                optimized = minify_css(data.decode()).encode()
+            else:
+                optimized = reencode_image(data, extension)
+            if optimized is not None and optimized != data:
+                self._replace(name, optimized)
+                paths[name] = (self, name)
+
+    def _compress(self, names):
+        for name in names:
+            if not name.lower().endswith(COMPRESSIBLE):
+                continue
+            with self.open(name) as file:
+                data = file.read()
+            for suffix, compressed in compress(data).items():
+                self._replace(name + suffix, compressed)
+
+    def post_process(self, paths, dry_run=False, **options):
+        if dry_run:
+            yield from super().post_process(paths, dry_run, **options)
+            return
+        self._optimize(paths)
+        yield from super().post_process(paths, dry_run, **options)
+        self._compress({*paths, *self.hashed_files.values()})
+
+    def stored_name(self, name):
+        # before the first collectstatic (tests, development), serve the
+        # unhashed names instead of failing on the missing manifest
+        if not self.hashed_files:
+            return name
+        return super().stored_name(name)
+
+
+class StaticFilesMiddleware:
+    """ Serve the collected files, cached and precompressed """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.files = None
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def index(self):
+        """ Map the URL path of each collected file to its details """
+        files = {}
+        root = settings.STATIC_ROOT
+        if not root or not os.path.isdir(root):
+            return files
+        hashed = set(getattr(staticfiles_storage, 'hashed_files', {})
+                     .values())
+        prefix = '/' + settings.STATIC_URL.lstrip('/')
+        for directory, _, names in os.walk(root):
+            for filename in names:
+                if filename.endswith(('.gz', '.br')):
+                    continue
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, root).replace(os.sep, '/')
+                files[prefix + name] = {
+                    'path': path,
+                    'variants': [(suffix, encoding)
+                                 for suffix, encoding in VARIANTS
+                                 if os.path.exists(path + suffix)],
+                    'cache_control': IMMUTABLE if name in hashed
+                    else SHORT_MAX_AGE,
+                }
+        return files
+
+    def is_static(self, request):
+        return request.method in ('GET', 'HEAD') \
+            and request.path_info.startswith(
+                '/' + settings.STATIC_URL.lstrip('/'))
+
+    def static_response(self, request):
+        """ Return the response of a collected file, None if not found """
+        if self.files is None:
+            self.files = self.index()
+        found = self.files.get(request.path_info)
+        return self.serve(request, found) if found else None
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if self.is_static(request):
+            response = self.static_response(request)
+            if response is not None:
+                return response
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        if self.is_static(request):
+            # stat and open the file off the event loop
+            response = await sync_to_async(
+                self.static_response, thread_sensitive=False)(request)
+            if response is not None:
+                return response
+        return await self.get_response(request)
+
+    def serve(self, request, found):
+        variants = {name: suffix for suffix, name in found['variants']}
+        encoding = compression.negotiate(
+            request.headers.get('Accept-Encoding', ''), list(variants))
+        path = found['path'] + variants.get(encoding, '')
+        stat = os.stat(path)
+        if not was_modified_since(request.headers.get('If-Modified-Since'),
+                                  stat.st_mtime):
+            response = HttpResponseNotModified()
+        else:
+            content_type = mimetypes.guess_type(found['path'])[0]
+            response = FileResponse(
+                open(path, 'rb'),
+                content_type=content_type or 'application/octet-stream')
+            if encoding:
+                response['Content-Encoding'] = encoding
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        response['Cache-Control'] = found['cache_control']
+        if found['variants']:
+            response['Vary'] = 'Accept-Encoding'
+        return response
@@ -20,8 +20,11 @@ from django.contrib import admin
 from django.shortcuts import redirect
 from django.urls import path, include
 
+from .instrumentation import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('instrumentation/', metrics_view, name='instrumentation'),
     path('auth/', include('authentication.urls', 'authentication')),
     path('reviews/', include('reviews.urls', 'reviews')),
     path('', lambda request: redirect('authentication:redirect')),
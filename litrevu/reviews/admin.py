@@ -1,12 +1,69 @@
 from django.contrib import admin
+from django.db import models
 
-from .models import Ticket, Review, UserFollow, UserBlocked
+from . import bulk, deletion
+from .models import DeletionJob, StoredFile, Ticket, Review, UserFollow, \
+    UserBlocked
+from .uploads import UploadImageField
+
+
+def _report(modeladmin, request, result, action):
+    bulk.refresh(result)
+    modeladmin.message_user(
+        request, f"{action} : {result.created} créé(s), {result.deleted} "
+                 f"supprimé(s), {result.skipped} ignoré(s) "
+                 f"({result.rate:.0f} lignes/s).")
+
+
+@admin.action(description="Supprimer en masse les abonnements sélectionnés")
+def delete_follows(modeladmin, request, queryset):
+    result = bulk.remove_follows(
+        queryset.values_list('user', 'following_user'))
+    _report(modeladmin, request, result, "Abonnements")
+
+
+@admin.action(description="Supprimer en masse les blocages sélectionnés")
+def delete_blocks(modeladmin, request, queryset):
+    result = bulk.remove_blocks(queryset.values_list('user', 'blocked_user'))
+    _report(modeladmin, request, result, "Blocages")
+
+
+@admin.action(description="Appliquer les blocages (retirer les abonnements "
+                          "des utilisateurs bloqués)")
+def apply_blocks(modeladmin, request, queryset):
+    result = bulk.add_blocks(queryset.values_list('user', 'blocked_user'))
+    _report(modeladmin, request, result, "Blocages")
+
+
+class TombstoneAdminMixin:
+    """
+    Delete the objects through reviews.deletion: tombstoned at once, their
+    dependent rows removed in the background.
+    """
+
+    def get_deleted_objects(self, objs, request):
+        # listing every dependent row would load what the background
+        # deletion avoids loading: only the objects are shown
+        return ([str(obj) for obj in objs],
+                {self.model._meta.verbose_name_plural: len(objs)}, set(), [])
+
+    def delete_model(self, request, obj):
+        deletion.tombstone(obj)
+
+    def delete_queryset(self, request, queryset):
+        for obj in queryset:
+            deletion.tombstone(obj)
+
+
+class UploadAdminMixin:
+    """ Image fields checked and stored as the site's forms do them """
+    formfield_overrides = {models.ImageField: {'form_class': UploadImageField}}
 
 
 @admin.register(Ticket)
-class TicketAdmin(admin.ModelAdmin):
+class TicketAdmin(TombstoneAdminMixin, UploadAdminMixin, admin.ModelAdmin):
     """ Class Ticket for admin interface """
-    list_display = ('title', 'user', 'time_created')
+    list_display = ('title', 'user', 'time_created', 'deleted_at')
 
 
 @admin.register(Review)
@@ -19,9 +76,37 @@ class ReviewAdmin(admin.ModelAdmin):
 class UserFollowAdmin(admin.ModelAdmin):
     """ Class UserFollow for admin interface """
     list_display = ('user', 'following_user')
+    actions = [delete_follows]
 
 
 @admin.register(UserBlocked)
 class UserBlockedAdmin(admin.ModelAdmin):
     """ Class UserBlocked for admin interface """
     list_display = ('user', 'blocked_user')
+    actions = [delete_blocks, apply_blocks]
+
+
+@admin.register(DeletionJob)
+class DeletionJobAdmin(admin.ModelAdmin):
+    """ Class DeletionJob for admin interface (progress, read only) """
+    list_display = ('content_type', 'label', 'step', 'deleted', 'batches',
+                    'created_at', 'finished_at', 'error')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(StoredFile)
+class StoredFileAdmin(admin.ModelAdmin):
+    """ Class StoredFile for admin interface (reference counts, read only) """
+    list_display = ('name', 'references')
+    search_fields = ('name',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,82 @@
+"""
+JSON read API of the feed.
+
+`stream_timeline` walks the materialized timeline batch by batch (keyset
+cursor, see feed.timeline) and yields the JSON document piece by piece,
+so a response only holds one batch of posts in memory whatever its size.
+Posts are reduced to a compact set of fields by `serialize_post`.
+"""
+import json
+
+from . import feed
+
+API_PAGE_SIZE = feed.FEED_PAGE_SIZE
+API_MAX_PAGE_SIZE = 200
+
+
+def _file_url(field):
+    return field.url if field else None
+
+
+def _user(user):
+    return {"id": user.pk, "username": user.username,
+            "avatar": _file_url(user.profile_picture)}
+
+
+def serialize_post(post):
+    """ Return the compact dict of a ticket or review """
+    data = {
+        "type": post.content_type,
+        "id": post.pk,
+        "user": _user(post.user),
+        "time_created": post.time_created.isoformat(),
+    }
+    if post.content_type == "ticket":
+        data.update({
+            "title": post.title,
+            "description": post.description,
+            "image": _file_url(post.image),
+            "review_count": post.review_count,
+            "average_rating": post.average_rating,
+            "is_reviewed": post.is_reviewed,
+        })
+    else:
+        data.update({
+            "headline": post.headline,
+            "body": post.body,
+            "rating": post.rating,
+            "ticket": {"id": post.ticket.pk, "title": post.ticket.title,
+                       "user": _user(post.ticket.user)},
+        })
+    return data
+
+
+def page_size(value):
+    """ Return the requested number of posts, bounded, default if invalid """
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return API_PAGE_SIZE
+    return max(1, min(size, API_MAX_PAGE_SIZE))
+
+
+def stream_timeline(user, cursor=None, limit=API_PAGE_SIZE,
+                    batch_size=feed.FEED_PAGE_SIZE):
+    """
+    Yield the JSON document {"results": [...], "next_cursor": ...} of at
+    most limit posts of the user's timeline, reading batch_size posts at
+    a time.
+    """
+    yield '{"results":['
+    remaining, separator = limit, ""
+    while True:
+        page = feed.timeline(user, cursor=cursor,
+                             page_size=min(batch_size, remaining))
+        for post in page.posts:
+            yield separator + json.dumps(serialize_post(post))
+            separator = ","
+        remaining -= len(page.posts)
+        cursor = page.next_cursor
+        if cursor is None or remaining <= 0:
+            break
+    yield '],"next_cursor":' + json.dumps(cursor) + "}"
@@ -0,0 +1,91 @@
+"""
+Async versions of the read-heavy views, for the ASGI deployment
+(litrevu.asgi). They are routed instead of the sync ones of views.py
+when the REVIEWS_ASYNC_VIEWS setting is True, see reviews.urls.
+
+Queries go through the async ORM API; the ticket and review queries of
+a page are issued concurrently (asyncio.gather, see feed.ahydrate and
+feed.apaginate). Cache, template and graph helpers stay sync and run in
+the ORM's thread through sync_to_async.
+"""
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.http import JsonResponse
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import require_GET, require_POST
+
+from litrevu.ratelimit import rate_limited
+from litrevu.routers import replica_reads
+
+from . import cards, feed, images
+from .autocomplete import username_index
+from .graph import social_graph
+from .models import Review, Ticket, UserFollow
+from .versions import conditional_timeline
+from .views import AUTOCOMPLETE_MAX_AGE, FeedView, PostView
+
+User = get_user_model()
+
+
+@method_decorator(conditional_timeline, name='get')
+class AsyncFeedView(FeedView):
+    """ Async FeedView """
+
+    async def get(self, request, *args, **kwargs):
+        user = await request.auser()
+        page = await feed.atimeline(user, cursor=request.GET.get('cursor'))
+        await sync_to_async(images.attach_renditions)(page.posts)
+
+        context = super(FeedView, self).get_context_data(**kwargs)
+        context['list_posts'] = page.posts
+        context['list_cards'] = await sync_to_async(cards.render_cards)(
+            page.posts, user)
+        context['next_cursor'] = page.next_cursor
+        return self.render_to_response(context)
+
+
+@method_decorator(conditional_timeline, name='get')
+class AsyncPostView(PostView):
+    """ Async PostView """
+
+    async def get(self, request, *args, **kwargs):
+        user = await request.auser()
+        page = await feed.apaginate(Ticket.objects.filter(user=user),
+                                    Review.objects.filter(user=user),
+                                    cursor=request.GET.get('cursor'))
+        await sync_to_async(images.attach_renditions)(page.posts)
+
+        context = super(PostView, self).get_context_data(**kwargs)
+        context['posts'] = page.posts
+        context['next_cursor'] = page.next_cursor
+        return self.render_to_response(context)
+
+
+@require_POST
+@rate_limited('follow')
+async def follow_user(request):
+    """ Async follow_user """
+    user = await request.auser()
+    user_to_follow = await User.objects.aget(
+        username=request.POST.get("username"))
+    await UserFollow.objects.aget_or_create(user=user,
+                                            following_user=user_to_follow)
+    return JsonResponse({"success": True})
+
+
+@replica_reads
+@require_GET
+@rate_limited('autocomplete')
+async def search_user(request):
+    """ Async search_user """
+    user = await request.auser()
+    graph = await sync_to_async(social_graph.sets)(user)
+    exclude = graph['following'] | graph['blocking'] | {user.pk}
+
+    data = await sync_to_async(username_index.complete)(
+        request.GET.get("q", ""), limit=10, exclude=exclude)
+    response = JsonResponse(data, safe=False)
+    patch_cache_control(response, private=True,
+                        max_age=AUTOCOMPLETE_MAX_AGE)
+    return response
@@ -0,0 +1,131 @@
+"""
+Username autocomplete.
+
+UsernameIndex keeps every username, normalized (case and accents folded),
+in a sorted array searched with bisect, with the data search_user returns.
+It is built once per process, updated incrementally on signup and
+username change (reviews.signals), and rebuilt when another process bumps
+the shared version kept in the cache.
+"""
+import threading
+import unicodedata
+import uuid
+from bisect import bisect_left, insort
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+DEFAULT_PICTURE = "/static/pictures/default_pictures/default.png"
+VERSION_KEY = "username-index:version"
+
+
+def normalize(username):
+    """ Return the case and accent insensitive form of a username """
+    decomposed = unicodedata.normalize("NFKD", username.casefold())
+    return "".join(char for char in decomposed
+                   if not unicodedata.combining(char))
+
+
+def _entry(user):
+    """ Return the data returned for a user """
+    return {
+        "username": user.username,
+        "image": (user.profile_picture.url if user.profile_picture
+                  else DEFAULT_PICTURE),
+    }
+
+
+class UsernameIndex:
+    """ Sorted (normalized username, id) array with per-user data """
+
+    def __init__(self, backend=cache):
+        self.cache = backend
+        self.keys = []
+        self.users = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def _shared_version(self):
+        """ Random token, a lost cache entry makes every process rebuild """
+        return self.cache.get_or_set(VERSION_KEY, uuid.uuid4().hex, None)
+
+    def build(self):
+        """ Load every user, sorted by normalized username """
+        users = get_user_model().objects.filter(
+            deleted_at__isnull=True).only("pk", "username", "profile_picture")
+        with self.lock:
+            self.version = self._shared_version()
+            self.users = {user.pk: (normalize(user.username), _entry(user))
+                          for user in users.iterator()}
+            self.keys = sorted((key, pk) for pk, (key, _)
+                               in self.users.items())
+
+    def _ensure_fresh(self):
+        if self.version is None or self.version != self._shared_version():
+            self.build()
+
+    def _remove_locked(self, pk):
+        previous = self.users.pop(pk, None)
+        if previous is not None:
+            position = bisect_left(self.keys, (previous[0], pk))
+            if position < len(self.keys) and self.keys[position] == \
+                    (previous[0], pk):
+                del self.keys[position]
+
+    def _changed(self, mutate):
+        """
+        Apply mutate to the local index if it is up to date, and bump the
+        shared version so that the other processes rebuild theirs.
+        """
+        with self.lock:
+            fresh = self.version is not None \
+                and self.version == self._shared_version()
+            if fresh:
+                mutate()
+            version = uuid.uuid4().hex
+            self.cache.set(VERSION_KEY, version, None)
+            self.version = version if fresh else None
+
+    def update(self, user):
+        """ Add a new user or refresh a renamed one """
+        def mutate():
+            self._remove_locked(user.pk)
+            key = normalize(user.username)
+            self.users[user.pk] = (key, _entry(user))
+            insort(self.keys, (key, user.pk))
+        self._changed(mutate)
+
+    def remove(self, user_id):
+        """ Drop a deleted user """
+        self._changed(lambda: self._remove_locked(user_id))
+
+    def invalidate(self):
+        """ Make every process rebuild its index, after bulk user writes """
+        self._changed(lambda: None)
+        with self.lock:
+            self.version = None
+
+    def complete(self, prefix, limit=10, exclude=()):
+        """
+        Return the data of at most limit users whose normalized username
+        starts with prefix, in alphabetical order, skipping excluded ids.
+        """
+        self._ensure_fresh()
+        prefix = normalize(prefix.strip())
+        if not prefix:
+            return []
+        results = []
+        with self.lock:
+            keys = self.keys
+            position = bisect_left(keys, (prefix,))
+            while position < len(keys) and len(results) < limit:
+                key, pk = keys[position]
+                if not key.startswith(prefix):
+                    break
+                if pk not in exclude:
+                    results.append(self.users[pk][1])
+                position += 1
+        return results
+
+
+username_index = UsernameIndex()
@@ -0,0 +1,298 @@
+"""
+Bulk social graph and post writes.
+
+The per-row views (follow_user, blocked_user...) rely on the signals of
+reviews.signals to keep the derived data in sync, one relationship at a
+time. The functions below write whole sets of rows with bulk_create
+(ignore_conflicts) and set-wise deletes, which send no signal, then
+`refresh` the derived data once for everything they touched: timelines
+(only the posts of the users followed, unfollowed, blocked or unblocked,
+and the new posts), cached social graph, counters, timeline versions
+and search index.
+
+Block rules are applied set-wise like blocked_user does for one user: a
+block removes the blocked user's follow of the blocking user, and no
+follow is created towards a user who blocks the follower.
+"""
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from functools import wraps
+
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.db.models import Exists, OuterRef
+
+from . import counters, feed, search, versions
+from .autocomplete import username_index
+from .graph import social_graph
+from .models import Review, Ticket, UserBlocked, UserFollow
+
+BATCH_SIZE = 1000
+
+
+@dataclass
+class BulkResult:
+    """ Rows written by a bulk operation and the users it affected """
+    created: int = 0
+    deleted: int = 0
+    skipped: int = 0
+    elapsed: float = 0.0
+    owners: set = field(default_factory=set)
+    users: set = field(default_factory=set)
+    tickets: set = field(default_factory=set)
+    # (owner, author) pairs whose timeline gains / loses author's posts
+    shown: set = field(default_factory=set)
+    hidden: set = field(default_factory=set)
+    posts: list = field(default_factory=list)
+
+    @property
+    def rows(self):
+        return self.created + self.deleted + self.skipped
+
+    @property
+    def rate(self):
+        """ Rows per second """
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def merge(self, other):
+        self.created += other.created
+        self.deleted += other.deleted
+        self.skipped += other.skipped
+        self.elapsed += other.elapsed
+        self.owners |= other.owners
+        self.users |= other.users
+        self.tickets |= other.tickets
+        self.shown |= other.shown
+        self.hidden |= other.hidden
+        self.posts += other.posts
+        return self
+
+
+def delete_rows(queryset, batch_size=500):
+    """
+    Delete rows without loading them nor sending signals, the derived
+    data is refreshed once afterwards: only their ids are read, then
+    deleted by batches of batch_size. Return the number of rows.
+    """
+    model = queryset.model
+    using = queryset.db
+    connection = connections[using]
+    ids = list(queryset.values_list('pk', flat=True))
+    sql = 'DELETE FROM {} WHERE {} IN ({{}})'.format(
+        connection.ops.quote_name(model._meta.db_table),
+        connection.ops.quote_name(model._meta.pk.column))
+    deleted = 0
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            cursor.execute(sql.format(', '.join(['%s'] * len(batch))),
+                           batch)
+            deleted += cursor.rowcount
+    return deleted
+
+
+def _count_new(model, rows, batch_size, **scope):
+    """
+    bulk_create rows ignoring conflicts and return the number of rows
+    actually added, counted among the rows matching scope.
+    """
+    existing = model.objects.filter(**scope)
+    before = existing.count()
+    model.objects.bulk_create(rows, batch_size=batch_size,
+                              ignore_conflicts=True)
+    return existing.count() - before
+
+
+def _by_user(pairs):
+    """ Group (user_id, target_id) pairs by user """
+    grouped = defaultdict(set)
+    for user, target in pairs:
+        grouped[user].add(target)
+    return grouped
+
+
+def _timed(function):
+    """ Set the elapsed time of the BulkResult returned by function """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        result.elapsed = time.perf_counter() - start
+        return result
+    return wrapper
+
+
+@_timed
+@transaction.atomic
+def add_follows(pairs, batch_size=BATCH_SIZE):
+    """
+    Create the (user_id, followed_id) follows, skipping self follows and
+    follows towards a user who blocks the follower.
+    """
+    pairs = {(user, target) for user, target in pairs if user != target}
+    blocked = set()
+    users = {user for user, _ in pairs}
+    if users:
+        blocked = set(UserBlocked.objects.filter(blocked_user__in=users)
+                      .values_list('blocked_user', 'user'))
+    allowed = pairs - blocked
+    created = _count_new(
+        UserFollow,
+        [UserFollow(user_id=user, following_user_id=target)
+         for user, target in allowed], batch_size, user__in=users)
+    return BulkResult(created=created, skipped=len(pairs) - created,
+                      owners={user for user, _ in allowed},
+                      users={user for pair in allowed for user in pair},
+                      shown=allowed)
+
+
+@_timed
+@transaction.atomic
+def remove_follows(pairs):
+    """ Delete the (user_id, followed_id) follows """
+    pairs = set(pairs)
+    deleted = sum(
+        delete_rows(UserFollow.objects.filter(user=user,
+                                              following_user__in=targets))
+        for user, targets in _by_user(pairs).items())
+    return BulkResult(deleted=deleted, skipped=len(pairs) - deleted,
+                      owners={user for user, _ in pairs},
+                      users={user for pair in pairs for user in pair},
+                      hidden=pairs)
+
+
+@_timed
+@transaction.atomic
+def add_blocks(pairs, batch_size=BATCH_SIZE):
+    """
+    Create the (user_id, blocked_id) blocks and delete, in one statement,
+    the follows of the blocked users towards the users blocking them.
+    """
+    pairs = {(user, target) for user, target in pairs if user != target}
+    created = _count_new(
+        UserBlocked,
+        [UserBlocked(user_id=user, blocked_user_id=target)
+         for user, target in pairs], batch_size,
+        user__in={user for user, _ in pairs})
+    blocked = {target for _, target in pairs}
+    deleted = delete_rows(UserFollow.objects.filter(
+        Exists(UserBlocked.objects.filter(user=OuterRef('following_user'),
+                                          blocked_user=OuterRef('user'))),
+        user__in=blocked,
+    )) if pairs else 0
+    return BulkResult(created=created, deleted=deleted,
+                      skipped=len(pairs) - created, owners=blocked,
+                      users={user for pair in pairs for user in pair},
+                      hidden={(target, user) for user, target in pairs})
+
+
+@_timed
+@transaction.atomic
+def remove_blocks(pairs):
+    """ Delete the (user_id, blocked_id) blocks """
+    pairs = set(pairs)
+    deleted = sum(
+        delete_rows(UserBlocked.objects.filter(user=user,
+                                               blocked_user__in=targets))
+        for user, targets in _by_user(pairs).items())
+    return BulkResult(deleted=deleted, skipped=len(pairs) - deleted,
+                      owners={target for _, target in pairs},
+                      users={user for pair in pairs for user in pair},
+                      shown={(target, user) for user, target in pairs})
+
+
+@_timed
+@transaction.atomic
+def add_users(users, batch_size=BATCH_SIZE):
+    """
+    Insert unsaved User objects (passwords already hashed) and make the
+    username index rebuild. Return the result; the users get their keys.
+    """
+    users = get_user_model().objects.bulk_create(users,
+                                                 batch_size=batch_size)
+    transaction.on_commit(username_index.invalidate)
+    return BulkResult(created=len(users), users={user.pk for user in users})
+
+
+@_timed
+@transaction.atomic
+def add_posts(tickets=(), reviews=(), batch_size=BATCH_SIZE):
+    """
+    Insert unsaved Ticket and Review objects (reviews of the tickets must
+    be saved or in tickets) and index them. Return the result; the
+    objects get their primary keys.
+    """
+    tickets = Ticket.objects.bulk_create(tickets, batch_size=batch_size)
+    reviews = Review.objects.bulk_create(reviews, batch_size=batch_size)
+    backend = search.get_backend()
+    for post in (*tickets, *reviews):
+        backend.index(post)
+    ticket_ids = {ticket.pk for ticket in tickets} \
+        | {review.ticket_id for review in reviews}
+    authors = {post.user_id for post in (*tickets, *reviews)}
+    authors |= set(Ticket.objects.filter(pk__in=ticket_ids)
+                   .values_list('user', flat=True))
+    readers = set(UserFollow.objects.filter(following_user__in=authors)
+                  .values_list('user', flat=True))
+    return BulkResult(created=len(tickets) + len(reviews),
+                      owners=authors | readers, users=authors,
+                      tickets=ticket_ids, posts=[*tickets, *reviews])
+
+
+@transaction.atomic
+def refresh(result):
+    """
+    Bring the data derived from the social graph and the posts up to date
+    after bulk writes: timelines of the affected owners, updated for the
+    authors they follow / unfollow, block / unblock (one call per owner)
+    and for the new posts, cached graph, counters, versions of the
+    related and affected users. Timelines are updated from the final
+    graph, whatever the order of the writes.
+    """
+    User = get_user_model()
+    for owner, authors in _by_user(result.hidden).items():
+        feed.remove_posts_of(owner, authors)
+    # the new posts reach the new followers through fan_out_posts
+    new_posts = {(type(post), post.pk) for post in result.posts}
+    for owner, authors in _by_user(result.shown).items():
+        feed.add_posts_of(owner, authors, skip=new_posts)
+    if result.posts:
+        feed.fan_out_posts(result.posts)
+    versions.bump(result.owners)
+    social_graph.invalidate(*result.users)
+    counters.reconcile(scope={User: result.users, Ticket: result.tickets})
+    if result.users:
+        versions.bump(versions.related_users(*result.users))
+
+
+def follow(user, targets):
+    """ Make user follow every target (users or ids) """
+    result = add_follows((user.pk, getattr(target, 'pk', target))
+                         for target in targets)
+    refresh(result)
+    return result
+
+
+def unfollow(user, targets):
+    """ Make user stop following every target (users or ids) """
+    result = remove_follows((user.pk, getattr(target, 'pk', target))
+                            for target in targets)
+    refresh(result)
+    return result
+
+
+def block(user, targets):
+    """ Make user block every target (users or ids) """
+    result = add_blocks((user.pk, getattr(target, 'pk', target))
+                        for target in targets)
+    refresh(result)
+    return result
+
+
+def unblock(user, targets):
+    """ Make user stop blocking every target (users or ids) """
+    result = remove_blocks((user.pk, getattr(target, 'pk', target))
+                           for target in targets)
+    refresh(result)
+    return result
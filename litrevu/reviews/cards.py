@@ -0,0 +1,104 @@
+"""
+Fragment cache of the feed post cards (reviews/post_card.html).
+
+Each card is rendered once and cached under a key versioned by the post
+id and its modification stamp (time_updated, and the ticket's one for a
+review), a digest of the names and avatars of the authors shown, plus
+the few viewer dependent flags the card shows. A page is
+read with one get_many and its misses stored with one set_many, on the
+default cache (any Django cache backend).
+"""
+import hashlib
+
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .images import attach_renditions
+
+CARD_TEMPLATE = 'reviews/post_card.html'
+CARD_TIMEOUT = 60 * 60 * 24
+
+
+def _kind(post):
+    """ Return the post type, 'ticket' or 'review' """
+    return type(post).__name__.lower()
+
+
+def _stamp(post):
+    """ Return the modification stamp of a post as an integer """
+    return int(post.time_updated.timestamp() * 1_000_000)
+
+
+def _renditions(obj, attribute):
+    """ Return the number of renditions attached to obj (see images) """
+    renditions = getattr(obj, attribute, None)
+    return renditions.version if renditions is not None else 0
+
+
+def _authors(post, ticket):
+    """
+    Return a digest of the usernames and avatars of the authors a card
+    shows: a renamed user or a new avatar changes the key
+    """
+    users = [post.user] if ticket is post else [post.user, ticket.user]
+    shown = "|".join(f"{user.username}:{user.profile_picture.name or ''}"
+                     for user in users)
+    return hashlib.sha1(shown.encode()).hexdigest()[:16]
+
+
+def _version(post):
+    """
+    Return the version part of the card key of a post: update stamps, the
+    authors shown, the number of image renditions shown (built in the
+    background) and the ticket's review counters.
+    """
+    ticket = post.ticket if _kind(post) == "review" else post
+    version = f"{_stamp(post)}.{_renditions(post.user, 'avatar')}"
+    if ticket is not post:
+        version += f".{_stamp(ticket)}"
+    return (f"{version}.{_authors(post, ticket)}"
+            f".{_renditions(ticket, 'cover')}"
+            f".{ticket.review_count}.{ticket.rating_sum}")
+
+
+def card_key(post, is_own, is_reviewed=False):
+    """ Return the cache key of the card of a post for one variant """
+    return (f"post-card:{_kind(post)}:{post.pk}:{_version(post)}"
+            f":{int(is_own)}{int(is_reviewed)}")
+
+
+def _variant(post, viewer):
+    """ Return the viewer dependent flags shown by the card """
+    is_reviewed = getattr(post, "is_reviewed", False)
+    return post.user_id == viewer.pk, is_reviewed
+
+
+def render_cards(posts, viewer):
+    """ Return the html of the cards of posts, as seen by viewer """
+    keys = [card_key(post, *_variant(post, viewer)) for post in posts]
+    cached = cache.get_many(keys)
+    missing = {}
+    cards = []
+    for key, post in zip(keys, posts):
+        if key not in cached:
+            missing[key] = render_to_string(
+                CARD_TEMPLATE, {"post": post, "viewer": viewer})
+        cards.append(mark_safe(cached[key] if key in cached
+                               else missing[key]))
+    if missing:
+        cache.set_many(missing, CARD_TIMEOUT)
+    return cards
+
+
+def invalidate_cards(post):
+    """
+    Drop every cached variant of the card of a post, before it is
+    modified or deleted (edits also change the key through time_updated).
+    """
+    attach_renditions([post])
+    cache.delete_many([
+        card_key(post, is_own, is_reviewed)
+        for is_own in (False, True)
+        for is_reviewed in (False, True)
+    ])
@@ -0,0 +1,161 @@
+"""
+Denormalized counters.
+
+Ticket.review_count / rating_sum and User.follower_count / following_count
+/ post_count are updated atomically with F() expressions from the create,
+edit and delete signals (reviews.signals), and repaired in bulk by
+`reconcile` (the reconcile_counters command). The saves of an existing
+ticket or user leave them alone unless update_fields names them
+(authentication.models.CounterFieldsMixin).
+`reviews_removed` and `follows_removed` apply the same updates for rows
+deleted in bulk without signals (reviews.deletion).
+"""
+from collections import Counter, defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, \
+    Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from authentication import backends
+
+from .models import Review, Ticket, UserFollow
+
+
+def _add(queryset, **deltas):
+    """ Add deltas to counter fields, never below zero, in one UPDATE """
+    queryset.update(**{
+        name: Greatest(F(name) + delta, Value(0)) if delta < 0
+        else F(name) + delta
+        for name, delta in deltas.items()
+    })
+
+
+def review_added(review):
+    _add(Ticket.objects.filter(pk=review.ticket_id),
+         review_count=1, rating_sum=review.rating)
+    post_added(review)
+
+
+def review_removed(review):
+    _add(Ticket.objects.filter(pk=review.ticket_id),
+         review_count=-1, rating_sum=-review.rating)
+    post_removed(review)
+
+
+def rating_changed(review, previous_rating):
+    delta = review.rating - previous_rating
+    if delta:
+        _add(Ticket.objects.filter(pk=review.ticket_id), rating_sum=delta)
+
+
+def _add_user(user_id, **deltas):
+    """ _add for one user, whose cached copy (request.user) gets stale """
+    _add(get_user_model().objects.filter(pk=user_id), **deltas)
+    backends.invalidate([user_id])
+
+
+def post_added(post):
+    _add_user(post.user_id, post_count=1)
+
+
+def post_removed(post):
+    _add_user(post.user_id, post_count=-1)
+
+
+def follow_added(follow):
+    _add_user(follow.user_id, following_count=1)
+    _add_user(follow.following_user_id, follower_count=1)
+
+
+def follow_removed(follow):
+    _add_user(follow.user_id, following_count=-1)
+    _add_user(follow.following_user_id, follower_count=-1)
+
+
+def reviews_removed(rows):
+    """
+    Count out reviews deleted without signals, given as (ticket_id,
+    user_id, rating) rows: one UPDATE per ticket and per author.
+    """
+    tickets = defaultdict(lambda: [0, 0])
+    authors = Counter()
+    for ticket_id, user_id, rating in rows:
+        tickets[ticket_id][0] += 1
+        tickets[ticket_id][1] += rating
+        authors[user_id] += 1
+    for ticket_id, (count, ratings) in tickets.items():
+        _add(Ticket.objects.filter(pk=ticket_id),
+             review_count=-count, rating_sum=-ratings)
+    for user_id, count in authors.items():
+        _add_user(user_id, post_count=-count)
+
+
+def follows_removed(pairs):
+    """
+    Count out follows deleted without signals, given as (user_id,
+    following_user_id) pairs: one UPDATE per user.
+    """
+    for user_id, count in Counter(user for user, _ in pairs).items():
+        _add_user(user_id, following_count=-count)
+    for user_id, count in Counter(target for _, target in pairs).items():
+        _add_user(user_id, follower_count=-count)
+
+
+def _aggregate(queryset, column, expression):
+    """ Correlated subquery returning expression grouped by column """
+    return Coalesce(
+        Subquery(queryset.filter(**{column: OuterRef('pk')})
+                 .order_by().values(column)
+                 .annotate(value=expression).values('value')),
+        Value(0), output_field=IntegerField())
+
+
+def expected_counters():
+    """ Return {model: {field: expression}} of the true counter values """
+    return {
+        Ticket: {
+            'review_count': _aggregate(Review.objects, 'ticket',
+                                       Count('pk')),
+            'rating_sum': _aggregate(Review.objects, 'ticket',
+                                     Sum('rating')),
+        },
+        get_user_model(): {
+            'follower_count': _aggregate(UserFollow.objects,
+                                         'following_user', Count('pk')),
+            'following_count': _aggregate(UserFollow.objects, 'user',
+                                          Count('pk')),
+            'post_count': (_aggregate(Ticket.objects, 'user', Count('pk'))
+                           + _aggregate(Review.objects, 'user',
+                                        Count('pk'))),
+        },
+    }
+
+
+def reconcile(check=False, scope=None):
+    """
+    Find the rows whose counters drifted and, unless check, repair them
+    with one UPDATE per model. scope ({model: ids}) restricts the check
+    to some rows of some models. Return {model name: drifted rows}.
+    """
+    drifted = {}
+    for model, fields in expected_counters().items():
+        rows = model.objects.all()
+        if scope is not None:
+            if not scope.get(model):
+                continue
+            rows = rows.filter(pk__in=scope[model])
+        annotated = rows.annotate(
+            **{f"expected_{name}": expression
+               for name, expression in fields.items()})
+        drift = Q()
+        for name in fields:
+            drift |= ~Q(**{name: F(f"expected_{name}")})
+        rows = annotated.filter(drift).values_list('pk', flat=True)
+        ids = list(rows)
+        drifted[model.__name__] = len(ids)
+        if ids and not check:
+            model.objects.filter(pk__in=ids).update(**fields)
+            if model is get_user_model():
+                backends.invalidate(ids)
+    return drifted
@@ -0,0 +1,295 @@
+"""
+Background cascade deletion of tickets and users.
+
+Deleting a ticket or a user through the ORM makes the Collector load
+every dependent row (reviews, follows, blocks, timeline entries) and
+delete them all in one long transaction. `tombstone` instead marks the
+root deleted (Ticket / User.deleted_at, the user is also deactivated),
+which hides it and its posts at once (feed.hydrate skips them), and
+records a DeletionJob run in the background.
+
+A job is a list of steps, each deleting the next batch of the rows left
+(bulk.delete_rows, no signal) in its own short transaction, then
+updating the counters and the search index of that batch. Timeline entries go with
+their posts, image files and renditions once the batch commits. The
+batch size adapts so that a transaction holds its locks for about
+DELETION_MAX_LOCK_MS. The root row is deleted last through the ORM,
+when nothing depends on it any more.
+
+Progress (step, rows deleted) is saved with each batch, and a step only
+deletes what is left, so a job interrupted by a crash or a deployment
+resumes where it stopped (the run_deletions command). A worker claims a
+job with a lease, renewed at every batch, so that two workers never run
+the same job.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from authentication import backends
+
+from . import bulk, counters, feed, images, search, versions
+from .autocomplete import username_index
+from .graph import social_graph
+from .models import DeletionJob, FeedEntry, Review, Ticket, UserBlocked, \
+    UserFollow
+
+logger = logging.getLogger(__name__)
+
+# a worker holds a job this long after each batch
+LEASE = timedelta(minutes=5)
+MAX_BATCH_SIZE = 10_000
+
+_executor = None
+
+
+# ================================================================ #
+#                         Steps                                    #
+# ================================================================ #
+def _next_rows(queryset, limit, *fields):
+    return list(queryset.order_by('pk').values_list('pk', *fields)[:limit])
+
+
+def _remove_posts(model, ids):
+    """
+    Remove posts from the search index and the timelines, return the
+    number of timeline entries deleted.
+    """
+    backend = search.get_backend()
+    for pk in ids:
+        backend.remove(model(pk=pk))
+    return bulk.delete_rows(FeedEntry.objects.filter(
+        content_type=ContentType.objects.get_for_model(model),
+        object_id__in=ids))
+
+
+def _reviews(reviews):
+    def step(limit):
+        rows = _next_rows(reviews, limit, 'ticket', 'user', 'rating')
+        if not rows:
+            return 0
+        ids = [row[0] for row in rows]
+        deleted = _remove_posts(Review, ids) \
+            + bulk.delete_rows(Review.objects.filter(pk__in=ids))
+        counters.reviews_removed([row[1:] for row in rows])
+        return deleted
+    return step
+
+
+def _tickets(tickets):
+    """ Tickets without reviews left, of a deleted user """
+    def step(limit):
+        rows = _next_rows(tickets, limit, 'image')
+        if not rows:
+            return 0
+        ids = [row[0] for row in rows]
+        deleted = _remove_posts(Ticket, ids) \
+            + bulk.delete_rows(Ticket.objects.filter(pk__in=ids))
+        images.release_on_commit([image for _, image in rows])
+        return deleted
+    return step
+
+
+def _relations(model, user_id, target):
+    """ Follows or blocks of a user, in both directions """
+    relations = model.objects.filter(Q(user=user_id)
+                                     | Q(**{target: user_id}))
+
+    def step(limit):
+        rows = _next_rows(relations, limit, 'user', target)
+        if not rows:
+            return 0
+        deleted = bulk.delete_rows(model.objects.filter(
+            pk__in=[row[0] for row in rows]))
+        pairs = [row[1:] for row in rows]
+        if model is UserFollow:
+            counters.follows_removed(pairs)
+        social_graph.invalidate(*{user for pair in pairs for user in pair})
+        return deleted
+    return step
+
+
+def _timeline(user_id):
+    entries = FeedEntry.objects.filter(owner=user_id)
+
+    def step(limit):
+        ids = [row[0] for row in _next_rows(entries, limit)]
+        if not ids:
+            return 0
+        return bulk.delete_rows(FeedEntry.objects.filter(pk__in=ids))
+    return step
+
+
+def _root(model, pk):
+    """
+    Delete the root through the ORM, once nothing depends on it (its
+    image goes with it, see reviews.signals)
+    """
+    def step(limit):
+        obj = model.objects.filter(pk=pk).first()
+        if obj is None:
+            return 0
+        obj.delete()
+        return 1
+    return step
+
+
+def steps(job):
+    """ Return the steps of a job, functions of the batch size """
+    model = job.content_type.model_class()
+    pk = job.object_id
+    if model is Ticket:
+        return [_reviews(Review.objects.filter(ticket=pk)),
+                _root(Ticket, pk)]
+    return [
+        _relations(UserFollow, pk, 'following_user'),
+        _relations(UserBlocked, pk, 'blocked_user'),
+        _reviews(Review.objects.filter(Q(user=pk) | Q(ticket__user=pk))),
+        _tickets(Ticket.objects.filter(user=pk)),
+        _timeline(pk),
+        _root(model, pk),
+    ]
+
+
+# ================================================================ #
+#                         Jobs                                     #
+# ================================================================ #
+def _readers(tickets, reviews):
+    """ Return the owners of the timelines showing some posts """
+    return set(FeedEntry.objects.filter(
+        Q(content_type=ContentType.objects.get_for_model(Ticket),
+          object_id__in=tickets.values('pk'))
+        | Q(content_type=ContentType.objects.get_for_model(Review),
+            object_id__in=reviews.values('pk'))
+    ).values_list('owner', flat=True).distinct())
+
+
+@transaction.atomic
+def tombstone(obj):
+    """
+    Hide a ticket or a user at once and schedule the deletion of its
+    rows. Return the DeletionJob.
+    """
+    model = type(obj)
+    content_type = ContentType.objects.get_for_model(model)
+    job = DeletionJob.objects.filter(content_type=content_type,
+                                     object_id=obj.pk).first()
+    if job is not None:
+        return job
+    obj.deleted_at = timezone.now()
+    if model is Ticket:
+        readers = feed.readers(obj)
+        Ticket.objects.filter(pk=obj.pk).update(deleted_at=obj.deleted_at)
+    else:
+        readers = versions.related_users(obj.pk) | _readers(
+            Ticket.objects.filter(user=obj.pk),
+            Review.objects.filter(Q(user=obj.pk) | Q(ticket__user=obj.pk)))
+        obj.is_active = False
+        model.objects.filter(pk=obj.pk).update(deleted_at=obj.deleted_at,
+                                               is_active=False)
+        backends.invalidate([obj.pk])
+        transaction.on_commit(lambda: username_index.remove(obj.pk))
+    versions.bump(readers)
+    job = DeletionJob.objects.create(content_type=content_type,
+                                     object_id=obj.pk, label=str(obj)[:255])
+    schedule(job)
+    return job
+
+
+def _claim(job):
+    """ Take the job's lease, False if another worker holds it """
+    now = timezone.now()
+    claimed = DeletionJob.objects.filter(
+        Q(claimed_until__isnull=True) | Q(claimed_until__lt=now),
+        pk=job.pk, finished_at__isnull=True,
+    ).update(claimed_until=now + LEASE)
+    job.refresh_from_db()
+    return bool(claimed)
+
+
+def _batch_size(size, elapsed, max_lock):
+    """ Resize the batches towards max_lock seconds per transaction """
+    if elapsed > max_lock:
+        return max(1, int(size * max_lock / elapsed))
+    if elapsed < max_lock / 2:
+        return min(MAX_BATCH_SIZE, size * 2)
+    return size
+
+
+def run(job, max_lock_ms=None, pause=0):
+    """
+    Run the steps a job has left, each batch in its own transaction of
+    about max_lock_ms (DELETION_MAX_LOCK_MS), sleeping pause seconds
+    between batches. Return False if another worker holds the job.
+    """
+    if not _claim(job):
+        return False
+    max_lock = (max_lock_ms or settings.DELETION_MAX_LOCK_MS) / 1000
+    size = settings.DELETION_BATCH_SIZE
+    remaining = steps(job)
+    try:
+        while job.step < len(remaining):
+            start = time.perf_counter()
+            with transaction.atomic():
+                deleted = remaining[job.step](size)
+                if deleted:
+                    job.deleted += deleted
+                    job.batches += 1
+                else:
+                    job.step += 1
+                job.claimed_until = timezone.now() + LEASE
+                job.save(update_fields=['step', 'deleted', 'batches',
+                                        'claimed_until'])
+            if deleted:
+                size = _batch_size(size, time.perf_counter() - start,
+                                   max_lock)
+                if pause:
+                    time.sleep(pause)
+    except Exception as error:
+        job.error = f"{type(error).__name__}: {error}"
+        job.claimed_until = None
+        job.save(update_fields=['error', 'claimed_until'])
+        raise
+    job.finished_at = timezone.now()
+    job.claimed_until = None
+    job.error = ""
+    job.save(update_fields=['finished_at', 'claimed_until', 'error'])
+    return True
+
+
+def pending():
+    """ Return the jobs not finished yet, oldest first """
+    return DeletionJob.objects.filter(finished_at__isnull=True) \
+        .order_by('pk')
+
+
+def _run(job_id):
+    """ Worker entry point: own database connection, errors are logged """
+    close_old_connections()
+    try:
+        run(DeletionJob.objects.get(pk=job_id))
+    except Exception:
+        logger.exception("Deletion job %s failed", job_id)
+    finally:
+        close_old_connections()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # one worker: jobs run one after the other
+        _executor = ThreadPoolExecutor(max_workers=1,
+                                       thread_name_prefix="deletions")
+    return _executor
+
+
+def schedule(job):
+    """ Run the job in the background once its transaction commits """
+    transaction.on_commit(lambda: _get_executor().submit(_run, job.pk))
@@ -0,0 +1,450 @@
+"""
+Feed engine.
+
+Tickets and reviews are merged and ordered by the database (UNION ALL of
+both tables ordered by ``time_created, kind, id``) and served page by
+page through a keyset cursor, so the cost of a page only depends on its
+size. The post kind is part of the key: ids come from two tables, so
+only the ids of posts of the same kind can break a time_created tie.
+
+The feed read by FeedView is materialized in FeedEntry (fan-out on
+write): `fan_out` / `retract` follow post writes, `add_posts_of` /
+`remove_posts_of` follow social graph changes, touching only the posts
+of the followed or blocking user, see reviews.signals.
+`rebuild_timeline` recomputes a whole timeline (rebuild_feed command).
+"""
+import asyncio
+import base64
+import binascii
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+from itertools import chain, islice
+from operator import itemgetter
+
+from asgiref.sync import sync_to_async
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import CharField, Exists, OuterRef, Q, Value
+
+from . import versions
+from .models import FeedEntry, Review, Ticket, UserBlocked, UserFollow
+
+FEED_PAGE_SIZE = 20
+
+
+@dataclass
+class FeedPage:
+    """ One page of the feed and the cursor of the next one (or None) """
+    posts: list = field(default_factory=list)
+    next_cursor: str = None
+
+
+def encode_cursor(time_created, kind, pk):
+    """
+    Return an opaque, url-safe cursor for the (time_created, kind, pk) key,
+    kind is "" for keys of a single table
+    """
+    raw = f"{time_created.isoformat()}|{kind}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """ Return the (time_created, kind, pk) key of a cursor, None if invalid """
+    if not cursor:
+        return None
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(cursor + padding).decode()
+        time_created, kind, pk = raw.split("|")
+        return datetime.fromisoformat(time_created), kind, int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+def visible_posts(user):
+    """
+    Return the (tickets, reviews) querysets visible in the user's feed:
+    posts of the user and of followed users, reviews answering their
+    tickets, excluding the posts of users who blocked the user.
+    """
+    following_users = UserFollow.objects.filter(user=user) \
+        .values_list('following_user', flat=True)
+    blocked_me = UserBlocked.objects.filter(blocked_user=user) \
+        .values_list('user', flat=True)
+    users_to_include = list(following_users) + [getattr(user, 'pk', user)]
+
+    tickets = Ticket.objects.filter(user__in=users_to_include) \
+        .exclude(user__in=blocked_me)
+    reviews = Review.objects.filter(
+        Q(user__in=users_to_include) | Q(ticket__user__in=users_to_include)
+    ).exclude(user__in=blocked_me)
+    return tickets, reviews
+
+
+def _before(queryset, key, kind=""):
+    """
+    Restrict queryset, whose rows are all of the given kind, to the rows
+    following the cursor key in the (-time_created, kind, -id) order
+    """
+    if key is None:
+        return queryset
+    time_created, key_kind, pk = key
+    older = Q(time_created__lt=time_created)
+    if kind == key_kind:
+        older |= Q(time_created=time_created, pk__lt=pk)
+    elif kind > key_kind:
+        older |= Q(time_created=time_created)
+    return queryset.filter(older)
+
+
+def _keys(queryset, content_type):
+    """ Return the (content_type, id, time_created) rows of a queryset """
+    return queryset.annotate(content_type=Value(content_type, CharField())) \
+        .values_list('content_type', 'id', 'time_created')
+
+
+def _post_querysets(rows):
+    """ Return the querysets loading the posts of (content_type, id) rows """
+    ticket_ids = [row[1] for row in rows if row[0] == "ticket"]
+    review_ids = [row[1] for row in rows if row[0] == "review"]
+    querysets = []
+    if ticket_ids:
+        querysets.append(
+            Ticket.objects.select_related('user')
+            .filter(pk__in=ticket_ids, deleted_at__isnull=True,
+                    user__deleted_at__isnull=True)
+            .annotate(is_reviewed=Exists(
+                Review.objects.filter(ticket=OuterRef('pk')))))
+    if review_ids:
+        querysets.append(
+            Review.objects.select_related('user', 'ticket__user')
+            .filter(pk__in=review_ids, user__deleted_at__isnull=True,
+                    ticket__deleted_at__isnull=True,
+                    ticket__user__deleted_at__isnull=True))
+    return querysets
+
+
+def _ordered(rows, posts):
+    """ Return the loaded posts in the order of the rows """
+    loaded = {}
+    for post in posts:
+        post.content_type = type(post).__name__.lower()
+        loaded[post.content_type, post.pk] = post
+    return [loaded[row[0], row[1]] for row in rows
+            if (row[0], row[1]) in loaded]
+
+
+def hydrate(rows):
+    """
+    Load the posts referenced by (content_type, id, ...) rows, with one
+    query per post type, and return them in the order of the rows.
+    Authors, reviewed tickets and their authors are loaded in the same
+    queries, so rendering a page never goes back to the database; tickets
+    carry an `is_reviewed` flag (EXISTS subquery on the review index).
+    Tombstoned posts and users (reviews.deletion) are skipped, on the
+    rows these queries already join.
+    """
+    return _ordered(rows, chain.from_iterable(_post_querysets(rows)))
+
+
+def _split(rows, page_size):
+    """
+    Cut (content_type, id, time_created, key_kind, key_id) rows, fetched
+    with one row more than page_size, to a page and return
+    (rows, next_cursor).
+    """
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    _, _, time_created, key_kind, key_id = rows[-1]
+    return rows, encode_cursor(time_created, key_kind, key_id)
+
+
+def _page(rows, page_size):
+    """ Build the FeedPage of rows fetched with one row more than needed """
+    rows, next_cursor = _split(rows, page_size)
+    return FeedPage(posts=hydrate(rows), next_cursor=next_cursor)
+
+
+def paginate(tickets, reviews, cursor=None, page_size=FEED_PAGE_SIZE):
+    """
+    Return the FeedPage following the cursor. Both querysets are merged
+    by a UNION ALL ordered by (time_created, kind, id) in the database;
+    only page_size + 1 keys are fetched to know whether a next page
+    exists.
+    """
+    key = decode_cursor(cursor)
+    rows = (
+        _keys(_before(tickets, key, "ticket"), "ticket")
+        .union(_keys(_before(reviews, key, "review"), "review"), all=True)
+        .order_by('-time_created', 'content_type', '-id')[:page_size + 1]
+    )
+    return _page([row + row[:2] for row in rows], page_size)
+
+
+# ================================================================ #
+#                   Materialized timeline                          #
+# ================================================================ #
+def _content_types():
+    """ Return the {content_type_id: name} mapping of post types """
+    return {
+        ContentType.objects.get_for_model(Ticket).pk: "ticket",
+        ContentType.objects.get_for_model(Review).pk: "review",
+    }
+
+
+def _timeline_entries(user, cursor, page_size):
+    """ Return the FeedEntry keys of a timeline page, plus one """
+    return (
+        _before(FeedEntry.objects.filter(owner=user), decode_cursor(cursor))
+        .order_by('-time_created', '-id')
+        .values_list('content_type_id', 'object_id', 'time_created', 'id')
+        [:page_size + 1]
+    )
+
+
+def _timeline_rows(entries, names):
+    return [(names[content_type_id], object_id, time_created, "", pk)
+            for content_type_id, object_id, time_created, pk in entries]
+
+
+def timeline(user, cursor=None, page_size=FEED_PAGE_SIZE):
+    """
+    Return the FeedPage of the user's materialized timeline: one range
+    scan of the (owner, time_created, id) index of FeedEntry.
+    """
+    entries = _timeline_entries(user, cursor, page_size)
+    return _page(_timeline_rows(entries, _content_types()), page_size)
+
+
+def audience(post):
+    """
+    Return the ids of the users whose feed shows the post: its author,
+    the ticket author for a review, and their followers, minus the users
+    the author has blocked (the rules of `visible_posts`).
+    """
+    authors = {post.user_id}
+    if isinstance(post, Review):
+        authors.add(post.ticket.user_id)
+    followers = UserFollow.objects.filter(following_user__in=authors) \
+        .values_list('user', flat=True)
+    blocked = UserBlocked.objects.filter(user=post.user_id) \
+        .values_list('blocked_user', flat=True)
+    return (authors | set(followers)) - set(blocked)
+
+
+def fan_out(post):
+    """ Add a new post to the timeline of each user of its audience """
+    content_type = ContentType.objects.get_for_model(post)
+    FeedEntry.objects.bulk_create(
+        [FeedEntry(owner_id=owner, content_type=content_type,
+                   object_id=post.pk, time_created=post.time_created)
+         for owner in audience(post)],
+        ignore_conflicts=True,
+    )
+
+
+def insert_entries(rows, batch_size=500):
+    """
+    Insert (owner_id, content_type_id, object_id, time_created) timeline
+    rows, skipping those already there, with plain parameterized INSERTs:
+    building a FeedEntry per row costs more than the insert itself when
+    whole populations are fanned out.
+    """
+    table = FeedEntry._meta.db_table
+    quote = connection.ops.quote_name
+    sql = (f"INSERT INTO {quote(table)} ({quote('owner_id')}, "
+           f"{quote('content_type_id')}, {quote('object_id')}, "
+           f"{quote('time_created')}) VALUES (%s, %s, %s, %s) "
+           f"ON CONFLICT DO NOTHING")
+    adapt = connection.ops.adapt_datetimefield_value
+    rows = iter(rows)
+    with connection.cursor() as cursor:
+        while batch := [(owner, content_type, object_id, adapt(time_created))
+                        for owner, content_type, object_id, time_created
+                        in islice(rows, batch_size)]:
+            cursor.executemany(sql, batch)
+
+
+@transaction.atomic
+def fan_out_posts(posts, batch_size=1000):
+    """
+    `fan_out` for many saved posts (bulk inserts): the followers and
+    blocks of their authors are loaded once per batch of posts.
+    """
+    for start in range(0, len(posts), batch_size):
+        _fan_out_batch(posts[start:start + batch_size])
+
+
+def _fan_out_batch(posts):
+    ticket_authors = dict(Ticket.objects.filter(pk__in={
+        post.ticket_id for post in posts if isinstance(post, Review)})
+        .values_list('pk', 'user'))
+    authors = {post.user_id for post in posts} | set(ticket_authors.values())
+    followers = defaultdict(set)
+    for followed, follower in UserFollow.objects.filter(
+            following_user__in=authors) \
+            .values_list('following_user', 'user'):
+        followers[followed].add(follower)
+    blocked = defaultdict(set)
+    for user, blocked_user in UserBlocked.objects.filter(
+            user__in=authors).values_list('user', 'blocked_user'):
+        blocked[user].add(blocked_user)
+
+    def entries():
+        for post in posts:
+            post_authors = {post.user_id}
+            if isinstance(post, Review):
+                post_authors.add(ticket_authors[post.ticket_id])
+            audience = set(post_authors)
+            for author in post_authors:
+                audience |= followers[author]
+            content_type = ContentType.objects.get_for_model(post).pk
+            for owner in audience - blocked[post.user_id]:
+                yield owner, content_type, post.pk, post.time_created
+
+    insert_entries(entries())
+
+
+def retract(post):
+    """ Remove a post from every timeline """
+    FeedEntry.objects.filter(
+        content_type=ContentType.objects.get_for_model(post),
+        object_id=post.pk,
+    ).delete()
+
+
+def readers(post):
+    """
+    Return the ids of the users whose timeline shows the post, its ticket
+    or one of the reviews of its ticket: the cards that depend on it.
+    """
+    ticket_id = post.ticket_id if isinstance(post, Review) else post.pk
+    reviews = Review.objects.filter(ticket=ticket_id).values('pk')
+    return set(FeedEntry.objects.filter(
+        Q(content_type=ContentType.objects.get_for_model(Ticket),
+          object_id=ticket_id)
+        | Q(content_type=ContentType.objects.get_for_model(Review),
+            object_id__in=reviews)
+    ).values_list('owner', flat=True))
+
+
+def _rows(owner, tickets, reviews, skip=frozenset()):
+    """
+    Yield the (owner_id, content_type_id, object_id, time_created)
+    timeline rows of the owner for the posts, but the (model, pk) of skip
+    """
+    owner_id = getattr(owner, 'pk', owner)
+    for model, queryset in ((Ticket, tickets), (Review, reviews)):
+        content_type = ContentType.objects.get_for_model(model).pk
+        for pk, time_created in queryset.values_list('pk', 'time_created'):
+            if (model, pk) not in skip:
+                yield owner_id, content_type, pk, time_created
+
+
+def expected_entries(owner):
+    """ Return the unsaved FeedEntry objects the owner's timeline needs """
+    return [FeedEntry(owner_id=owner_id, content_type_id=content_type,
+                      object_id=pk, time_created=time_created)
+            for owner_id, content_type, pk, time_created
+            in _rows(owner, *visible_posts(owner))]
+
+
+def _related(tickets, reviews, authors):
+    """
+    Restrict post querysets to the posts of some users and the reviews
+    of their tickets: what following or blocking them can change.
+    """
+    return (tickets.filter(user__in=authors),
+            reviews.filter(Q(user__in=authors) | Q(ticket__user__in=authors)))
+
+
+@transaction.atomic
+def add_posts_of(owner, authors, skip=frozenset()):
+    """
+    Add to the owner's timeline the posts of authors (and the reviews of
+    their tickets) it now shows: after a follow or an unblock. skip holds
+    the (model, pk) of posts fanned out separately (bulk.refresh).
+    """
+    insert_entries(_rows(owner, *_related(*visible_posts(owner), authors),
+                         skip))
+    versions.bump([getattr(owner, 'pk', owner)])
+
+
+@transaction.atomic
+def remove_posts_of(owner, authors):
+    """
+    Remove from the owner's timeline the posts of authors (and the
+    reviews of their tickets) it no longer shows: after an unfollow or a
+    block. Posts still visible another way (a review by a followed user)
+    stay.
+    """
+    related = _related(Ticket.objects.all(), Review.objects.all(), authors)
+    visible = _related(*visible_posts(owner), authors)
+    for model, queryset, kept in zip((Ticket, Review), related, visible):
+        FeedEntry.objects.filter(
+            owner=owner, content_type=ContentType.objects.get_for_model(model),
+            object_id__in=queryset.values('pk'),
+        ).exclude(object_id__in=kept.values('pk')).delete()
+    versions.bump([getattr(owner, 'pk', owner)])
+
+
+@transaction.atomic
+def rebuild_timeline(owner):
+    """ Recompute the owner's timeline from the posts and social graph """
+    FeedEntry.objects.filter(owner=owner).delete()
+    FeedEntry.objects.bulk_create(expected_entries(owner), batch_size=500)
+    versions.bump([owner.pk])
+
+
+def timeline_drift(owner):
+    """
+    Compare the owner's timeline with the expected one and return the
+    (missing, extra) sets of (content_type_id, object_id) keys.
+    """
+    expected = {(entry.content_type_id, entry.object_id)
+                for entry in expected_entries(owner)}
+    actual = set(FeedEntry.objects.filter(owner=owner)
+                 .values_list('content_type_id', 'object_id'))
+    return expected - actual, actual - expected
+
+
+# ================================================================ #
+#                         Async API                                #
+# ================================================================ #
+async def _alist(queryset):
+    return [obj async for obj in queryset]
+
+
+async def ahydrate(rows):
+    """ Async `hydrate`: the ticket and review queries run concurrently """
+    loaded = await asyncio.gather(*map(_alist, _post_querysets(rows)))
+    return _ordered(rows, chain.from_iterable(loaded))
+
+
+async def atimeline(user, cursor=None, page_size=FEED_PAGE_SIZE):
+    """ Async `timeline` """
+    names = await sync_to_async(_content_types)()
+    entries = await _alist(_timeline_entries(user, cursor, page_size))
+    rows, next_cursor = _split(_timeline_rows(entries, names), page_size)
+    return FeedPage(posts=await ahydrate(rows), next_cursor=next_cursor)
+
+
+async def apaginate(tickets, reviews, cursor=None, page_size=FEED_PAGE_SIZE):
+    """
+    Async `paginate`: instead of a UNION, the page_size + 1 newest keys of
+    each queryset are fetched concurrently and merged here.
+    """
+    key = decode_cursor(cursor)
+    ticket_rows, review_rows = await asyncio.gather(*(
+        _alist(_keys(_before(queryset, key, kind), kind)
+               .order_by('-time_created', '-id')[:page_size + 1])
+        for queryset, kind in ((tickets, "ticket"), (reviews, "review"))))
+    # each list is in (-time_created, -id) order: a stable sort on the
+    # kind, then on time_created, gives the (-time_created, kind, -id) one
+    rows = sorted(ticket_rows + review_rows, key=itemgetter(0))
+    rows = sorted(rows, key=itemgetter(2), reverse=True)[:page_size + 1]
+    rows, next_cursor = _split([row + row[:2] for row in rows], page_size)
+    return FeedPage(posts=await ahydrate(rows), next_cursor=next_cursor)
@@ -1,5 +1,6 @@
 from django import forms
 from .models import Review, Ticket
+from .uploads import UploadImageField
 
 
 class TicketForm(forms.ModelForm):
@@ -8,6 +9,7 @@ class TicketForm(forms.ModelForm):
     class Meta:
         model = Ticket
         fields = ['title', 'description', 'image']
+        field_classes = {'image': UploadImageField}
         widgets = {
             'title': forms.TextInput(attrs={
                 'placeholder': 'Title'
@@ -70,7 +72,7 @@ class ReviewWithTicketForm(ReviewForm):
         }),
         label='Description'
     )
-    ticket_image = forms.ImageField(
+    ticket_image = UploadImageField(
         required=False,
         label='Image'
     )
@@ -0,0 +1,114 @@
+"""
+Cached social graph.
+
+SocialGraph keeps, for each user, the id sets of the users they follow,
+their followers, the users they block and the users blocking them, in one
+cache entry per user. Every follow / block created or deleted through the
+ORM (views, admin...) invalidates both users from the signals of
+reviews.signals, the bulk writes without signals (reviews.bulk,
+reviews.deletion) explicitly, once the transaction commits; a warm cache
+answers graph reads with zero queries.
+"""
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import UserBlocked, UserFollow
+
+RELATIONS = ('following', 'followers', 'blocking', 'blocked_by')
+
+
+class SocialGraph:
+    """ Per-user follow / block id sets, read through the cache """
+    key_prefix = 'social-graph'
+    timeout = 60 * 60
+
+    def __init__(self, backend=cache):
+        self.cache = backend
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, user_id):
+        return f"{self.key_prefix}:{user_id}"
+
+    def _load(self, user_ids):
+        """ Return {user_id: {relation: frozenset}} read from the database """
+        sets = {user_id: defaultdict(set) for user_id in user_ids}
+        queries = (
+            (UserFollow, 'user', 'following_user', 'following', 'followers'),
+            (UserBlocked, 'user', 'blocked_user', 'blocking', 'blocked_by'),
+        )
+        for model, source, target, forward, reverse in queries:
+            edges = model.objects.values_list(source, target)
+            for left, right in edges.filter(**{f"{source}__in": user_ids}):
+                sets[left][forward].add(right)
+            for left, right in edges.filter(**{f"{target}__in": user_ids}):
+                sets[right][reverse].add(left)
+        return {
+            user_id: {relation: frozenset(relations[relation])
+                      for relation in RELATIONS}
+            for user_id, relations in sets.items()
+        }
+
+    def warm(self, user_ids):
+        """
+        Load the graph of many users with one cache round trip, and the
+        misses with four queries in total. Return {user_id: sets}.
+        """
+        user_ids = set(user_ids)
+        keys = {self._key(user_id): user_id for user_id in user_ids}
+        found = {keys[key]: value
+                 for key, value in self.cache.get_many(keys).items()}
+        self.hits += len(found)
+        missing = user_ids - found.keys()
+        if missing:
+            self.misses += len(missing)
+            loaded = self._load(missing)
+            self.cache.set_many({self._key(user_id): sets
+                                 for user_id, sets in loaded.items()},
+                                self.timeout)
+            found.update(loaded)
+        return found
+
+    def sets(self, user):
+        """ Return the {relation: frozenset of ids} of a user (or id) """
+        user_id = getattr(user, 'pk', user)
+        value = self.cache.get(self._key(user_id))
+        if value is not None:
+            self.hits += 1
+            return value
+        return self.warm([user_id])[user_id]
+
+    def following(self, user):
+        return self.sets(user)['following']
+
+    def followers(self, user):
+        return self.sets(user)['followers']
+
+    def blocking(self, user):
+        return self.sets(user)['blocking']
+
+    def blocked_by(self, user):
+        return self.sets(user)['blocked_by']
+
+    def invalidate(self, *users):
+        """
+        Drop the cached graph of users (instances or ids) once the
+        transaction commits
+        """
+        keys = [self._key(getattr(user, 'pk', user)) for user in users]
+        if keys:
+            transaction.on_commit(lambda: self.cache.delete_many(keys))
+
+    def stats(self):
+        """ Return the hit / miss counters of this process """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
+
+social_graph = SocialGraph()
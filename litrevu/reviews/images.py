@@ -0,0 +1,193 @@
+"""
+Image rendition pipeline.
+
+Uploaded ticket covers and avatars are resized and re-encoded (WebP and
+JPEG) at a few fixed widths by a thread pool, after the upload's
+transaction commits, so the request never waits for Pillow. Renditions
+are recorded in ImageRendition with their dimensions and attached to the
+posts of a page by `attach_renditions` (one query). A file replaced,
+cleared or deleted with its row is released (`release_on_commit`, see
+reviews.signals), the renditions go with its last reference.
+"""
+import logging
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+from .models import ImageRendition, Review
+
+logger = logging.getLogger(__name__)
+
+RENDITION_WIDTHS = (160, 320, 640)
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+MAX_WORKERS = 2
+
+_executor = None
+
+
+def rendition_formats():
+    """ Return the formats produced, WebP only if Pillow supports it """
+    if features.check("webp"):
+        return ("webp", "jpeg")
+    return ("jpeg",)
+
+
+def _encode(image, image_format):
+    """ Return the bytes of the image encoded in image_format """
+    buffer = BytesIO()
+    if image_format == "webp":
+        image.save(buffer, "WEBP", quality=WEBP_QUALITY, method=4)
+    else:
+        image.save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True,
+                   progressive=True)
+    return buffer.getvalue()
+
+
+def process_image(source, force=False):
+    """
+    Build the renditions of the stored image `source` (a storage name)
+    and return them. Widths larger than the original are not produced,
+    except the smallest one so that every image gets a rendition.
+    """
+    existing = ImageRendition.objects.filter(source=source)
+    if existing.exists() and not force:
+        return list(existing)
+    delete_renditions(source)
+
+    try:
+        with default_storage.open(source) as file:
+            original = ImageOps.exif_transpose(Image.open(file))
+            original.load()
+    except (OSError, UnidentifiedImageError):
+        logger.warning("Cannot read image %s, no rendition built", source)
+        return []
+    if original.mode != "RGB":
+        original = original.convert("RGB")
+
+    stem = os.path.splitext(os.path.basename(source))[0]
+    widths = [width for width in RENDITION_WIDTHS
+              if width <= original.width] or [original.width]
+    renditions = []
+    for width in widths:
+        height = max(1, round(original.height * width / original.width))
+        resized = original.resize((width, height), Image.Resampling.LANCZOS)
+        for image_format in rendition_formats():
+            rendition = ImageRendition(source=source, width=width,
+                                       height=height, format=image_format)
+            extension = "jpg" if image_format == "jpeg" else image_format
+            rendition.file.save(f"{stem}-{width}.{extension}",
+                                ContentFile(_encode(resized, image_format)),
+                                save=False)
+            renditions.append(rendition)
+    return ImageRendition.objects.bulk_create(renditions)
+
+
+def delete_renditions(source):
+    """ Delete the renditions of an image, files included """
+    for rendition in ImageRendition.objects.filter(source=source):
+        rendition.file.delete(save=False)
+        rendition.delete()
+
+
+def release(names):
+    """
+    Release stored image files (reviews.uploads), their renditions go
+    with the last reference
+    """
+    for name in names:
+        default_storage.delete(name)
+        if not default_storage.exists(name):
+            delete_renditions(name)
+
+
+def release_on_commit(names):
+    """ Release the files once the transaction commits """
+    names = [name for name in names if name]
+    if names:
+        transaction.on_commit(lambda: release(names))
+
+
+def _run(source):
+    """ Worker entry point: own database connection, errors are logged """
+    close_old_connections()
+    try:
+        process_image(source)
+    except Exception:
+        logger.exception("Rendition of %s failed", source)
+    finally:
+        close_old_connections()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                                       thread_name_prefix="renditions")
+    return _executor
+
+
+def schedule(source):
+    """ Build the renditions of source in the pool once the upload commits """
+    if source:
+        transaction.on_commit(lambda: _get_executor().submit(_run, source))
+
+
+class RenditionSet:
+    """ Renditions of one image, as used by reviews/picture.html """
+
+    def __init__(self, renditions):
+        self.renditions = sorted(renditions, key=lambda r: r.width)
+
+    def __bool__(self):
+        return bool(self.renditions)
+
+    def _srcset(self, image_format):
+        return ", ".join(f"{r.file.url} {r.width}w" for r in self.renditions
+                         if r.format == image_format)
+
+    @property
+    def webp_srcset(self):
+        return self._srcset("webp")
+
+    @property
+    def jpeg_srcset(self):
+        return self._srcset("jpeg")
+
+    @property
+    def default(self):
+        """ The JPEG rendition used as src: the widest one """
+        jpegs = [r for r in self.renditions if r.format == "jpeg"]
+        return jpegs[-1] if jpegs else None
+
+    @property
+    def version(self):
+        """ Changes when renditions are added, for cache keys """
+        return len(self.renditions)
+
+
+def attach_renditions(posts):
+    """
+    Set `cover` on tickets (and on the ticket of reviews) and `avatar` on
+    authors, as RenditionSet, loading every rendition of the page at once.
+    """
+    images = []
+    for post in posts:
+        images.append((post.user, "avatar", post.user.profile_picture))
+        ticket = post.ticket if isinstance(post, Review) else post
+        images.append((ticket, "cover", ticket.image))
+    names = {field.name for _, _, field in images if field}
+    found = defaultdict(list)
+    if names:
+        for rendition in ImageRendition.objects.filter(source__in=names):
+            found[rendition.source].append(rendition)
+    for obj, attribute, field in images:
+        setattr(obj, attribute,
+                RenditionSet(found.get(field.name, []) if field else []))
+    return posts
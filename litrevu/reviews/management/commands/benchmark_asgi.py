@@ -0,0 +1,112 @@
+import asyncio
+import importlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.test import AsyncClient, Client, override_settings
+from django.urls import clear_url_caches, reverse
+
+User = get_user_model()
+
+
+def _reload_urlconf():
+    importlib.reload(importlib.import_module('reviews.urls'))
+    importlib.reload(importlib.import_module(settings.ROOT_URLCONF))
+    clear_url_caches()
+
+
+@contextmanager
+def routing(enabled=True):
+    """
+    Route the reviews urls to the async views (or back to the sync ones)
+    inside the block, for this benchmark and the tests.
+    """
+    try:
+        with override_settings(REVIEWS_ASYNC_VIEWS=enabled):
+            _reload_urlconf()
+            yield
+    finally:
+        _reload_urlconf()
+
+
+class Command(BaseCommand):
+    """ Compare the WSGI (sync views) and ASGI (async views) throughput """
+    help = ("Send the same GET requests (feed, posts, username search) "
+            "through the WSGI handler with the sync views, then the ASGI "
+            "handler with the async views, and report requests per second. "
+            "Logs the user in, i.e. writes sessions: use a development "
+            "database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", required=True,
+                            help="Username whose pages are requested.")
+        parser.add_argument("--requests", type=int, default=200,
+                            help="Requests per run (default 200).")
+        parser.add_argument("--concurrency", type=int, default=10,
+                            help="Requests in flight (default 10).")
+
+    def paths(self):
+        return [reverse("reviews:feed"), reverse("reviews:posts"),
+                reverse("reviews:search_user") + "?q=a"]
+
+    def run_wsgi(self, user, count, concurrency):
+        """ count requests from concurrency threads, one Client each """
+        paths = self.paths()
+
+        def worker(share):
+            client = Client()
+            client.force_login(user)
+            try:
+                for index in range(share):
+                    response = client.get(paths[index % len(paths)])
+                    assert response.status_code == 200, response.status_code
+            finally:
+                close_old_connections()
+
+        shares = [count // concurrency + (index < count % concurrency)
+                  for index in range(concurrency)]
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            start = time.perf_counter()
+            list(pool.map(worker, shares))
+            return time.perf_counter() - start
+
+    async def run_asgi(self, user, count, concurrency):
+        """ count requests, concurrency at a time, on one event loop """
+        paths = self.paths()
+        client = AsyncClient()
+        await client.aforce_login(user)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def request(index):
+            async with semaphore:
+                response = await client.get(paths[index % len(paths)])
+                assert response.status_code == 200, response.status_code
+
+        start = time.perf_counter()
+        await asyncio.gather(*(request(index) for index in range(count)))
+        return time.perf_counter() - start
+
+    def report(self, name, count, elapsed):
+        self.stdout.write(f"{name}: {count} requests in {elapsed:.2f}s, "
+                          f"{count / elapsed:.1f} req/s")
+
+    def handle(self, *args, user, requests, concurrency, **options):
+        try:
+            user = User.objects.get(username=user)
+        except User.DoesNotExist:
+            raise CommandError(f"Unknown user {user!r}.")
+
+        # the benchmark measures the views, not the rate limits
+        with override_settings(RATE_LIMITS={}):
+            with routing(enabled=False):
+                self.report("WSGI, sync views", requests,
+                            self.run_wsgi(user, requests, concurrency))
+            with routing(enabled=True):
+                self.report("ASGI, async views", requests,
+                            asyncio.run(self.run_asgi(user, requests,
+                                                      concurrency)))
@@ -0,0 +1,115 @@
+import json
+import random
+import time
+from pathlib import Path
+
+from django.core.management.base import CommandError
+from django.urls import reverse
+
+from litrevu import compression
+from litrevu.routers import replicas
+from reviews import synthetic
+
+from .benchmark_suite import PREFIX, Command as SuiteCommand
+from .generate_population import add_population_arguments, \
+    population_options
+
+# levels measured per encoding: fastest, default (settings), densest
+LEVELS = {'gzip': (1, 6, 9), 'br': (1, 4, 11), 'zstd': (1, 3, 19)}
+
+
+def pages():
+    """ Return the (name, path) of the measured pages """
+    return [
+        ("feed", reverse("reviews:feed")),
+        ("posts", reverse("reviews:posts")),
+        ("feed_api", reverse("reviews:feed_api") + "?limit=50"),
+        ("search_user", f"{reverse('reviews:search_user')}?q={PREFIX}00"),
+    ]
+
+
+class Command(SuiteCommand):
+    """ Measure the compression of the dynamic pages """
+    help = ("Generate a synthetic population in a scratch test database, "
+            "fetch the feed, posts, JSON feed and username search pages "
+            "of sampled users uncompressed, then compress their bodies "
+            "the way CompressionMiddleware does (streamed bodies chunk by "
+            "chunk) with each installed encoding and several levels, and "
+            "report bytes saved against CPU time.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000,
+                            help="Population size (default 1000).")
+        parser.add_argument("--sampled-users", type=int, default=5)
+        parser.add_argument("--repeat", type=int, default=20,
+                            help="Compressions timed per body "
+                                 "(default 20).")
+        parser.add_argument("--output",
+                            help="Also write the results to this JSON "
+                                 "file.")
+        add_population_arguments(parser)
+
+    def bodies(self, clients):
+        """ Return {page: [chunks of each sampled user's body]} """
+        bodies = {}
+        for name, path in pages():
+            bodies[name] = []
+            for client in clients:
+                response = client.get(path)
+                if response.status_code != 200:
+                    raise CommandError(f"GET {path}: "
+                                       f"{response.status_code}")
+                bodies[name].append(list(response.streaming_content)
+                                    if response.streaming
+                                    else [response.content])
+        return bodies
+
+    def measure(self, encoding, level, bodies, repeat):
+        """ Return the sizes and time of compressing every body """
+        encoder_class = compression.encoders()[encoding]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            raw = compressed = 0
+            for chunks in bodies:
+                raw += sum(len(data) for data in chunks)
+                compressed += sum(
+                    len(data) for data in compression.encode_stream(
+                        encoder_class(level), chunks))
+        elapsed = (time.perf_counter() - start) / repeat
+        return {
+            "raw_bytes": raw // len(bodies),
+            "compressed_bytes": compressed // len(bodies),
+            "ratio": round(compressed / raw, 3) if raw else 1.0,
+            "ms_per_page": round(elapsed / len(bodies) * 1000, 3),
+            "mb_per_s": round(raw / elapsed / 1e6, 1) if elapsed else 0.0,
+        }
+
+    def handle(self, *args, users, sampled_users, repeat, output,
+               **options):
+        if replicas():
+            raise CommandError("Run the benchmark without read replicas.")
+        results = {}
+        with self.scratch_database():
+            synthetic.generate(users, prefix=PREFIX,
+                               **population_options(options))
+            clients = self.sampled_clients(users,
+                                           random.Random(options["seed"]),
+                                           sampled_users)
+            for page, bodies in self.bodies(clients).items():
+                results[page] = {}
+                for encoding in compression.encoders():
+                    for level in LEVELS[encoding]:
+                        measures = self.measure(encoding, level, bodies,
+                                                repeat)
+                        results[page][f"{encoding}-{level}"] = measures
+                        self.stdout.write(
+                            f"{page}, {encoding} {level}: "
+                            f"{measures['raw_bytes']} -> "
+                            f"{measures['compressed_bytes']} bytes "
+                            f"({measures['ratio'] * 100:.1f}%), "
+                            f"{measures['ms_per_page']} ms/page, "
+                            f"{measures['mb_per_s']} MB/s")
+        if output:
+            Path(output).write_text(json.dumps(results, indent=2))
+            self.stdout.write(self.style.SUCCESS(
+                f"Results written to {output}."))
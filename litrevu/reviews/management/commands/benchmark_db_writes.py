@@ -0,0 +1,136 @@
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from statistics import quantiles
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, \
+    transaction
+
+from litrevu.db import sqlite_database
+
+TABLE = "litrevu_write_benchmark"
+
+
+class Command(BaseCommand):
+    """ Measure the write throughput of a database under concurrency """
+    help = ("Run concurrent write transactions (and readers) on a scratch "
+            "table and report committed transactions per second, latency "
+            "and lock errors. --compare-sqlite runs the same load on two "
+            "temporary SQLite files, default and tuned (litrevu.db).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS,
+                            help="Database alias to measure.")
+        parser.add_argument("--compare-sqlite", action="store_true",
+                            help="Compare the SQLite profiles instead.")
+        parser.add_argument("--writers", type=int, default=8)
+        parser.add_argument("--readers", type=int, default=4)
+        parser.add_argument("--transactions", type=int, default=200,
+                            help="Transactions per writer (default 200).")
+        parser.add_argument("--rows", type=int, default=5,
+                            help="Rows inserted per transaction (default 5).")
+
+    def handle(self, *args, database, compare_sqlite, **options):
+        load = {name: options[name]
+                for name in ("writers", "readers", "transactions", "rows")}
+        if not compare_sqlite:
+            self.report(database, self.measure(database, **load))
+            return
+        with tempfile.TemporaryDirectory() as directory:
+            for name, tuned in (("sqlite-default", False),
+                                ("sqlite-tuned", True)):
+                settings = sqlite_database(
+                    Path(directory) / f"{name}.sqlite3", tuned=tuned)
+                connections.settings[name] = connections.configure_settings(
+                    {DEFAULT_DB_ALIAS: settings})[DEFAULT_DB_ALIAS]
+                try:
+                    self.report(name, self.measure(name, **load))
+                finally:
+                    connections[name].close()
+                    del connections.settings[name]
+
+    def measure(self, alias, writers, readers, transactions, rows):
+        """ Run the load on alias and return its statistics """
+        with connections[alias].cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+            cursor.execute(f"CREATE TABLE {TABLE} (id INTEGER PRIMARY KEY, "
+                           f"worker INTEGER NOT NULL, "
+                           f"payload VARCHAR(200) NOT NULL)")
+        writing = threading.Event()
+        writing.set()
+
+        def write(worker):
+            latencies, failures = [], 0
+            try:
+                for number in range(transactions):
+                    start = time.perf_counter()
+                    try:
+                        with transaction.atomic(using=alias):
+                            with connections[alias].cursor() as cursor:
+                                for row in range(rows):
+                                    key = (worker * transactions + number) \
+                                        * rows + row
+                                    cursor.execute(
+                                        f"INSERT INTO {TABLE} "
+                                        f"VALUES (%s, %s, %s)",
+                                        [key, worker, "x" * 200])
+                    except OperationalError:
+                        failures += 1
+                    else:
+                        latencies.append(time.perf_counter() - start)
+            finally:
+                connections[alias].close()
+            return latencies, failures
+
+        def read():
+            reads = failures = 0
+            try:
+                while writing.is_set():
+                    try:
+                        with connections[alias].cursor() as cursor:
+                            cursor.execute(f"SELECT COUNT(*) FROM {TABLE}")
+                            cursor.fetchone()
+                        reads += 1
+                    except OperationalError:
+                        failures += 1
+            finally:
+                connections[alias].close()
+            return reads, failures
+
+        with ThreadPoolExecutor(max_workers=writers + readers) as pool:
+            reading = [pool.submit(read) for _ in range(readers)]
+            start = time.perf_counter()
+            results = list(pool.map(write, range(writers)))
+            elapsed = time.perf_counter() - start
+            writing.clear()
+            read_results = [future.result() for future in reading]
+
+        with connections[alias].cursor() as cursor:
+            cursor.execute(f"DROP TABLE {TABLE}")
+        latencies = sorted(latency for result in results
+                           for latency in result[0])
+        return {
+            "elapsed": elapsed,
+            "committed": len(latencies),
+            "failed": sum(result[1] for result in results),
+            "latencies": latencies,
+            "reads": sum(result[0] for result in read_results),
+            "read_failures": sum(result[1] for result in read_results),
+        }
+
+    def report(self, name, stats):
+        latencies = stats["latencies"]
+        if len(latencies) >= 2:
+            cuts = quantiles(latencies, n=100)
+            p50, p99 = cuts[49] * 1000, cuts[98] * 1000
+        else:
+            p50 = p99 = 0
+        self.stdout.write(
+            f"{name}: {stats['committed'] / stats['elapsed']:.0f} tx/s "
+            f"({stats['committed']} committed, {stats['failed']} failed), "
+            f"p50 {p50:.1f}ms, p99 {p99:.1f}ms, "
+            f"{stats['reads'] / stats['elapsed']:.0f} reads/s "
+            f"({stats['read_failures']} failed)")
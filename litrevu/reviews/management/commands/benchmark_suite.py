@@ -0,0 +1,206 @@
+import json
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from statistics import mean, quantiles
+
+import django
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from litrevu.routers import replicas
+from reviews import synthetic
+
+from .generate_population import add_population_arguments, \
+    population_options
+
+User = get_user_model()
+
+PREFIX = "bench"
+# measures compared with --baseline, lower is better
+COMPARED = ("p95_ms", "queries")
+
+
+def endpoints(rng):
+    """ Return the (name, path) of the measured GET endpoints """
+    word = rng.choice(synthetic.WORDS)
+    return [
+        ("feed", reverse("reviews:feed")),
+        ("posts", reverse("reviews:posts")),
+        ("search", f"{reverse('reviews:search')}?q={word}"),
+        ("search_user", f"{reverse('reviews:search_user')}?q={PREFIX}00"),
+        ("follow", reverse("reviews:follow")),
+    ]
+
+
+def percentile(cuts, rank):
+    return round(cuts[rank - 1] * 1000, 2) if cuts else 0.0
+
+
+class Command(BaseCommand):
+    """ Benchmark the main pages on synthetic populations of several sizes """
+    help = ("For each scale, generate a synthetic population in a scratch "
+            "test database, then request the feed, posts, search, username "
+            "search and follow pages as sampled users and record latency "
+            "percentiles, queries per request and peak Python memory in a "
+            "JSON file. --baseline compares with a previous result file.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scales", default="100,1000",
+                            help="Comma separated user counts "
+                                 "(default 100,1000).")
+        parser.add_argument("--requests", type=int, default=50,
+                            help="Timed requests per endpoint (default 50).")
+        parser.add_argument("--profiled", type=int, default=10,
+                            help="Requests per endpoint counting queries "
+                                 "and memory (default 10).")
+        parser.add_argument("--sampled-users", type=int, default=10)
+        parser.add_argument("--output", default="benchmark-results.json")
+        parser.add_argument("--baseline",
+                            help="Previous result file to compare with.")
+        parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="Allowed relative regression against the "
+                                 "baseline (default 0.2).")
+        add_population_arguments(parser)
+
+    @contextmanager
+    def scratch_database(self):
+        """ Run the block on a new test database and media directory """
+        creation = connection.creation
+        name = connection.settings_dict["NAME"]
+        with tempfile.TemporaryDirectory() as directory:
+            if connection.vendor == "sqlite":
+                # a file rather than memory, like the real database
+                connection.settings_dict["TEST"]["NAME"] = str(
+                    Path(directory) / "benchmark.sqlite3")
+            creation.create_test_db(verbosity=0, autoclobber=True,
+                                    serialize=False)
+            try:
+                # the suite measures the views, not the rate limits
+                with override_settings(MEDIA_ROOT=directory, RATE_LIMITS={}):
+                    yield
+            finally:
+                creation.destroy_test_db(name, verbosity=0)
+                cache.clear()
+
+    def measure(self, clients, path, count, profiled):
+        """ Return the statistics of GET path, cycling through clients """
+        latencies = []
+        for index in range(count):
+            start = time.perf_counter()
+            response = clients[index % len(clients)].get(path)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise CommandError(f"GET {path}: {response.status_code}")
+        queries, peaks = [], []
+        for index in range(profiled):
+            tracemalloc.start()
+            try:
+                with CaptureQueriesContext(connection) as context:
+                    clients[index % len(clients)].get(path)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+            queries.append(len(context.captured_queries))
+        cuts = quantiles(latencies, n=100) if len(latencies) > 1 else []
+        return {
+            "requests": count,
+            "p50_ms": percentile(cuts, 50),
+            "p95_ms": percentile(cuts, 95),
+            "p99_ms": percentile(cuts, 99),
+            "queries": round(mean(queries), 1) if queries else 0,
+            "max_queries": max(queries, default=0),
+            "peak_memory_kib": round(max(peaks, default=0) / 1024),
+        }
+
+    def sampled_clients(self, users, rng, sampled):
+        """ Logged-in clients of the most followed user and a sample """
+        indexes = {0, *rng.sample(range(users), min(users, sampled))}
+        clients = []
+        for user in User.objects.filter(username__in=[
+                synthetic.username(PREFIX, index) for index in indexes]):
+            client = Client()
+            client.force_login(user)
+            clients.append(client)
+        return clients
+
+    def run_scale(self, users, options):
+        population = synthetic.generate(users, prefix=PREFIX,
+                                        **population_options(options))
+        rng = random.Random(options["seed"])
+        clients = self.sampled_clients(users, rng, options["sampled_users"])
+        results = {}
+        for name, path in endpoints(rng):
+            results[name] = self.measure(clients, path, options["requests"],
+                                         options["profiled"])
+            self.stdout.write(
+                f"{users} users, {name}: p50 {results[name]['p50_ms']}ms, "
+                f"p95 {results[name]['p95_ms']}ms, p99 "
+                f"{results[name]['p99_ms']}ms, "
+                f"{results[name]['queries']} queries, "
+                f"{results[name]['peak_memory_kib']} KiB")
+        return {"population": population, "endpoints": results}
+
+    def compare(self, results, baseline, tolerance):
+        """ Print the measures that regressed, return their number """
+        regressions = 0
+        for scale, current in results["scales"].items():
+            previous = baseline.get("scales", {}).get(scale)
+            if not previous:
+                continue
+            for name, measures in current["endpoints"].items():
+                before = previous["endpoints"].get(name, {})
+                for measure in COMPARED:
+                    old, new = before.get(measure), measures[measure]
+                    if old and new > old * (1 + tolerance):
+                        regressions += 1
+                        self.stdout.write(self.style.WARNING(
+                            f"{scale} users, {name}: {measure} {old} -> "
+                            f"{new} (+{(new / old - 1) * 100:.0f}%)"))
+        return regressions
+
+    def handle(self, *args, scales, output, baseline, tolerance, **options):
+        if replicas():
+            raise CommandError("Run the suite without read replicas.")
+        try:
+            sizes = [int(size) for size in scales.split(",")]
+        except ValueError:
+            raise CommandError("--scales takes comma separated integers.")
+        previous = None
+        if baseline:
+            try:
+                previous = json.loads(Path(baseline).read_text())
+            except (OSError, ValueError) as error:
+                raise CommandError(f"Cannot read the baseline: {error}")
+
+        results = {
+            "meta": {
+                "date": timezone.now().isoformat(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+                "options": {**population_options(options),
+                            "requests": options["requests"],
+                            "profiled": options["profiled"]},
+            },
+            "scales": {},
+        }
+        for users in sizes:
+            with self.scratch_database():
+                results["scales"][str(users)] = self.run_scale(users,
+                                                               options)
+        Path(output).write_text(json.dumps(results, indent=2))
+        self.stdout.write(self.style.SUCCESS(f"Results written to {output}."))
+
+        if previous and self.compare(results, previous, tolerance):
+            raise CommandError("Regressions against the baseline.")
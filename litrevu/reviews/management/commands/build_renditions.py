@@ -0,0 +1,70 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from reviews import images
+from reviews.models import Ticket
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    """ Backfill the image renditions of existing covers and avatars """
+    help = ("Build the renditions of ticket covers, avatars and of the "
+            "files already stored under tickets/ and avatars/.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force", action="store_true",
+            help="Rebuild the renditions that already exist.")
+        parser.add_argument(
+            "--workers", type=int, default=images.MAX_WORKERS,
+            help="Number of worker threads (default: %(default)s).")
+
+    def sources(self):
+        """ Return the storage names of every image to process """
+        names = set(Ticket.objects.exclude(image="")
+                    .exclude(image__isnull=True)
+                    .values_list("image", flat=True))
+        names |= set(User.objects.exclude(profile_picture="")
+                     .exclude(profile_picture__isnull=True)
+                     .values_list("profile_picture", flat=True))
+        directories = ["tickets", "avatars"]
+        while directories:
+            # uploads are stored under tickets/3f/... (reviews.uploads)
+            directory = directories.pop()
+            if not default_storage.exists(directory):
+                continue
+            subdirectories, files = default_storage.listdir(directory)
+            directories += [os.path.join(directory, name)
+                            for name in subdirectories]
+            names |= {os.path.join(directory, name) for name in files
+                      if not name.endswith(".upload")}
+        return sorted(names)
+
+    def build(self, source, force, threaded=False):
+        try:
+            return source, len(images.process_image(source, force=force))
+        finally:
+            if threaded:
+                connection.close()
+
+    def handle(self, *args, force=False, workers=1, **options):
+        sources = self.sources()
+        if workers > 1:
+            pool = ThreadPoolExecutor(max_workers=workers)
+            results = pool.map(
+                lambda name: self.build(name, force, threaded=True), sources)
+        else:
+            pool = None
+            results = (self.build(name, force) for name in sources)
+        for source, count in results:
+            self.stdout.write(f"{source}: {count} rendition(s)")
+        if pool is not None:
+            pool.shutdown()
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(sources)} image(s) processed."))
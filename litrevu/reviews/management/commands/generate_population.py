@@ -0,0 +1,56 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from reviews import synthetic
+
+User = get_user_model()
+
+
+def add_population_arguments(parser):
+    """ Options of the synthetic population, shared with benchmark_suite """
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--follows", type=float, default=20,
+                        help="Mean follows per user (default 20).")
+    parser.add_argument("--blocks", type=float, default=0.2,
+                        help="Mean blocks per user (default 0.2).")
+    parser.add_argument("--tickets", type=float, default=3,
+                        help="Mean tickets per user (default 3).")
+    parser.add_argument("--reviews", type=float, default=2,
+                        help="Mean reviews per ticket (default 2).")
+    parser.add_argument("--covers", type=float, default=0,
+                        help="Share of tickets with a cover image "
+                             "(default 0).")
+
+
+def population_options(options):
+    return {name: options[name] for name in
+            ("seed", "follows", "blocks", "tickets", "reviews", "covers")}
+
+
+class Command(BaseCommand):
+    """ Generate a deterministic synthetic population """
+    help = ("Create N users named PREFIX000000... with a power-law follow "
+            "graph, blocks, tickets, reviews and optional cover images. The "
+            "same options always generate the same data. Synthetic users "
+            f"log in with the password {synthetic.PASSWORD!r}.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("users", type=int)
+        parser.add_argument("--prefix", default="synth")
+        parser.add_argument("--replace", action="store_true",
+                            help="Delete the users of the prefix first.")
+        add_population_arguments(parser)
+
+    def handle(self, *args, users, prefix, replace, **options):
+        existing = User.objects.filter(username__startswith=prefix)
+        if existing.exists():
+            if not replace:
+                raise CommandError(f"Users prefixed {prefix!r} exist, use "
+                                   f"--replace or another --prefix.")
+            existing.delete()
+        created = synthetic.generate(users, prefix=prefix,
+                                     **population_options(options))
+        seconds = created.pop("seconds")
+        self.stdout.write(self.style.SUCCESS(
+            ", ".join(f"{count} {kind}" for kind, count in created.items())
+            + f" created in {seconds:.1f}s."))
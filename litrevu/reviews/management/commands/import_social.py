@@ -0,0 +1,203 @@
+import csv
+import json
+import time
+from pathlib import Path
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from reviews import bulk
+from reviews.models import Review, Ticket
+
+User = get_user_model()
+
+KINDS = ("follow", "block", "ticket", "review")
+
+
+class Command(BaseCommand):
+    """ Import follow / block graphs and posts from CSV or JSONL """
+    help = (
+        "Import rows from a CSV file (with a header) or a JSONL file. Each "
+        "row has a `type` and the fields of its type:\n"
+        "  follow, block: user, target (usernames)\n"
+        "  ticket: user, title, description, key (optional, for reviews)\n"
+        "  review: user, ticket (key of a ticket of the file) or ticket_id, "
+        "rating (0-5), headline, body\n"
+        "Rows are written with bulk_create in batches, then the feeds, "
+        "counters and caches are refreshed once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=("csv", "jsonl"),
+                            help="Default: from the file extension.")
+        parser.add_argument("--batch-size", type=int,
+                            default=bulk.BATCH_SIZE)
+
+    def rows(self, path, file_format):
+        with open(path, newline="", encoding="utf-8") as file:
+            if file_format == "csv":
+                yield from enumerate(csv.DictReader(file), start=2)
+                return
+            for number, line in enumerate(file, start=1):
+                if line.strip():
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        row = None
+                    # None: rejected, not a JSON object
+                    yield number, row if isinstance(row, dict) else None
+
+    def handle(self, *args, path, format=None, batch_size, **options):
+        file_format = format or Path(path).suffix.lstrip(".").lower()
+        if file_format not in ("csv", "jsonl"):
+            raise CommandError("Unknown format, use --format csv or jsonl.")
+        self.batch_size = batch_size
+        self.user_ids = {}
+        self.ticket_keys = {}
+        self.buffers = {kind: [] for kind in KINDS}
+        self.results = {kind: bulk.BulkResult() for kind in KINDS}
+        self.invalid = 0
+
+        rows = 0
+        start = time.perf_counter()
+        try:
+            for number, row in self.rows(path, file_format):
+                rows += 1
+                if row is None:
+                    self.reject(number, "not a JSON object")
+                    continue
+                kind = row.get("type")
+                if kind not in KINDS:
+                    self.reject(number, f"unknown type {kind!r}")
+                    continue
+                self.buffers[kind].append((number, row))
+                if len(self.buffers[kind]) >= batch_size:
+                    self.flush(kind)
+        except OSError as error:
+            raise CommandError(error)
+        for kind in KINDS:
+            self.flush(kind)
+        written = time.perf_counter() - start
+
+        total = bulk.BulkResult()
+        for result in self.results.values():
+            total.merge(result)
+        refresh_start = time.perf_counter()
+        bulk.refresh(total)
+        refreshed = time.perf_counter() - refresh_start
+
+        for kind, result in self.results.items():
+            if result.rows:
+                self.stdout.write(
+                    f"{kind}: {result.created} created, {result.deleted} "
+                    f"deleted, {result.skipped} skipped, "
+                    f"{result.rate:.0f} rows/s")
+        self.stdout.write(self.style.SUCCESS(
+            f"{rows} rows ({self.invalid} invalid) in {written:.2f}s, "
+            f"{rows / written if written else 0:.0f} rows/s; "
+            f"feeds and counters refreshed in {refreshed:.2f}s."))
+
+    def reject(self, number, reason):
+        self.invalid += 1
+        self.stderr.write(f"line {number}: {reason}")
+
+    def resolve_users(self, rows, *fields):
+        """ Load the ids of the usernames of rows not yet known """
+        names = {row.get(name) for _, row in rows for name in fields}
+        missing = names - self.user_ids.keys() - {None}
+        self.user_ids.update(User.objects.filter(username__in=missing)
+                             .values_list("username", "pk"))
+
+    def users_of(self, number, row, *fields):
+        """ Return the ids of the row's usernames, None if one is unknown """
+        ids = [self.user_ids.get(row.get(name)) for name in fields]
+        if None in ids:
+            self.reject(number, f"unknown user in {fields}")
+            return None
+        return ids
+
+    def too_long(self, number, row, model, *fields):
+        """ Reject the row if a field is over its max_length """
+        for name in fields:
+            max_length = model._meta.get_field(name).max_length
+            if len(str(row.get(name) or "")) > max_length:
+                self.reject(number, f"{name} over {max_length} characters")
+                return True
+        return False
+
+    def flush(self, kind):
+        rows, self.buffers[kind] = self.buffers[kind], []
+        if not rows:
+            return
+        if kind == "review":
+            # reviews may reference tickets still in the buffer
+            self.flush("ticket")
+        getattr(self, f"flush_{kind}")(rows)
+
+    def edges(self, rows):
+        self.resolve_users(rows, "user", "target")
+        return [ids for ids in (self.users_of(number, row, "user", "target")
+                                for number, row in rows) if ids]
+
+    def flush_follow(self, rows):
+        self.results["follow"].merge(
+            bulk.add_follows(self.edges(rows), batch_size=self.batch_size))
+
+    def flush_block(self, rows):
+        self.results["block"].merge(
+            bulk.add_blocks(self.edges(rows), batch_size=self.batch_size))
+
+    def flush_ticket(self, rows):
+        self.resolve_users(rows, "user")
+        tickets, keys = [], []
+        for number, row in rows:
+            ids = self.users_of(number, row, "user")
+            if not ids or not row.get("title"):
+                if ids:
+                    self.reject(number, "ticket without title")
+                continue
+            if self.too_long(number, row, Ticket, "title", "description"):
+                continue
+            tickets.append(Ticket(user_id=ids[0], title=row["title"],
+                                  description=row.get("description") or ""))
+            keys.append(row.get("key"))
+        self.results["ticket"].merge(
+            bulk.add_posts(tickets=tickets, batch_size=self.batch_size))
+        self.ticket_keys.update((key, ticket.pk) for key, ticket
+                                in zip(keys, tickets) if key)
+
+    def flush_review(self, rows):
+        self.resolve_users(rows, "user")
+        reviews = []
+        for number, row in rows:
+            ids = self.users_of(number, row, "user")
+            if not ids:
+                continue
+            ticket_id = self.ticket_keys.get(row.get("ticket")) \
+                or row.get("ticket_id")
+            try:
+                rating = int(row.get("rating"))
+                ticket_id = int(ticket_id)
+            except (TypeError, ValueError):
+                self.reject(number, "invalid rating or ticket")
+                continue
+            if not 0 <= rating <= 5 or not row.get("headline"):
+                self.reject(number, "invalid rating or headline")
+                continue
+            if self.too_long(number, row, Review, "headline", "body"):
+                continue
+            reviews.append((number, Review(
+                user_id=ids[0], ticket_id=ticket_id, rating=rating,
+                headline=row["headline"], body=row.get("body") or "")))
+        existing = set(Ticket.objects.filter(
+            pk__in={review.ticket_id for _, review in reviews})
+            .values_list("pk", flat=True))
+        valid = []
+        for number, review in reviews:
+            if review.ticket_id in existing:
+                valid.append(review)
+            else:
+                self.reject(number, f"unknown ticket {review.ticket_id}")
+        self.results["review"].merge(
+            bulk.add_posts(reviews=valid, batch_size=self.batch_size))
@@ -0,0 +1,45 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from reviews import feed
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    """ Rebuild the materialized feed (FeedEntry) or check it for drift """
+    help = "Rebuild the materialized feed of every user, or check it for drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check", action="store_true",
+            help="Only report the timelines that drifted, write nothing.")
+        parser.add_argument(
+            "--user", action="append", dest="usernames", default=[],
+            help="Limit to this username (repeatable).")
+
+    def handle(self, *args, check=False, usernames=(), **options):
+        users = User.objects.order_by("pk")
+        if usernames:
+            users = users.filter(username__in=usernames)
+
+        drifted = 0
+        for user in users.iterator():
+            if check:
+                missing, extra = feed.timeline_drift(user)
+                if missing or extra:
+                    drifted += 1
+                    self.stdout.write(
+                        f"{user.username}: {len(missing)} missing, "
+                        f"{len(extra)} extra")
+            else:
+                feed.rebuild_timeline(user)
+                self.stdout.write(f"{user.username}: rebuilt")
+
+        if check and drifted:
+            raise CommandError(f"{drifted} timeline(s) drifted, "
+                               f"run `rebuild_feed` to repair them.")
+        if check:
+            self.stdout.write(self.style.SUCCESS("No drift."))
+        else:
+            self.stdout.write(self.style.SUCCESS("Feed rebuilt."))
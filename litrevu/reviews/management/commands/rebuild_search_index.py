@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from reviews import search
+
+
+class Command(BaseCommand):
+    """ Rebuild the full-text index of tickets and reviews """
+    help = "Index every ticket and review from scratch."
+
+    def handle(self, *args, **options):
+        backend = search.get_backend()
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f"Search index rebuilt ({type(backend).__name__})."))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from reviews import counters
+
+
+class Command(BaseCommand):
+    """ Repair the denormalized counters, or check them for drift """
+    help = ("Recompute the review, rating, follower and post counters that "
+            "drifted, or only report them.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check", action="store_true",
+            help="Only report the rows that drifted, write nothing.")
+
+    def handle(self, *args, check=False, **options):
+        drifted = counters.reconcile(check=check)
+        for model, rows in drifted.items():
+            if rows:
+                self.stdout.write(f"{model}: {rows} row(s) drifted")
+
+        total = sum(drifted.values())
+        if check and total:
+            raise CommandError(f"{total} row(s) drifted, "
+                               f"run `reconcile_counters` to repair them.")
+        if check or not total:
+            self.stdout.write(self.style.SUCCESS("No drift."))
+        else:
+            self.stdout.write(self.style.SUCCESS("Counters repaired."))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from litrevu.db import refresh_sqlite_replicas
+
+
+class Command(BaseCommand):
+    """ Copy the primary SQLite database onto the SQLite replicas """
+    help = ("Copy the default SQLite database onto the replicas of "
+            "LITREVU_SQLITE_REPLICAS, to try the replica routing locally.")
+
+    def handle(self, *args, **options):
+        aliases = refresh_sqlite_replicas()
+        for alias in aliases:
+            self.stdout.write(f"{alias}: refreshed")
+        if not aliases:
+            self.stdout.write("No SQLite replica configured.")
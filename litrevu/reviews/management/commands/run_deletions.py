@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from reviews import deletion
+
+
+class Command(BaseCommand):
+    """ Run or resume the unfinished deletion jobs """
+    help = ("Run the deletion jobs left unfinished (crash, deployment, "
+            "failed batch), in small batches, see reviews.deletion. Jobs "
+            "running in another process are skipped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-lock-ms", type=int, default=None,
+            help="Target duration of a batch transaction "
+                 "(default: DELETION_MAX_LOCK_MS).")
+        parser.add_argument("--pause", type=float, default=0,
+                            help="Seconds to wait between batches.")
+
+    def handle(self, *args, max_lock_ms, pause, **options):
+        jobs = list(deletion.pending())
+        if not jobs:
+            self.stdout.write("No deletion job left.")
+            return
+        for job in jobs:
+            try:
+                ran = deletion.run(job, max_lock_ms=max_lock_ms, pause=pause)
+            except Exception as error:
+                self.stderr.write(f"{job}: failed, {error}")
+                continue
+            if not ran:
+                self.stdout.write(f"{job}: running elsewhere, skipped.")
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                f"{job}: {job.deleted} row(s) deleted in {job.batches} "
+                f"batch(es)."))
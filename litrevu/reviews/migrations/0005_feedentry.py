@@ -0,0 +1,76 @@
+# Generated by Django 5.2.7 on 2026-10-17 11:29
+
+import django.db.models.deletion
+from django.conf import settings
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def fill_feed(apps, schema_editor):
+    """
+    Materialize the timeline of every existing user: each post goes to
+    its author, the ticket author for a review, and their followers,
+    minus the users blocked by the post author (reviews.feed.audience)
+    """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    FeedEntry = apps.get_model('reviews', 'FeedEntry')
+    Ticket = apps.get_model('reviews', 'Ticket')
+    Review = apps.get_model('reviews', 'Review')
+    UserFollow = apps.get_model('reviews', 'UserFollow')
+    UserBlocked = apps.get_model('reviews', 'UserBlocked')
+
+    followers = defaultdict(set)
+    for user, followed in UserFollow.objects.values_list('user', 'following_user'):
+        followers[followed].add(user)
+    blocked = defaultdict(set)
+    for user, blocked_user in UserBlocked.objects.values_list('user', 'blocked_user'):
+        blocked[user].add(blocked_user)
+
+    ticket_type, _ = ContentType.objects.get_or_create(app_label='reviews', model='ticket')
+    review_type, _ = ContentType.objects.get_or_create(app_label='reviews', model='review')
+    posts = [(ticket_type, pk, user, {user}, time_created) for pk, user, time_created
+             in Ticket.objects.values_list('pk', 'user', 'time_created').iterator()]
+    posts += [(review_type, pk, user, {user, ticket_user}, time_created)
+              for pk, user, ticket_user, time_created
+              in Review.objects.values_list('pk', 'user', 'ticket__user', 'time_created').iterator()]
+
+    entries = []
+    for content_type, pk, author, authors, time_created in posts:
+        audience = set(authors)
+        for user in authors:
+            audience |= followers[user]
+        entries += [FeedEntry(owner_id=owner, content_type=content_type, object_id=pk,
+                              time_created=time_created)
+                    for owner in audience - blocked[author]]
+        if len(entries) >= 500:
+            FeedEntry.objects.bulk_create(entries)
+            entries = []
+    FeedEntry.objects.bulk_create(entries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('reviews', '0004_alter_ticket_image'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveBigIntegerField()),
+                ('time_created', models.DateTimeField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', '-time_created', '-id'], name='feedentry_owner_timeline'), models.Index(fields=['content_type', 'object_id'], name='feedentry_post')],
+                'unique_together': {('owner', 'content_type', 'object_id')},
+            },
+        ),
+        migrations.RunPython(fill_feed, migrations.RunPython.noop),
+    ]
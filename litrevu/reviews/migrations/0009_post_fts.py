@@ -0,0 +1,35 @@
+from django.db import migrations
+
+FTS_TABLE = 'reviews_post_fts'
+
+
+def create_fts(apps, schema_editor):
+    """ Create and fill the FTS5 index of the posts (SQLite only) """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        f"title, body, tokenize = 'unicode61 remove_diacritics 2')")
+    schema_editor.execute(
+        f"INSERT INTO {FTS_TABLE} (rowid, title, body) "
+        f"SELECT id * 2, title, description FROM reviews_ticket")
+    schema_editor.execute(
+        f"INSERT INTO {FTS_TABLE} (rowid, title, body) "
+        f"SELECT id * 2 + 1, headline, body FROM reviews_review")
+
+
+def drop_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0008_imagerendition'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts, drop_fts),
+    ]
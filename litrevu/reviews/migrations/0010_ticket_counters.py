@@ -0,0 +1,54 @@
+# Generated by Django 5.2.7 on 2026-10-17 11:39
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum, \
+    Value
+from django.db.models.functions import Coalesce
+
+
+def _aggregate(model, column, expression):
+    return Coalesce(
+        Subquery(model.objects.filter(**{column: OuterRef('pk')})
+                 .order_by().values(column)
+                 .annotate(value=expression).values('value')),
+        Value(0), output_field=IntegerField())
+
+
+def fill_counters(apps, schema_editor):
+    """ Compute the counters of the existing rows """
+    Ticket = apps.get_model('reviews', 'Ticket')
+    Review = apps.get_model('reviews', 'Review')
+    UserFollow = apps.get_model('reviews', 'UserFollow')
+    User = apps.get_model('authentication', 'User')
+    Ticket.objects.update(
+        review_count=_aggregate(Review, 'ticket', Count('pk')),
+        rating_sum=_aggregate(Review, 'ticket', Sum('rating')),
+    )
+    User.objects.update(
+        follower_count=_aggregate(UserFollow, 'following_user', Count('pk')),
+        following_count=_aggregate(UserFollow, 'user', Count('pk')),
+        post_count=(_aggregate(Ticket, 'user', Count('pk'))
+                    + _aggregate(Review, 'user', Count('pk'))),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0007_user_counters'),
+        ('reviews', '0009_post_fts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='ticket',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.7 on 2026-10-17 12:26
+
+from collections import Counter
+
+from django.db import migrations, models
+
+
+def count_references(apps, schema_editor):
+    """ Count the rows pointing at each existing file """
+    Ticket = apps.get_model('reviews', 'Ticket')
+    ImageRendition = apps.get_model('reviews', 'ImageRendition')
+    User = apps.get_model('authentication', 'User')
+    StoredFile = apps.get_model('reviews', 'StoredFile')
+    references = Counter()
+    for model, field in ((Ticket, 'image'), (ImageRendition, 'file'),
+                         (User, 'profile_picture')):
+        references.update(model.objects.exclude(**{field: ''})
+                          .exclude(**{f'{field}__isnull': True})
+                          .values_list(field, flat=True).iterator())
+    StoredFile.objects.bulk_create(
+        [StoredFile(name=name, references=count)
+         for name, count in references.items()], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0008_user_deleted_at'),
+        ('reviews', '0011_deletion_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('references', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+# same configuration and expression as reviews.search.post_vector, or the
+# search queries do not use the indexes
+SEARCH_CONFIG = 'simple'
+INDEXES = [
+    ('Ticket', 'ticket_search_idx', 'title', 'description'),
+    ('Review', 'review_search_idx', 'headline', 'body'),
+]
+
+
+def _index(name, title, body):
+    return GinIndex(SearchVector(title, weight='A', config=SEARCH_CONFIG)
+                    + SearchVector(body, weight='B', config=SEARCH_CONFIG),
+                    name=name)
+
+
+def create_indexes(apps, schema_editor):
+    """ Index the tsvector of the posts (PostgreSQL only) """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for model, name, title, body in INDEXES:
+        schema_editor.add_index(apps.get_model('reviews', model),
+                                _index(name, title, body))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for model, name, title, body in INDEXES:
+        schema_editor.remove_index(apps.get_model('reviews', model),
+                                   _index(name, title, body))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviews', '0012_stored_files'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -1,37 +1,79 @@
 from django.conf import settings
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
 
+from authentication.models import CounterFieldsMixin
 
-class Ticket(models.Model):
+
+class Ticket(CounterFieldsMixin, models.Model):
     """ Ticket Model """
+    counter_fields = ('review_count', 'rating_sum')
     title = models.CharField(max_length=128)
     description = models.TextField(max_length=2048)
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
-        on_delete=models.CASCADE
+        on_delete=models.CASCADE,
+        db_index=False  # covered by ticket_user_time_idx
     )
     image = models.ImageField(upload_to="tickets/", null=True, blank=True)
     time_created = models.DateTimeField(auto_now_add=True)
+    time_updated = models.DateTimeField(auto_now=True)
+    # Denormalized counters, maintained by reviews.counters
+    review_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    # Set when the ticket is deleted, the rows go later (reviews.deletion)
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # feed / posts: the posts of some users, newest first
+            models.Index(fields=['user', '-time_created'],
+                         name='ticket_user_time_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+    @property
+    def average_rating(self):
+        """ Average rating of the reviews, None without review """
+        if not self.review_count:
+            return None
+        return self.rating_sum / self.review_count
+
 
 class Review(models.Model):
     """ Review Model """
-    ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE)
+    ticket = models.ForeignKey(
+        Ticket,
+        on_delete=models.CASCADE,
+        db_index=False  # covered by review_ticket_user_idx
+    )
     rating = models.PositiveSmallIntegerField(
         validators=[MinValueValidator(0),
                     MaxValueValidator(5)]
     )
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
-        on_delete=models.CASCADE
+        on_delete=models.CASCADE,
+        db_index=False  # covered by review_user_time_idx
     )
     headline = models.CharField(max_length=128)
     body = models.TextField(max_length=8192, blank=True)
     time_created = models.DateTimeField(auto_now_add=True)
+    time_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # feed / posts: the posts of some users, newest first
+            models.Index(fields=['user', '-time_created'],
+                         name='review_user_time_idx'),
+            # reviews of a ticket, and "has this user reviewed it"
+            models.Index(fields=['ticket', 'user'],
+                         name='review_ticket_user_idx'),
+        ]
 
     def __str__(self):
         return self.headline
@@ -47,11 +89,17 @@ class UserFollow(models.Model):
     following_user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
-        related_name='followers'
+        related_name='followers',
+        db_index=False  # covered by userfollow_reverse_idx
     )
 
     class Meta:
         unique_together = ('user', 'following_user')
+        indexes = [
+            # followers of a user (reverse lookup of the unique key)
+            models.Index(fields=['following_user', 'user'],
+                         name='userfollow_reverse_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} → {self.following_user.username}"
@@ -67,11 +115,102 @@ class UserBlocked(models.Model):
     blocked_user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
-        related_name='blocked_by'
+        related_name='blocked_by',
+        db_index=False  # covered by userblocked_reverse_idx
     )
 
     class Meta:
         unique_together = ('user', 'blocked_user')
+        indexes = [
+            # users who blocked a user (blocked_me)
+            models.Index(fields=['blocked_user', 'user'],
+                         name='userblocked_reverse_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} bloque {self.blocked_user.username}"
+
+
+class FeedEntry(models.Model):
+    """
+    FeedEntry Model
+    One post (ticket or review) visible in the feed of its owner.
+    Maintained on write by reviews.signals, rebuilt by `rebuild_feed`.
+    """
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='feed_entries'
+    )
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveBigIntegerField()
+    post = GenericForeignKey('content_type', 'object_id')
+    time_created = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('owner', 'content_type', 'object_id')
+        indexes = [
+            models.Index(fields=['owner', '-time_created', '-id'],
+                         name='feedentry_owner_timeline'),
+            models.Index(fields=['content_type', 'object_id'],
+                         name='feedentry_post'),
+        ]
+
+    def __str__(self):
+        return f"{self.owner} : {self.content_type.model} {self.object_id}"
+
+
+class ImageRendition(models.Model):
+    """
+    ImageRendition Model
+    Resized, re-encoded copy of an uploaded image (ticket cover or avatar),
+    produced off the request thread by reviews.images.
+    """
+    source = models.CharField(max_length=255)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    format = models.CharField(max_length=8)
+    file = models.ImageField(upload_to="renditions/")
+
+    class Meta:
+        unique_together = ('source', 'width', 'format')
+
+    def __str__(self):
+        return f"{self.source} {self.width}w {self.format}"
+
+
+class DeletionJob(models.Model):
+    """
+    DeletionJob Model
+    Background removal of a tombstoned ticket or user and of the rows
+    depending on it, batch by batch, see reviews.deletion.
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveBigIntegerField()
+    root = GenericForeignKey('content_type', 'object_id')
+    label = models.CharField(max_length=255)
+    # index of the step to run next, and progress so far
+    step = models.PositiveSmallIntegerField(default=0)
+    deleted = models.PositiveIntegerField(default=0)
+    batches = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # a worker running the job holds it until then
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.content_type.model} {self.label}"
+
+
+class StoredFile(models.Model):
+    """
+    StoredFile Model
+    Reference count of a file of the content-addressed storage
+    (reviews.uploads): rows pointing at it, or saves of its content.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    references = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} ({self.references})"
@@ -0,0 +1,255 @@
+"""
+Full-text search over tickets (title, description) and reviews (headline,
+body).
+
+The backend is pluggable (setting REVIEWS_SEARCH_BACKEND, a dotted path):
+SQLite uses an FTS5 inverted index (reviews_post_fts, created by the
+0009 migration) ranked with bm25, PostgreSQL the weighted tsvector of the
+posts (GIN expression indexes of the 0013 migration) ranked with ts_rank.
+Other databases fall back on an unranked LIKE scan, newest first.
+Results are restricted to the searcher's materialized feed, so they
+follow the same follow / block rules as FeedView.
+"""
+import re
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.search import SearchQuery, SearchRank, \
+    SearchVector
+from django.db import connection
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from .feed import hydrate
+from .models import FeedEntry, Review, Ticket
+
+FTS_TABLE = 'reviews_post_fts'
+SEARCH_LIMIT = 20
+# text search configuration of the PostgreSQL vectors and queries, fixed
+# so that the index expressions are immutable
+SEARCH_CONFIG = 'simple'
+
+_backend = None
+
+
+def _document(post):
+    """ Return the (title, body) indexed for a post """
+    if isinstance(post, Ticket):
+        return post.title, post.description
+    return post.headline, post.body
+
+
+def _rowid(post):
+    """ Ticket n is row 2n, review n is row 2n + 1 """
+    return post.pk * 2 + isinstance(post, Review)
+
+
+def post_vector(title, body):
+    """
+    Return the tsvector of the posts, title weighing more than body: the
+    expression of their GIN indexes (0013 migration), keep them in sync
+    """
+    return SearchVector(title, weight='A', config=SEARCH_CONFIG) \
+        + SearchVector(body, weight='B', config=SEARCH_CONFIG)
+
+
+class SearchBackend:
+    """ Interface of the search backends """
+
+    def index(self, post):
+        """ Add or refresh a post in the index """
+        raise NotImplementedError
+
+    def remove(self, post):
+        """ Remove a post from the index """
+        raise NotImplementedError
+
+    def rebuild(self):
+        """ Index every post from scratch """
+        raise NotImplementedError
+
+    def search(self, user, query, limit=SEARCH_LIMIT):
+        """
+        Return the (content_type, id) keys of the posts of the user's feed
+        matching query, best match first ('ticket' or 'review').
+        """
+        raise NotImplementedError
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """ SQLite FTS5 index, rowids encode the post type and id """
+
+    def index(self, post):
+        title, body = _document(post)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT OR REPLACE INTO {FTS_TABLE} (rowid, title, body) "
+                f"VALUES (%s, %s, %s)", [_rowid(post), title, body])
+
+    def remove(self, post):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s",
+                           [_rowid(post)])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, title, body) "
+                f"SELECT id * 2, title, description FROM reviews_ticket")
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, title, body) "
+                f"SELECT id * 2 + 1, headline, body FROM reviews_review")
+
+    @staticmethod
+    def match_expression(query):
+        """
+        Turn user input into an FTS5 query: every word must match, the
+        last one as a prefix. Words are quoted, so no FTS5 syntax leaks.
+        """
+        words = re.findall(r"\w+", query)
+        if not words:
+            return None
+        terms = [f'"{word}"' for word in words]
+        terms[-1] += "*"
+        return " ".join(terms)
+
+    def search(self, user, query, limit=SEARCH_LIMIT):
+        expression = self.match_expression(query)
+        if expression is None:
+            return []
+        ticket_type = ContentType.objects.get_for_model(Ticket).pk
+        review_type = ContentType.objects.get_for_model(Review).pk
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT fts.rowid FROM {FTS_TABLE} AS fts "
+                f"JOIN reviews_feedentry AS entry "
+                f"ON entry.owner_id = %s "
+                f"AND entry.content_type_id = CASE fts.rowid %% 2 "
+                f"WHEN 0 THEN %s ELSE %s END "
+                f"AND entry.object_id = fts.rowid / 2 "
+                f"WHERE {FTS_TABLE} MATCH %s "
+                f"ORDER BY bm25({FTS_TABLE}, 2.0, 1.0) LIMIT %s",
+                [user.pk, ticket_type, review_type, expression, limit])
+            rowids = [row[0] for row in cursor.fetchall()]
+        return [("review" if rowid % 2 else "ticket", rowid // 2)
+                for rowid in rowids]
+
+
+class PostgresBackend(SearchBackend):
+    """
+    PostgreSQL full-text search: the GIN indexes are built on the post
+    columns and maintained by the database, nothing to do on writes
+    """
+
+    def index(self, post):
+        pass
+
+    def remove(self, post):
+        pass
+
+    def rebuild(self):
+        pass
+
+    @staticmethod
+    def search_query(query):
+        """
+        Turn user input into a tsquery: every word must match, the last
+        one as a prefix. Only words are kept, so no tsquery syntax leaks.
+        """
+        words = re.findall(r"\w+", query)
+        if not words:
+            return None
+        terms = [f"'{word}'" for word in words]
+        terms[-1] += ":*"
+        return SearchQuery(" & ".join(terms), search_type='raw',
+                           config=SEARCH_CONFIG)
+
+    def search(self, user, query, limit=SEARCH_LIMIT):
+        query = self.search_query(query)
+        if query is None:
+            return []
+        visible = FeedEntry.objects.filter(owner=user)
+        results = []
+        for model, fields in ((Ticket, ('title', 'description')),
+                              (Review, ('headline', 'body'))):
+            vector = post_vector(*fields)
+            ids = visible.filter(
+                content_type=ContentType.objects.get_for_model(model)) \
+                .values('object_id')
+            kind = model.__name__.lower()
+            results += [
+                (rank, time_created, kind, pk)
+                for pk, rank, time_created in model.objects
+                .annotate(document=vector)
+                .filter(document=query, pk__in=ids)
+                .annotate(rank=SearchRank(vector, query))
+                .order_by('-rank', '-time_created')
+                .values_list('pk', 'rank', 'time_created')[:limit]
+            ]
+        results.sort(reverse=True)
+        return [(kind, pk) for _, _, kind, pk in results[:limit]]
+
+
+class SimpleBackend(SearchBackend):
+    """
+    Fallback without an index, for the databases other than SQLite and
+    PostgreSQL: LIKE scan of the posts of the feed, newest first (not
+    ranked). Enough for small databases.
+    """
+
+    def index(self, post):
+        pass
+
+    def remove(self, post):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def search(self, user, query, limit=SEARCH_LIMIT):
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        visible = FeedEntry.objects.filter(owner=user)
+        results = []
+        for model, fields in ((Ticket, ('title', 'description')),
+                              (Review, ('headline', 'body'))):
+            condition = Q()
+            for word in words:
+                condition &= (Q(**{f"{fields[0]}__icontains": word})
+                              | Q(**{f"{fields[1]}__icontains": word}))
+            ids = visible.filter(
+                content_type=ContentType.objects.get_for_model(model)) \
+                .values('object_id')
+            kind = model.__name__.lower()
+            results += [
+                (time_created, kind, pk)
+                for pk, time_created in model.objects
+                .filter(condition, pk__in=ids)
+                .order_by('-time_created')
+                .values_list('pk', 'time_created')[:limit]
+            ]
+        results.sort(reverse=True)
+        return [(kind, pk) for _, kind, pk in results[:limit]]
+
+
+def get_backend():
+    """ Return the configured search backend """
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'REVIEWS_SEARCH_BACKEND', None)
+        if path:
+            _backend = import_string(path)()
+        elif connection.vendor == 'sqlite':
+            _backend = SQLiteFTSBackend()
+        elif connection.vendor == 'postgresql':
+            _backend = PostgresBackend()
+        else:
+            _backend = SimpleBackend()
+    return _backend
+
+
+def search_posts(user, query, limit=SEARCH_LIMIT):
+    """ Return the posts of the user's feed matching query, ranked """
+    return hydrate(get_backend().search(user, query, limit))
@@ -0,0 +1,271 @@
+"""
+Signal receivers keeping the materialized feed (FeedEntry) in sync with
+post writes and social graph changes, the search indexes (posts and
+usernames), the cached social graph and the denormalized counters in
+sync with writes, bumping the timeline versions of the users whose pages
+change, scheduling image renditions and releasing the image files
+replaced, cleared or deleted with their row.
+"""
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import counters, feed, images, search, versions
+from .autocomplete import username_index
+from .graph import social_graph
+from .models import Review, Ticket, UserBlocked, UserFollow
+
+User = get_user_model()
+
+
+def _owner_deleted(origin, owner_id):
+    """
+    Return True if the deletion comes from the owner's own deletion:
+    its timeline is going away with it and must not be rebuilt.
+    """
+    if isinstance(origin, User):
+        return origin.pk == owner_id
+    if isinstance(origin, QuerySet) and origin.model is User:
+        return origin.filter(pk=owner_id).exists()
+    return False
+
+
+@receiver(post_save, sender=Ticket)
+@receiver(post_save, sender=Review)
+def post_created(sender, instance, created, **kwargs):
+    """ Fan a new post out to the timelines of its audience """
+    if created:
+        feed.fan_out(instance)
+
+
+@receiver(post_delete, sender=Ticket)
+@receiver(post_delete, sender=Review)
+def post_deleted(sender, instance, **kwargs):
+    """ Remove a deleted post from every timeline """
+    versions.bump(feed.readers(instance))
+    feed.retract(instance)
+
+
+@receiver(post_save, sender=Ticket)
+@receiver(post_save, sender=Review)
+def post_changed(sender, instance, **kwargs):
+    """ New version for the timelines showing a new or edited post """
+    versions.bump(feed.readers(instance))
+
+
+@receiver(post_save, sender=UserFollow)
+def follow_created(sender, instance, created, **kwargs):
+    """ The follower's timeline now includes the followed user's posts """
+    if created:
+        feed.add_posts_of(instance.user_id, [instance.following_user_id])
+        versions.bump(versions.related_users(instance.following_user_id))
+
+
+@receiver(post_delete, sender=UserFollow)
+def follow_deleted(sender, instance, origin=None, **kwargs):
+    """ The follower's timeline loses the unfollowed user's posts """
+    if not _owner_deleted(origin, instance.user_id):
+        feed.remove_posts_of(instance.user_id, [instance.following_user_id])
+    versions.bump(versions.related_users(instance.following_user_id))
+
+
+@receiver(post_save, sender=UserBlocked)
+def block_created(sender, instance, created, **kwargs):
+    """ The blocked user's timeline loses the blocking user's posts """
+    if created:
+        feed.remove_posts_of(instance.blocked_user_id, [instance.user_id])
+        versions.bump([instance.user_id])
+
+
+@receiver(post_delete, sender=UserBlocked)
+def block_deleted(sender, instance, origin=None, **kwargs):
+    """ The unblocked user's timeline gets the posts back """
+    if not _owner_deleted(origin, instance.blocked_user_id):
+        feed.add_posts_of(instance.blocked_user_id, [instance.user_id])
+    versions.bump([instance.user_id])
+
+
+@receiver(post_save, sender=UserFollow)
+@receiver(post_save, sender=UserBlocked)
+def relation_created(sender, instance, created, **kwargs):
+    """ Drop the cached social graph of both users """
+    if created:
+        social_graph.invalidate(instance.user_id, _target_id(instance))
+
+
+@receiver(post_delete, sender=UserFollow)
+@receiver(post_delete, sender=UserBlocked)
+def relation_deleted(sender, instance, **kwargs):
+    social_graph.invalidate(instance.user_id, _target_id(instance))
+
+
+def _target_id(relation):
+    """ The followed or blocked user of a relation """
+    if isinstance(relation, UserFollow):
+        return relation.following_user_id
+    return relation.blocked_user_id
+
+
+@receiver(post_save, sender=Ticket)
+@receiver(post_save, sender=Review)
+def post_saved(sender, instance, **kwargs):
+    """ Index a new or edited post """
+    search.get_backend().index(instance)
+
+
+@receiver(post_delete, sender=Ticket)
+@receiver(post_delete, sender=Review)
+def post_unindexed(sender, instance, **kwargs):
+    """ Remove a deleted post from the search index """
+    search.get_backend().remove(instance)
+
+
+@receiver(post_save, sender=Ticket)
+def ticket_counted(sender, instance, created, **kwargs):
+    """ Count a new ticket in its author's posts """
+    if created:
+        counters.post_added(instance)
+
+
+@receiver(post_delete, sender=Ticket)
+def ticket_uncounted(sender, instance, **kwargs):
+    counters.post_removed(instance)
+
+
+@receiver(pre_save, sender=Review)
+def review_rating_read(sender, instance, **kwargs):
+    """ Remember the stored rating of an edited review """
+    instance._previous_rating = None
+    if not instance._state.adding:
+        instance._previous_rating = Review.objects.filter(
+            pk=instance.pk).values_list('rating', flat=True).first()
+
+
+@receiver(post_save, sender=Review)
+def review_counted(sender, instance, created, **kwargs):
+    """ Update the ticket aggregates and the author's post count """
+    previous = getattr(instance, '_previous_rating', None)
+    if created:
+        counters.review_added(instance)
+    elif previous is not None:
+        counters.rating_changed(instance, previous)
+
+
+@receiver(post_delete, sender=Review)
+def review_uncounted(sender, instance, **kwargs):
+    counters.review_removed(instance)
+
+
+@receiver(post_save, sender=UserFollow)
+def follow_counted(sender, instance, created, **kwargs):
+    if created:
+        counters.follow_added(instance)
+
+
+@receiver(post_delete, sender=UserFollow)
+def follow_uncounted(sender, instance, **kwargs):
+    counters.follow_removed(instance)
+
+
+@receiver(post_save, sender=Ticket)
+def ticket_image_saved(sender, instance, **kwargs):
+    """ Build the renditions of a new ticket cover in the background """
+    if instance.image:
+        images.schedule(instance.image.name)
+
+
+@receiver(post_save, sender=User)
+def avatar_saved(sender, instance, update_fields=None, **kwargs):
+    """ Build the renditions of a new avatar in the background """
+    if update_fields and 'profile_picture' not in update_fields:
+        return
+    if instance.profile_picture:
+        images.schedule(instance.profile_picture.name)
+
+
+IMAGE_FIELDS = {Ticket: 'image', User: 'profile_picture'}
+
+
+@receiver(pre_save, sender=Ticket)
+@receiver(pre_save, sender=User)
+def stored_image_read(sender, instance, update_fields=None, **kwargs):
+    """
+    Remember the stored image of an edited ticket or user, to release it
+    once replaced or cleared
+    """
+    field = IMAGE_FIELDS[sender]
+    instance._previous_image = None
+    if instance._state.adding or (
+            update_fields is not None and field not in update_fields):
+        return
+    image = getattr(instance, field)
+    # not committed yet: uploaded by this save
+    instance._image_uploaded = bool(image) and not image._committed
+    instance._previous_image = sender.objects.filter(pk=instance.pk) \
+        .values_list(field, flat=True).first()
+
+
+@receiver(post_save, sender=Ticket)
+@receiver(post_save, sender=User)
+def replaced_image_released(sender, instance, **kwargs):
+    """
+    Release the previous image of a ticket or user when the save stored
+    another one or none: a new upload takes its own reference, even
+    when it is the same content
+    """
+    previous = getattr(instance, '_previous_image', None)
+    if previous and (instance._image_uploaded or previous
+                     != getattr(instance, IMAGE_FIELDS[sender]).name):
+        images.release_on_commit([previous])
+
+
+@receiver(post_delete, sender=Ticket)
+@receiver(post_delete, sender=User)
+def deleted_image_released(sender, instance, **kwargs):
+    """ Release the image of a deleted ticket or user """
+    images.release_on_commit([getattr(instance, IMAGE_FIELDS[sender]).name])
+
+
+SHOWN_USER_FIELDS = ('username', 'profile_picture')
+
+
+@receiver(pre_save, sender=User)
+def user_shown_read(sender, instance, update_fields=None, **kwargs):
+    """
+    Remember the stored username and avatar of an edited user, unless the
+    save cannot change them (update_fields, e.g. last_login at login)
+    """
+    instance._previous_shown = None
+    if instance._state.adding or (
+            update_fields is not None
+            and not set(SHOWN_USER_FIELDS) & set(update_fields)):
+        return
+    stored = User.objects.filter(pk=instance.pk) \
+        .values_list(*SHOWN_USER_FIELDS).first()
+    if stored is not None:
+        username, picture = stored
+        instance._previous_shown = (username, picture or '')
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    """
+    Index a new user, or a changed username / avatar, which also changes
+    the pages of the related users.
+    """
+    previous = getattr(instance, '_previous_shown', None)
+    changed = previous is not None and previous != (
+        instance.username, instance.profile_picture.name or '')
+    if created or changed:
+        transaction.on_commit(lambda: username_index.update(instance))
+    if changed:
+        versions.bump(versions.related_users(instance.pk))
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    """ Remove a deleted user from the username index """
+    user_id = instance.pk  # None once the deletion is done
+    transaction.on_commit(lambda: username_index.remove(user_id))
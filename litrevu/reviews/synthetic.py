@@ -0,0 +1,183 @@
+"""
+Deterministic synthetic populations, for benchmarks at realistic scale.
+
+`generate` creates users named `{prefix}000000`, `{prefix}000001`... and,
+from a seeded random generator, always the same social graph and posts
+for the same parameters:
+
+- follows: the number of users followed is heavy-tailed (Pareto) and the
+  followed users are drawn with Zipf weights, the lowest numbers being
+  the most popular, so a few users have most of the followers;
+- blocks: uniform random pairs;
+- tickets: heavy-tailed per author, reviews per ticket around a mean,
+  titles and texts drawn from a small vocabulary (for search), dates
+  spread over the last SPAN_DAYS days;
+- optional covers: a few generated images shared by the tickets, with
+  their renditions.
+
+Rows are written with reviews.bulk, then the derived data is refreshed.
+"""
+import random
+import time
+from collections import Counter
+from datetime import timedelta
+from io import BytesIO
+from itertools import accumulate
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image
+
+from . import bulk, images, uploads
+from .models import Review, Ticket
+
+PASSWORD = "litrevu-synthetic"
+SPAN_DAYS = 90
+ZIPF_EXPONENT = 1.1
+PARETO_SHAPE = 2.0
+COVER_VARIANTS = 8
+WORDS = (
+    "roman", "poésie", "histoire", "science", "voyage", "mémoire", "nuit",
+    "mer", "ville", "guerre", "amour", "enfance", "exil", "jardin", "secret",
+    "lumière", "silence", "dune", "étoile", "forêt", "rivière", "montagne",
+    "hiver", "été", "famille", "mystère", "enquête", "révolution", "rêve",
+    "machine", "temps", "musique", "ombre", "empire", "île", "désert",
+    "lettre", "chemin", "feu", "océan", "vertige", "printemps", "miroir",
+    "frontière", "royaume", "naufrage", "promesse", "destin", "colère",
+)
+
+
+def username(prefix, index):
+    return f"{prefix}{index:06d}"
+
+
+def _heavy_tailed(rng, mean, cap):
+    """ Draw a count with the given mean from a Pareto law, capped """
+    scale = mean * (PARETO_SHAPE - 1) / PARETO_SHAPE
+    return min(cap, int(rng.paretovariate(PARETO_SHAPE) * scale))
+
+
+def _text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _covers(seed):
+    """ Store the shared cover images of a seed, with their renditions """
+    names = []
+    for variant in range(COVER_VARIANTS):
+        rng = random.Random(f"{seed}-{variant}")
+        image = Image.new("RGB", (800, 1200), tuple(
+            rng.randrange(256) for _ in range(3)))
+        buffer = BytesIO()
+        image.save(buffer, "JPEG", quality=85)
+        name = default_storage.save(
+            f"tickets/synthetic-{seed}-{variant}.jpg",
+            ContentFile(buffer.getvalue()))
+        images.process_image(name)
+        names.append(name)
+    return names
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _add_dated(total, dated, kind, batch_size):
+    """
+    Insert (post, time_created) pairs of one kind: bulk_create sets the
+    auto_now_add dates, they are then backdated.
+    """
+    model = Ticket if kind == "tickets" else Review
+    for chunk in _chunks(dated, batch_size):
+        posts = [post for post, _ in chunk]
+        total.merge(bulk.add_posts(**{kind: posts}, batch_size=batch_size))
+        for post, date in chunk:
+            post.time_created = date
+        model.objects.bulk_update(posts, ["time_created"],
+                                  batch_size=batch_size)
+
+
+def generate(users, seed=0, follows=20, blocks=0.2, tickets=3, reviews=2,
+             covers=0.0, prefix="synth", batch_size=bulk.BATCH_SIZE):
+    """
+    Create a population of users (follows, blocks, tickets and reviews
+    being means per user or per ticket, covers the share of tickets with
+    an image) and return the created rows by kind with the elapsed time.
+    """
+    start = time.perf_counter()
+    rng = random.Random(seed)
+    User = get_user_model()
+    password = make_password(PASSWORD)
+    total = bulk.BulkResult()
+    created = {}
+
+    people = [User(username=username(prefix, index), password=password)
+              for index in range(users)]
+    for chunk in _chunks(people, batch_size):
+        total.merge(bulk.add_users(chunk, batch_size=batch_size))
+    ids = [user.pk for user in people]
+    created["users"] = len(ids)
+
+    popularity = list(accumulate(1 / (rank + 1) ** ZIPF_EXPONENT
+                                 for rank in range(users)))
+    block_edges = [(ids[rng.randrange(users)], ids[rng.randrange(users)])
+                   for _ in range(int(users * blocks))]
+    edges = []
+    for follower in range(users):
+        degree = _heavy_tailed(rng, follows, users - 1)
+        targets = set(rng.choices(range(users), cum_weights=popularity,
+                                  k=degree))
+        edges.extend((ids[follower], ids[target]) for target in
+                     sorted(targets) if target != follower)
+    # blocks first: follows towards a blocker are skipped like in the app
+    for kind, operation, pairs in (("blocks", bulk.add_blocks, block_edges),
+                                   ("follows", bulk.add_follows, edges)):
+        created[kind] = 0
+        for chunk in _chunks(pairs, batch_size):
+            result = operation(chunk, batch_size=batch_size)
+            created[kind] += result.created
+            total.merge(result)
+
+    now = timezone.now()
+    span = timedelta(days=SPAN_DAYS).total_seconds()
+    names = _covers(seed) if covers and users else []
+    tickets_dated = []
+    for author in range(users):
+        for _ in range(_heavy_tailed(rng, tickets, 1000)):
+            ticket = Ticket(
+                user_id=ids[author], title=_text(rng, 3).capitalize(),
+                description=_text(rng, rng.randint(10, 40)),
+                image=rng.choice(names) if rng.random() < covers else None)
+            tickets_dated.append(
+                (ticket, now - timedelta(seconds=rng.random() * span)))
+    _add_dated(total, tickets_dated, "tickets", batch_size)
+    created["tickets"] = len(tickets_dated)
+    # each cover was saved once, for as many tickets (reviews.uploads)
+    uses = Counter(ticket.image.name for ticket, _ in tickets_dated
+                   if ticket.image)
+    for name, count in uses.items():
+        if count > 1:
+            uploads.retain(name, count - 1)
+
+    reviews_dated = []
+    for ticket, date in tickets_dated:
+        count = min(users, round(rng.expovariate(1 / reviews))) \
+            if reviews else 0
+        reviewers = set(rng.choices(range(users), cum_weights=popularity,
+                                    k=count))
+        for reviewer in sorted(reviewers):
+            review = Review(
+                ticket_id=ticket.pk, user_id=ids[reviewer],
+                rating=rng.randint(0, 5), headline=_text(rng, 4).capitalize(),
+                body=_text(rng, rng.randint(20, 80)))
+            reviews_dated.append(
+                (review, date + (now - date) * rng.random()))
+    _add_dated(total, reviews_dated, "reviews", batch_size)
+    created["reviews"] = len(reviews_dated)
+
+    bulk.refresh(total)
+    return {**created, "seconds": round(time.perf_counter() - start, 3)}
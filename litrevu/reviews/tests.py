@@ -1,3 +1,1903 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import zlib
+from datetime import timedelta
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.handlers.asgi import ASGIHandler
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.utils import load_backend
+from django.db.models.signals import post_delete
+from django.http import HttpResponse, StreamingHttpResponse
+from django.template.base import Template
+from django.test import AsyncClient, RequestFactory, TestCase, \
+    TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from authentication.backends import CachedModelBackend
+from litrevu import compression, db, instrumentation, ratelimit, routers, \
+    staticfiles
+from PIL import Image
+
+from . import api, async_views, bulk, cards, counters, deletion, feed, \
+    images, search, synthetic, uploads, versions, views
+from .autocomplete import UsernameIndex, normalize, username_index
+from .graph import SocialGraph, social_graph
+from .management.commands.benchmark_asgi import routing
+from .models import (DeletionJob, FeedEntry, ImageRendition, Review, StoredFile, Ticket, UserBlocked,
+                     UserFollow)
+
+User = get_user_model()
+
+
+def make_ticket(user, title="Ticket", minutes=0):
+    """ Create a ticket, time_created shifted by minutes """
+    ticket = Ticket.objects.create(title=title, description="", user=user)
+    if minutes:
+        Ticket.objects.filter(pk=ticket.pk).update(
+            time_created=ticket.time_created + timedelta(minutes=minutes))
+        ticket.refresh_from_db()
+    return ticket
+
+
+def make_review(user, ticket, headline="Review", minutes=0):
+    """ Create a review, time_created shifted by minutes """
+    review = Review.objects.create(ticket=ticket, user=user, rating=3,
+                                   headline=headline)
+    if minutes:
+        Review.objects.filter(pk=review.pk).update(
+            time_created=review.time_created + timedelta(minutes=minutes))
+        review.refresh_from_db()
+    return review
+
+
+class FeedEngineTests(TestCase):
+    """ Tests for the keyset-paginated feed engine """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+        cls.carol = User.objects.create_user("carol", password="pwd")
+        UserFollow.objects.create(user=cls.alice, following_user=cls.bob)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_visible_posts_follow_and_block_rules(self):
+        own = make_ticket(self.alice, "own")
+        followed = make_ticket(self.bob, "followed")
+        stranger = make_ticket(self.carol, "stranger")
+        answer = make_review(self.carol, own, "answer")
+        make_review(self.carol, stranger, "hidden")
+
+        tickets, reviews = feed.visible_posts(self.alice)
+        self.assertCountEqual(tickets, [own, followed])
+        self.assertCountEqual(reviews, [answer])
+
+        UserBlocked.objects.create(user=self.carol, blocked_user=self.alice)
+        tickets, reviews = feed.visible_posts(self.alice)
+        self.assertCountEqual(reviews, [])
+
+    def test_pages_are_ordered_and_complete(self):
+        expected = []
+        for i in range(7):
+            ticket = make_ticket(self.bob, f"t{i}", minutes=2 * i)
+            review = make_review(self.alice, ticket, f"r{i}", minutes=2 * i + 1)
+            expected += [ticket, review]
+        expected.reverse()
+
+        tickets, reviews = feed.visible_posts(self.alice)
+        seen, cursor = [], None
+        while True:
+            page = feed.paginate(tickets, reviews, cursor=cursor, page_size=4)
+            self.assertLessEqual(len(page.posts), 4)
+            seen += page.posts
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        self.assertEqual([(p.content_type, p.pk) for p in seen],
+                         [(type(p).__name__.lower(), p.pk) for p in expected])
+
+    def test_tickets_carry_reviewed_state(self):
+        reviewed = make_ticket(self.bob, "reviewed")
+        make_review(self.carol, reviewed)
+        open_ticket = make_ticket(self.bob, "open")
+        posts = feed.hydrate([("ticket", reviewed.pk), ("ticket", open_ticket.pk)])
+        self.assertEqual([post.is_reviewed for post in posts], [True, False])
+
+    def test_invalid_cursor_is_first_page(self):
+        self.assertIsNone(feed.decode_cursor("not a cursor"))
+        now = timezone.now()
+        self.assertEqual(
+            feed.decode_cursor(feed.encode_cursor(now, "ticket", 12)),
+            (now, "ticket", 12))
+
+    def test_equal_times_across_kinds(self):
+        tickets = [make_ticket(self.bob, f"t{i}") for i in range(3)]
+        reviews = [make_review(self.alice, ticket, f"r{i}")
+                   for i, ticket in enumerate(tickets)]
+        now = timezone.now()
+        Ticket.objects.update(time_created=now)
+        Review.objects.update(time_created=now)
+        expected = [("review", r.pk) for r in reversed(reviews)] \
+            + [("ticket", t.pk) for t in reversed(tickets)]
+
+        tickets, reviews = feed.visible_posts(self.alice)
+        for paginate in (feed.paginate, async_to_sync(feed.apaginate)):
+            with self.subTest(paginate=paginate):
+                seen, cursor = [], None
+                while True:
+                    page = paginate(tickets, reviews, cursor=cursor,
+                                    page_size=2)
+                    seen += [(p.content_type, p.pk) for p in page.posts]
+                    cursor = page.next_cursor
+                    if cursor is None:
+                        break
+                self.assertEqual(seen, expected)
+
+    def test_feed_view_paginates(self):
+        for i in range(feed.FEED_PAGE_SIZE + 1):
+            make_ticket(self.bob, f"t{i}", minutes=i)
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse("reviews:feed"))
+        self.assertEqual(len(response.context["list_posts"]),
+                         feed.FEED_PAGE_SIZE)
+        cursor = response.context["next_cursor"]
+        response = self.client.get(reverse("reviews:feed"), {"cursor": cursor})
+        self.assertEqual(len(response.context["list_posts"]), 1)
+        self.assertIsNone(response.context["next_cursor"])
+
+
+class TimelineTests(TestCase):
+    """ Tests for the materialized timeline kept in sync by signals """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+        cls.carol = User.objects.create_user("carol", password="pwd")
+        UserFollow.objects.create(user=cls.alice, following_user=cls.bob)
+
+    def timeline_posts(self, user):
+        return feed.timeline(user, page_size=100).posts
+
+    def assertInSync(self):
+        for user in User.objects.all():
+            self.assertEqual(feed.timeline_drift(user), (set(), set()))
+
+    def test_posts_fan_out_and_retract(self):
+        ticket = make_ticket(self.bob)
+        review = make_review(self.carol, ticket)
+        self.assertEqual(self.timeline_posts(self.alice), [review, ticket])
+        self.assertEqual(self.timeline_posts(self.carol), [review])
+        self.assertInSync()
+
+        ticket.delete()
+        self.assertEqual(self.timeline_posts(self.alice), [])
+        self.assertFalse(FeedEntry.objects.exists())
+
+    def test_graph_changes_rebuild_timelines(self):
+        ticket = make_ticket(self.carol)
+        self.assertEqual(self.timeline_posts(self.alice), [])
+
+        follow = UserFollow.objects.create(user=self.alice,
+                                           following_user=self.carol)
+        self.assertEqual(self.timeline_posts(self.alice), [ticket])
+
+        block = UserBlocked.objects.create(user=self.carol,
+                                           blocked_user=self.alice)
+        self.assertEqual(self.timeline_posts(self.alice), [])
+        block.delete()
+        self.assertEqual(self.timeline_posts(self.alice), [ticket])
+        follow.delete()
+        self.assertEqual(self.timeline_posts(self.alice), [])
+        self.assertInSync()
+
+    def test_graph_changes_touch_only_related_posts(self):
+        bob_ticket = make_ticket(self.bob)
+        carol_ticket = make_ticket(self.carol)
+        review = make_review(self.bob, carol_ticket)
+        kept = FeedEntry.objects.get(owner=self.alice, object_id=bob_ticket.pk,
+                                     content_type__model="ticket")
+        with mock.patch.object(feed, "rebuild_timeline") as rebuild:
+            follow = UserFollow.objects.create(user=self.alice,
+                                               following_user=self.carol)
+            self.assertCountEqual(self.timeline_posts(self.alice),
+                                  [review, bob_ticket, carol_ticket])
+            follow.delete()
+            # bob's review of carol's ticket is still visible through bob
+            self.assertCountEqual(self.timeline_posts(self.alice),
+                                  [review, bob_ticket])
+        rebuild.assert_not_called()
+        self.assertTrue(FeedEntry.objects.filter(pk=kept.pk).exists())
+        self.assertInSync()
+
+    def test_user_deletion(self):
+        make_ticket(self.bob)
+        alice_id = self.alice.pk
+        self.alice.delete()
+        self.assertFalse(FeedEntry.objects.filter(owner=alice_id).exists())
+        self.assertInSync()
+
+    def test_rebuild_feed_command(self):
+        make_ticket(self.bob)
+        FeedEntry.objects.all().delete()
+        with self.assertRaises(CommandError):
+            call_command("rebuild_feed", "--check", stdout=StringIO())
+        call_command("rebuild_feed", stdout=StringIO())
+        call_command("rebuild_feed", "--check", stdout=StringIO())
+        self.assertEqual(len(self.timeline_posts(self.alice)), 1)
+
+
+@skipUnlessDBFeature("supports_explaining_query_execution")
+class IndexUsageTests(TestCase):
+    """ The feed, posts, follow and search queries use the declared indexes """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+        UserFollow.objects.create(user=cls.alice, following_user=cls.bob)
+
+    def assertUsesIndex(self, queryset, index):
+        if connection.vendor != "sqlite":
+            self.skipTest("EXPLAIN QUERY PLAN output is SQLite specific")
+        plan = queryset.explain()
+        self.assertIn(f"INDEX {index}", plan)
+
+    def test_timeline_range_scan(self):
+        entries = FeedEntry.objects.filter(owner=self.alice) \
+            .order_by('-time_created', '-id')
+        self.assertUsesIndex(entries, "feedentry_owner_timeline")
+
+    def test_posts_of_users(self):
+        tickets, reviews = feed.visible_posts(self.alice)
+        self.assertUsesIndex(tickets.order_by('-time_created'),
+                             "ticket_user_time_idx")
+        self.assertUsesIndex(
+            Review.objects.filter(user=self.alice).order_by('-time_created'),
+            "review_user_time_idx")
+
+    def test_reviews_of_tickets(self):
+        self.assertUsesIndex(
+            Review.objects.filter(ticket__in=[1, 2, 3], user=self.alice),
+            "review_ticket_user_idx")
+
+    def test_graph_reverse_lookups(self):
+        self.assertUsesIndex(
+            UserBlocked.objects.filter(blocked_user=self.alice)
+            .values_list('user', flat=True),
+            "userblocked_reverse_idx")
+        self.assertUsesIndex(
+            User.objects.filter(following__following_user=self.alice),
+            "userfollow_reverse_idx")
+
+    def test_search_user_exclusions(self):
+        followed_ids = UserFollow.objects.filter(user=self.alice) \
+            .values_list('following_user_id', flat=True)
+        plan = User.objects.exclude(pk__in=followed_ids).explain()
+        self.assertNotIn("SCAN reviews_userfollow", plan)
+
+
+class QueryCountTests(TestCase):
+    """ A feed or posts page costs a constant number of queries """
+
+    SIZES = (10, 100, 1000)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+        cls.carol = User.objects.create_user("carol", password="pwd")
+        UserFollow.objects.create(user=cls.alice, following_user=cls.bob)
+        UserFollow.objects.create(user=cls.alice, following_user=cls.carol)
+
+    def setUp(self):
+        cache.clear()
+        # content types are cached per process, load them once
+        ContentType.objects.get_for_models(Ticket, Review)
+        self.client.force_login(self.alice)
+        # the session and request.user then come from the cache
+        CachedModelBackend().get_user(self.alice.pk)
+
+    def grow(self, size):
+        """
+        Bring the feed of alice to size posts, alternating tickets (by bob
+        or alice) and reviews (by carol or alice), then rebuild it since
+        bulk_create skips signals.
+        """
+        count = Ticket.objects.count() + Review.objects.count()
+        for i in range(count // 2, size // 2):
+            author = self.alice if i % 2 else self.bob
+            reviewer = self.carol if i % 2 else self.alice
+            ticket, = Ticket.objects.bulk_create(
+                [Ticket(title=f"t{i}", description="", user=author)])
+            Review.objects.bulk_create(
+                [Review(ticket=ticket, rating=i % 6, headline=f"r{i}",
+                        user=reviewer)])
+        feed.rebuild_timeline(self.alice)
+
+    def test_feed_page(self):
+        for size in self.SIZES:
+            self.grow(size)
+            with self.subTest(size=size), self.assertNumQueries(3):
+                self.client.get(reverse("reviews:feed"))
+
+    def test_posts_page(self):
+        for size in self.SIZES:
+            self.grow(size)
+            with self.subTest(size=size), self.assertNumQueries(3):
+                self.client.get(reverse("reviews:posts"))
+
+
+class CardCacheTests(TestCase):
+    """ Tests for the fragment cache of the feed post cards """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+        UserFollow.objects.create(user=cls.alice, following_user=cls.bob)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cards_rendered_once(self):
+        ticket = make_ticket(self.bob, "Dune")
+        make_review(self.alice, make_ticket(self.alice))
+        posts = feed.timeline(self.alice).posts
+        with mock.patch.object(cards, "render_to_string",
+                               wraps=cards.render_to_string) as render:
+            first = cards.render_cards(posts, self.alice)
+            second = cards.render_cards(posts, self.alice)
+        self.assertEqual(render.call_count, len(posts))
+        self.assertEqual(first, second)
+        self.assertIn("bob a demandé une critique", first[-1])
+        self.assertIn("Dune", first[-1])
+        own_card, = cards.render_cards([posts[-1]], self.bob)
+        self.assertIn("Vous avez demandé une critique", own_card)
+        self.assertIn(ticket.title, own_card)
+
+    def test_update_view_invalidates(self):
+        ticket = make_ticket(self.alice, "Before")
+        self.client.force_login(self.alice)
+        self.assertContains(self.client.get(reverse("reviews:feed")), "Before")
+        self.client.post(reverse("reviews:ticket_modify", args=[ticket.pk]),
+                         {"title": "After", "description": "changed"})
+        response = self.client.get(reverse("reviews:feed"))
+        self.assertContains(response, "After")
+        self.assertNotContains(response, "Before")
+
+    def test_renamed_author_changes_cards(self):
+        make_review(self.alice, make_ticket(self.bob, "Dune"))
+        self.client.force_login(self.alice)
+        self.assertContains(self.client.get(reverse("reviews:feed")),
+                            "bob a demandé")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bob.username = "robert"
+            self.bob.save()
+        response = self.client.get(reverse("reviews:feed"))
+        self.assertContains(response, "robert a demandé")
+        self.assertNotContains(response, "bob a demandé")
+        self.assertNotContains(response, "bob")
+
+    def test_delete_view_invalidates(self):
+        ticket = make_ticket(self.alice, "Gone")
+        posts = feed.timeline(self.alice).posts
+        cards.render_cards(posts, self.alice)
+        key = cards.card_key(posts[0], True, False)
+        self.assertIsNotNone(cache.get(key))
+        self.client.force_login(self.alice)
+        self.client.post(reverse("reviews:ticket_delete", args=[ticket.pk]))
+        self.assertIsNone(cache.get(key))
+        self.assertIsNotNone(Ticket.objects.get().deleted_at)
+        self.assertEqual(feed.timeline(self.alice).posts, [])
+
+
+class SocialGraphTests(TestCase):
+    """ Tests for the cached social graph service """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+        cls.carol = User.objects.create_user("carol", password="pwd")
+        UserFollow.objects.create(user=cls.alice, following_user=cls.bob)
+        UserFollow.objects.create(user=cls.carol, following_user=cls.alice)
+        UserBlocked.objects.create(user=cls.bob, blocked_user=cls.carol)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_sets(self):
+        graph = SocialGraph()
+        self.assertEqual(graph.following(self.alice), {self.bob.pk})
+        self.assertEqual(graph.followers(self.alice), {self.carol.pk})
+        self.assertEqual(graph.blocking(self.bob), {self.carol.pk})
+        self.assertEqual(graph.blocked_by(self.carol), {self.bob.pk})
+        self.assertEqual(graph.blocking(self.alice), set())
+
+    def test_warm_cache_costs_no_query(self):
+        graph = SocialGraph()
+        with self.assertNumQueries(4):
+            graph.warm([self.alice.pk, self.bob.pk, self.carol.pk])
+        with self.assertNumQueries(0):
+            graph.followers(self.alice)
+            graph.blocking(self.bob)
+            graph.warm([self.alice.pk, self.carol.pk])
+        self.assertEqual(graph.stats()["misses"], 3)
+        self.assertEqual(graph.stats()["hits"], 4)
+
+    def post(self, url, data=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, data)
+
+    def test_views_invalidate(self):
+        self.client.force_login(self.alice)
+        social_graph.warm([self.alice.pk, self.carol.pk])
+        self.post(reverse("reviews:follow_user"), {"username": "carol"})
+        self.assertIn(self.carol.pk, social_graph.following(self.alice))
+        self.assertIn(self.alice.pk, social_graph.followers(self.carol))
+
+        self.post(reverse("reviews:blocked_user", args=[self.carol.pk]))
+        self.assertIn(self.carol.pk, social_graph.blocking(self.alice))
+        self.assertNotIn(self.carol.pk, social_graph.followers(self.alice))
+        response = self.client.get(reverse("reviews:search_user"), {"q": "c"})
+        self.assertEqual(response.json(), [])
+
+        self.post(reverse("reviews:unblocked_user", args=[self.carol.pk]))
+        self.assertEqual(social_graph.blocking(self.alice), set())
+        self.post(reverse("reviews:unfollow_user", args=[self.bob.pk]))
+        self.assertEqual(social_graph.following(self.alice), {self.carol.pk})
+        response = self.client.get(reverse("reviews:follow"))
+        self.assertEqual(response.context["followed_users"], [self.carol])
+
+    def test_orm_writes_invalidate_once_committed(self):
+        social_graph.warm([self.alice.pk, self.bob.pk, self.carol.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            UserBlocked.objects.create(user=self.alice, blocked_user=self.bob)
+            # still the committed state until then
+            self.assertEqual(social_graph.blocking(self.alice), set())
+        self.assertEqual(social_graph.blocking(self.alice), {self.bob.pk})
+        with self.captureOnCommitCallbacks(execute=True):
+            UserFollow.objects.filter(user=self.carol).delete()
+            UserBlocked.objects.filter(user=self.bob).delete()
+        self.assertEqual(social_graph.followers(self.alice), set())
+        self.assertEqual(social_graph.blocked_by(self.carol), set())
+
+
+def image_file(width, height, image_format="PNG"):
+    """ Return a ContentFile holding a generated image """
+    buffer = BytesIO()
+    mode = "RGB" if image_format == "JPEG" else "RGBA"
+    Image.new(mode, (width, height), "orange").save(buffer, image_format)
+    return ContentFile(buffer.getvalue())
+
+
+class ImagePipelineTests(TestCase):
+    """ Tests for the image rendition pipeline """
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        cache.clear()
+        self.alice = User.objects.create_user("alice", password="pwd")
+
+    def test_renditions_widths_and_dimensions(self):
+        name = default_storage.save("tickets/cover.png", image_file(800, 400))
+        renditions = images.process_image(name)
+        self.assertEqual(
+            sorted({(r.width, r.height) for r in renditions}),
+            [(160, 80), (320, 160), (640, 320)])
+        self.assertEqual({r.format for r in renditions},
+                         set(images.rendition_formats()))
+        with default_storage.open(renditions[0].file.name) as file:
+            self.assertEqual(Image.open(file).size,
+                             (renditions[0].width, renditions[0].height))
+        # already built: nothing new
+        self.assertEqual(len(images.process_image(name)), len(renditions))
+        self.assertEqual(ImageRendition.objects.count(), len(renditions))
+
+    def test_small_image_not_upscaled(self):
+        name = default_storage.save("avatars/me.png", image_file(100, 50))
+        widths = {r.width for r in images.process_image(name)}
+        self.assertEqual(widths, {100})
+
+    def test_upload_schedules_after_commit(self):
+        executor = mock.Mock()
+        with mock.patch.object(images, "_get_executor",
+                               return_value=executor), \
+                self.captureOnCommitCallbacks(execute=True):
+            ticket = Ticket.objects.create(
+                title="t", description="", user=self.alice,
+                image=default_storage.save("tickets/t.png",
+                                           image_file(50, 50)))
+        executor.submit.assert_called_once_with(images._run,
+                                                ticket.image.name)
+
+    def test_feed_serves_renditions(self):
+        ticket = Ticket.objects.create(
+            title="t", description="", user=self.alice,
+            image=default_storage.save("tickets/t.png", image_file(400, 300)))
+        self.client.force_login(self.alice)
+        self.assertNotContains(self.client.get(reverse("reviews:feed")),
+                               "<picture>")
+        images.process_image(ticket.image.name)
+        response = self.client.get(reverse("reviews:feed"))
+        self.assertContains(response, "<picture>")
+        self.assertContains(response, 'width="320" height="240"')
+
+    def test_build_renditions_command(self):
+        name = default_storage.save("tickets/old.jpg",
+                                    image_file(700, 700, "JPEG"))
+        call_command("build_renditions", "--workers", "1", stdout=StringIO())
+        self.assertEqual(
+            set(ImageRendition.objects.values_list("source", flat=True)),
+            {name})
+
+
+class SearchTests(TestCase):
+    """ Tests for the full-text search of tickets and reviews """
+
+    backend = search.SQLiteFTSBackend()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+        cls.carol = User.objects.create_user("carol", password="pwd")
+        UserFollow.objects.create(user=cls.alice, following_user=cls.bob)
+        cls.dune = Ticket.objects.create(
+            title="Dune", description="Un classique de la science-fiction",
+            user=cls.bob)
+        cls.review = Review.objects.create(
+            ticket=cls.dune, user=cls.bob, rating=5,
+            headline="Épique", body="Arrakis et l'épice, la science-fiction")
+        cls.hidden = Ticket.objects.create(
+            title="Fondation", description="science-fiction aussi",
+            user=cls.carol)
+
+    def setUp(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("FTS5 index is SQLite specific")
+        cache.clear()
+
+    def keys(self, user, query, backend=None):
+        return (backend or self.backend).search(user, query)
+
+    def test_ranked_and_visible(self):
+        self.assertEqual(self.keys(self.alice, "dune"),
+                         [("ticket", self.dune.pk)])
+        # the headline weighs more than the body
+        self.assertEqual(self.keys(self.alice, "epique science"),
+                         [("review", self.review.pk)])
+        self.assertCountEqual(
+            self.keys(self.alice, "science"),
+            [("ticket", self.dune.pk), ("review", self.review.pk)])
+        self.assertEqual(self.keys(self.carol, "science"),
+                         [("ticket", self.hidden.pk)])
+
+    def test_prefix_and_syntax(self):
+        self.assertEqual(self.keys(self.alice, "arra"),
+                         [("review", self.review.pk)])
+        self.assertEqual(self.keys(self.alice, 'dune" OR NEAR('),
+                         [])
+        self.assertEqual(self.keys(self.alice, "  "), [])
+
+    def test_index_follows_writes(self):
+        self.dune.title = "Dune Messiah"
+        self.dune.save()
+        self.assertEqual(self.keys(self.alice, "messiah"),
+                         [("ticket", self.dune.pk)])
+        self.review.delete()
+        self.assertEqual(self.keys(self.alice, "arrakis"), [])
+        UserBlocked.objects.create(user=self.bob, blocked_user=self.alice)
+        self.assertEqual(self.keys(self.alice, "dune"), [])
+
+    def test_rebuild_and_simple_backend(self):
+        self.backend.rebuild()
+        self.assertEqual(len(self.keys(self.alice, "science")), 2)
+        simple = search.SimpleBackend()
+        self.assertCountEqual(self.keys(self.alice, "science", simple),
+                              self.keys(self.alice, "science"))
+
+    def test_search_view(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse("reviews:search"), {"q": "dune"})
+        self.assertContains(response, "Un classique")
+        self.assertNotContains(response, "Fondation")
+
+
+class PostgresSearchTests(TestCase):
+    """ Tests for the tsvector search of PostgreSQL """
+
+    backend = search.PostgresBackend()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+        UserFollow.objects.create(user=cls.alice, following_user=cls.bob)
+        cls.dune = Ticket.objects.create(
+            title="Dune", description="Un classique de la science-fiction",
+            user=cls.bob)
+        cls.review = Review.objects.create(
+            ticket=cls.dune, user=cls.bob, rating=5,
+            headline="Arrakis", body="Dune et l'épice")
+
+    def setUp(self):
+        if connection.vendor != "postgresql":
+            self.skipTest("tsvector search is PostgreSQL specific")
+
+    def test_ranked_prefix_search(self):
+        self.assertIsInstance(search.get_backend(), search.PostgresBackend)
+        # the title weighs more than the body
+        self.assertEqual(self.backend.search(self.alice, "dune"),
+                         [("ticket", self.dune.pk), ("review", self.review.pk)])
+        self.assertEqual(self.backend.search(self.alice, "arra"),
+                         [("review", self.review.pk)])
+        self.assertEqual(self.backend.search(self.alice, "dune' | !x"),
+                         [])
+        self.assertEqual(self.backend.search(self.alice, "  "), [])
+
+    def test_uses_the_gin_index(self):
+        with connection.cursor() as cursor:
+            # the tables are too small for the planner to prefer an index
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        plan = Ticket.objects.annotate(
+            document=search.post_vector('title', 'description'),
+        ).filter(document=self.backend.search_query("dune")).explain()
+        self.assertIn("ticket_search_idx", plan)
+
+
+class AutocompleteTests(TestCase):
+    """ Tests for the username prefix index and search_user """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.albert = User.objects.create_user("Albert", password="pwd")
+        cls.aline = User.objects.create_user("Éline", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+
+    def setUp(self):
+        cache.clear()
+
+    def usernames(self, index, prefix, **kwargs):
+        return [data["username"] for data in index.complete(prefix, **kwargs)]
+
+    def test_prefix_matches(self):
+        index = UsernameIndex()
+        self.assertEqual(normalize("Éline"), "eline")
+        self.assertEqual(self.usernames(index, "al"), ["Albert", "alice"])
+        self.assertEqual(self.usernames(index, "EL"), ["Éline"])
+        self.assertEqual(self.usernames(index, "al", limit=1), ["Albert"])
+        self.assertEqual(
+            self.usernames(index, "al", exclude={self.albert.pk}), ["alice"])
+        self.assertEqual(self.usernames(index, "lice"), [])
+
+    def test_incremental_updates(self):
+        index = UsernameIndex()
+        other = UsernameIndex()
+        self.usernames(other, "a")
+        with mock.patch("reviews.signals.username_index", index):
+            self.usernames(index, "a")
+            with self.captureOnCommitCallbacks(execute=True):
+                carla = User.objects.create_user("alcarla", password="pwd")
+                # applied once committed
+                self.assertEqual(self.usernames(index, "alc"), [])
+            with self.assertNumQueries(0):
+                self.assertIn("alcarla", self.usernames(index, "alc"))
+            carla.username = "carla"
+            with self.captureOnCommitCallbacks(execute=True):
+                carla.save()
+            self.assertEqual(self.usernames(index, "alc"), [])
+            self.assertEqual(self.usernames(index, "car"), ["carla"])
+            with self.captureOnCommitCallbacks(execute=True):
+                carla.delete()
+            self.assertEqual(self.usernames(index, "car"), [])
+        # another process notices the shared version and rebuilds
+        self.assertEqual(self.usernames(other, "car"), [])
+
+    def test_rolled_back_writes_leave_the_index(self):
+        index = UsernameIndex()
+        self.usernames(index, "a")
+        with mock.patch("reviews.signals.username_index", index):
+            with self.assertRaises(ValueError), transaction.atomic():
+                User.objects.create_user("alphantom", password="pwd")
+                self.bob.username = "alrobert"
+                self.bob.save()
+                raise ValueError
+        self.assertEqual(self.usernames(index, "alp"), [])
+        self.assertEqual(self.usernames(index, "alr"), [])
+        self.assertEqual(self.usernames(index, "b"), ["bob"])
+
+    def test_unrelated_saves_keep_the_index(self):
+        with mock.patch("reviews.signals.username_index") as index, \
+                mock.patch.object(versions, "bump") as bump, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.bob.set_password("other")
+            self.bob.save()
+            self.bob.first_name = "Bob"
+            self.bob.save()
+            index.update.assert_not_called()
+            bump.assert_not_called()
+            self.bob.username = "robert"
+            self.bob.save()
+        index.update.assert_called_once_with(self.bob)
+        bump.assert_called_once()
+
+    def test_search_user_view(self):
+        username_index.build()
+        UserFollow.objects.create(user=self.alice, following_user=self.albert)
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse("reviews:search_user"),
+                                   {"q": "Al"})
+        self.assertEqual(response.json(), [])
+        self.assertIn("max-age=30", response["Cache-Control"])
+        self.assertIn("private", response["Cache-Control"])
+        response = self.client.get(reverse("reviews:search_user"),
+                                   {"q": "b"})
+        self.assertEqual([user["username"] for user in response.json()],
+                         ["bob"])
+
+
+class CounterTests(TestCase):
+    """ Tests for the denormalized counters """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+
+    def setUp(self):
+        cache.clear()
+
+    def counts(self, user):
+        user.refresh_from_db()
+        return user.follower_count, user.following_count, user.post_count
+
+    def test_stale_saves_keep_the_counters(self):
+        ticket = make_ticket(self.alice)
+        stale_alice = User.objects.get(pk=self.alice.pk)
+        make_review(self.bob, ticket)
+        UserFollow.objects.create(user=self.bob, following_user=self.alice)
+
+        self.client.force_login(self.alice)
+        response = self.client.post(
+            reverse("reviews:ticket_modify", args=[ticket.pk]),
+            {"title": "Renamed", "description": "d"})
+        self.assertEqual(response.status_code, 302)
+        ticket.title = "Stale"
+        ticket.save()
+        stale_alice.first_name = "Alice"
+        stale_alice.save()
+
+        ticket.refresh_from_db()
+        self.assertEqual((ticket.title, ticket.review_count,
+                          ticket.rating_sum), ("Stale", 1, 3))
+        self.assertEqual(self.counts(self.alice), (1, 0, 1))
+        self.assertEqual(self.alice.first_name, "Alice")
+
+    def test_writes_update_counters(self):
+        ticket = make_ticket(self.alice)
+        review = make_review(self.bob, ticket)
+        make_review(self.alice, ticket)
+        ticket.refresh_from_db()
+        self.assertEqual((ticket.review_count, ticket.rating_sum), (2, 6))
+        self.assertEqual(ticket.average_rating, 3)
+
+        review.rating = 5
+        review.save()
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.rating_sum, 8)
+        review.delete()
+        ticket.refresh_from_db()
+        self.assertEqual((ticket.review_count, ticket.rating_sum), (1, 3))
+
+        follow = UserFollow.objects.create(user=self.bob,
+                                           following_user=self.alice)
+        self.assertEqual(self.counts(self.alice), (1, 0, 2))
+        self.assertEqual(self.counts(self.bob), (0, 1, 0))
+        follow.delete()
+        self.assertEqual(self.counts(self.alice), (0, 0, 2))
+        self.assertEqual(self.counts(self.bob), (0, 0, 0))
+        self.assertEqual(counters.reconcile(check=True),
+                         {"Ticket": 0, "User": 0})
+
+    def test_reconcile_repairs_drift(self):
+        ticket = make_ticket(self.alice)
+        Review.objects.bulk_create([
+            Review(ticket=ticket, user=self.bob, rating=4, headline="a"),
+            Review(ticket=ticket, user=self.bob, rating=2, headline="b"),
+        ])
+        UserFollow.objects.bulk_create(
+            [UserFollow(user=self.bob, following_user=self.alice)])
+        with self.assertRaises(CommandError):
+            call_command("reconcile_counters", "--check", stdout=StringIO())
+        call_command("reconcile_counters", stdout=StringIO())
+        ticket.refresh_from_db()
+        self.assertEqual((ticket.review_count, ticket.rating_sum), (2, 6))
+        self.assertEqual(self.counts(self.alice), (1, 0, 1))
+        self.assertEqual(self.counts(self.bob), (0, 1, 2))
+        call_command("reconcile_counters", "--check", stdout=StringIO())
+
+    def test_feed_card_shows_aggregates(self):
+        ticket = make_ticket(self.bob, title="Dune")
+        make_review(self.bob, ticket)
+        UserFollow.objects.create(user=self.alice, following_user=self.bob)
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse("reviews:feed"))
+        self.assertContains(response, "1 critique - moyenne 3,0/5")
+
+
+class FeedApiTests(TestCase):
+    """ Tests for the streaming JSON feed """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+        UserFollow.objects.create(user=cls.alice, following_user=cls.bob)
+        cls.tickets = [make_ticket(cls.bob, title=f"T{i}", minutes=i)
+                       for i in range(5)]
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.alice)
+
+    def get(self, **params):
+        response = self.client.get(reverse("reviews:feed_api"), params)
+        self.assertTrue(response.streaming)
+        return response, json.loads(b"".join(response.streaming_content))
+
+    def test_streams_pages_across_batches(self):
+        chunks = list(api.stream_timeline(self.alice, limit=4, batch_size=3))
+        data = json.loads("".join(chunks))
+        self.assertEqual([post["title"] for post in data["results"]],
+                         ["T4", "T3", "T2", "T1"])
+        self.assertGreater(len(chunks), 4)
+
+        response, data = self.get(limit=3)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(len(data["results"]), 3)
+        self.assertEqual(data["results"][0]["user"]["username"], "bob")
+        _, data = self.get(limit=3, cursor=data["next_cursor"])
+        self.assertEqual([post["title"] for post in data["results"]],
+                         ["T1", "T0"])
+        self.assertIsNone(data["next_cursor"])
+
+    def test_conditional_get(self):
+        response, _ = self.get()
+        etag = response["ETag"]
+        response = self.client.get(reverse("reviews:feed_api"),
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            make_review(self.bob, self.tickets[0])
+        response = self.client.get(reverse("reviews:feed_api"),
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class TimelineVersionTests(TestCase):
+    """ Tests for the conditional responses of the timeline pages """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+        cls.carl = User.objects.create_user("carl", password="pwd")
+        UserFollow.objects.create(user=cls.alice, following_user=cls.bob)
+        cls.ticket = make_ticket(cls.bob)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.alice)
+
+    def etags(self):
+        return {name: self.client.get(reverse(f"reviews:{name}"))["ETag"]
+                for name in ("feed", "posts", "follow")}
+
+    def revisit(self, name, etag):
+        return self.client.get(reverse(f"reviews:{name}"),
+                               HTTP_IF_NONE_MATCH=etag).status_code
+
+    def test_revisit_answers_304_without_post_query(self):
+        etag = self.etags()["feed"]
+        # session and user come from the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(self.revisit("feed", etag), 304)
+        response = self.client.get(reverse("reviews:feed"),
+                                   {"cursor": "x"}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_writes_bump_the_version(self):
+        etags = self.etags()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ticket.title = "Edited"
+            self.ticket.save()
+        self.assertEqual(self.revisit("feed", etags["feed"]), 200)
+        self.assertEqual(self.revisit("follow", etags["follow"]), 200)
+
+        etags = self.etags()
+        with self.captureOnCommitCallbacks(execute=True):
+            make_ticket(self.carl)
+        self.assertEqual(self.revisit("feed", etags["feed"]), 304)
+        # bob's follower count, shown on alice's follow page, changes
+        with self.captureOnCommitCallbacks(execute=True):
+            UserFollow.objects.create(user=self.carl, following_user=self.bob)
+        self.assertEqual(self.revisit("follow", etags["follow"]), 200)
+
+    def test_pending_messages_get_a_full_response(self):
+        etag = self.etags()["feed"]
+        response = self.client.post(reverse("reviews:unfollow_user",
+                                            args=[self.bob.pk]))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.revisit("feed", etag), 200)
+
+
+class AsyncViewTests(TestCase):
+    """ Tests for the async views and their routing """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+        cls.albert = User.objects.create_user("albert", password="pwd")
+        UserFollow.objects.create(user=cls.alice, following_user=cls.bob)
+        for minutes in range(3):
+            ticket = make_ticket(cls.bob, title=f"T{minutes}",
+                                 minutes=minutes)
+            make_review(cls.alice, ticket, headline=f"R{minutes}",
+                        minutes=minutes)
+
+    def setUp(self):
+        cache.clear()
+        username_index.build()
+
+    def test_apaginate_matches_paginate(self):
+        tickets = Ticket.objects.all()
+        reviews = Review.objects.all()
+        cursor = None
+        while True:
+            expected = feed.paginate(tickets, reviews, cursor, page_size=4)
+            page = async_to_sync(feed.apaginate)(tickets, reviews, cursor,
+                                                 page_size=4)
+            self.assertEqual(page.posts, expected.posts)
+            self.assertEqual(page.next_cursor, expected.next_cursor)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+
+    async def test_async_views_render_the_same_pages(self):
+        client = AsyncClient()
+        await client.aforce_login(self.alice)
+        paths = [reverse("reviews:feed"), reverse("reviews:posts"),
+                 reverse("reviews:search_user") + "?q=al"]
+        expected = [await client.get(path) for path in paths]
+        with routing():
+            match = await sync_to_async(resolve)(reverse("reviews:feed"))
+            self.assertIs(match.func.view_class, async_views.AsyncFeedView)
+            responses = [await client.get(path) for path in paths]
+
+        def without_token(response):
+            # the csrf token is masked differently on every response
+            return re.sub(rb'name="csrfmiddlewaretoken" value="[^"]*"', b"",
+                          response.content)
+
+        for response, sync_response in zip(responses, expected):
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(without_token(response),
+                             without_token(sync_response))
+        self.assertIn("ETag", responses[0])
+        # measured by the async path of the instrumentation
+        self.assertRegex(responses[0]["Server-Timing"],
+                         r'desc="[1-9]\d* queries", render;dur=[\d.]+')
+
+    @override_settings(DEBUG=True)
+    def test_middleware_runs_on_the_event_loop(self):
+        # a sync only middleware would be adapted (logged) and move every
+        # request to a thread
+        with self.assertNoLogs("django.request", "DEBUG"):
+            ASGIHandler()
+
+    def test_async_follow_user(self):
+        self.client.force_login(self.alice)
+        with routing():
+            response = self.client.post(reverse("reviews:follow_user"),
+                                        {"username": "albert"})
+        self.assertEqual(response.json(), {"success": True})
+        self.assertTrue(UserFollow.objects.filter(
+            user=self.alice, following_user=self.albert).exists())
+
+
+class AsgiBenchmarkTests(TransactionTestCase):
+    """ Tests for the benchmark_asgi command, its threads commit """
+
+    def test_requests_are_not_rate_limited(self):
+        User.objects.create_user("alice", password="pwd")
+        cache.clear()
+        # 60 username searches, twice the autocomplete burst
+        out = StringIO()
+        call_command("benchmark_asgi", "--user", "alice", "--requests",
+                     "90", "--concurrency", "1", stdout=out)
+        self.assertIn("WSGI, sync views: 90 requests", out.getvalue())
+        self.assertIn("ASGI, async views: 90 requests", out.getvalue())
+
+
+class DatabaseProfileTests(TestCase):
+    """ Tests for the database profiles of litrevu.db """
+
+    def test_profiles_from_environment(self):
+        base_dir = Path("/srv/litrevu")
+        default = db.databases(base_dir, {})["default"]
+        self.assertEqual(default["NAME"], base_dir / "db.sqlite3")
+        # the checked-in database keeps its journal mode
+        self.assertNotIn("journal_mode", default["PRAGMAS"])
+        self.assertEqual(default["OPTIONS"]["transaction_mode"], "IMMEDIATE")
+        for environ in ({"LITREVU_SQLITE_WAL": "1"},
+                        {"LITREVU_SQLITE_PATH": "/srv/data/litrevu.sqlite3"}):
+            self.assertEqual(db.databases(base_dir, environ)["default"]
+                             ["PRAGMAS"]["journal_mode"], "WAL")
+        plain = db.databases(base_dir, {"LITREVU_SQLITE_TUNING": "0"})
+        self.assertNotIn("PRAGMAS", plain["default"])
+
+        pooled = db.databases(base_dir, {"LITREVU_DB": "postgres",
+                                         "POSTGRES_HOST": "db"})["default"]
+        self.assertEqual(pooled["HOST"], "db")
+        self.assertEqual(pooled["CONN_MAX_AGE"], 0)
+        self.assertEqual(pooled["OPTIONS"]["pool"]["max_size"], 10)
+        persistent = db.databases(base_dir, {
+            "LITREVU_DB": "postgres", "LITREVU_DB_POOL": "0",
+            "LITREVU_DB_CONN_MAX_AGE": "300"})["default"]
+        self.assertEqual(persistent["CONN_MAX_AGE"], 300)
+        self.assertTrue(persistent["CONN_HEALTH_CHECKS"])
+        with self.assertRaises(ImproperlyConfigured):
+            db.databases(base_dir, {"LITREVU_DB": "mysql"})
+
+    def connect(self, settings_dict, alias="profile"):
+        settings_dict = connections.configure_settings(
+            {DEFAULT_DB_ALIAS: settings_dict})[DEFAULT_DB_ALIAS]
+        wrapper = load_backend(settings_dict["ENGINE"]).DatabaseWrapper(
+            settings_dict, alias)
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def test_sqlite_hook_applies_pragmas(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        wrapper = self.connect(
+            db.sqlite_database(Path(directory) / "tuned.sqlite3"))
+        with wrapper.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            self.assertEqual(cursor.fetchone()[0], "wal")
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], 5000)
+
+    @skipUnless(os.environ.get("LITREVU_TEST_POSTGRES"),
+                "set LITREVU_TEST_POSTGRES=1 and POSTGRES_* to a disposable "
+                "server")
+    def test_postgres_pool(self):
+        wrapper = self.connect(db.postgres_database(os.environ))
+        for _ in range(3):
+            with wrapper.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                self.assertEqual(cursor.fetchone()[0], 1)
+            wrapper.close()
+        self.assertIsNotNone(wrapper.pool)
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    """ Tests for the replica router, with an SQLite file as replica """
+
+    @classmethod
+    def setUpClass(cls):
+        directory = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, directory, ignore_errors=True)
+        connections.settings["replica_1"] = connections.configure_settings({
+            DEFAULT_DB_ALIAS: db.replica(db.sqlite_database(
+                Path(directory) / "replica.sqlite3"))})[DEFAULT_DB_ALIAS]
+        cls.addClassCleanup(connections.settings.pop, "replica_1")
+        cls.addClassCleanup(connections.__delitem__, "replica_1")
+        cls.addClassCleanup(lambda: connections["replica_1"].close())
+        # set here: the test runner does not know the alias
+        cls.databases = {"default", "replica_1"}
+        super().setUpClass()
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice", password="pwd")
+        self.bob = User.objects.create_user("bob", password="pwd")
+        UserFollow.objects.create(user=self.alice, following_user=self.bob)
+        make_ticket(self.bob, title="Replicated")
+        self.assertEqual(db.refresh_sqlite_replicas(), ["replica_1"])
+        # written after the replication
+        make_ticket(self.bob, title="Lagging")
+        self.client.force_login(self.alice)
+
+    def test_router(self):
+        router = routers.ReplicaRouter()
+        self.assertEqual(router.db_for_read(Ticket), "default")
+        with routers.use_replica():
+            self.assertEqual(router.db_for_read(Ticket), "replica_1")
+            self.assertEqual(router.db_for_write(Ticket), "default")
+            self.assertEqual(Ticket.objects.count(), 1)
+        self.assertEqual(Ticket.objects.count(), 2)
+        self.assertFalse(router.allow_migrate("replica_1", "reviews"))
+
+    def test_read_views_use_the_replica_until_a_write(self):
+        middleware = routers.ReplicaMiddleware(None)
+
+        def reads_replica(name):
+            request = RequestFactory().get(reverse(name))
+            request.session = self.client.session
+            return middleware.reads_replica(request)
+
+        self.assertTrue(reads_replica("reviews:search_user"))
+        self.client.post(reverse("reviews:ticket_create"),
+                         {"title": "Mine", "description": "d"})
+        self.assertFalse(reads_replica("reviews:search_user"))
+
+    def test_timeline_pages_read_the_primary(self):
+        # the ETag names the current version: the page must hold its rows
+        response = self.client.get(reverse("reviews:feed"))
+        self.assertTrue(response.has_header("ETag"))
+        self.assertContains(response, "Lagging")
+        self.assertContains(self.client.get(reverse("reviews:feed_api")),
+                            "Lagging")
+        # even when marked for replica reads
+        with mock.patch.object(views.FeedView, "replica_reads", True,
+                               create=True):
+            response = self.client.get(reverse("reviews:feed"))
+        self.assertContains(response, "Lagging")
+
+
+class BulkTests(TestCase):
+    """ Tests for the bulk social graph operations and the importer """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(name, password="pwd")
+                     for name in ("alice", "bob", "carl", "dave")]
+        cls.alice, cls.bob, cls.carl, cls.dave = cls.users
+
+    def setUp(self):
+        cache.clear()
+
+    def assertInSync(self):
+        for user in self.users:
+            self.assertEqual(feed.timeline_drift(user), (set(), set()))
+        self.assertEqual(counters.reconcile(check=True),
+                         {"Ticket": 0, "User": 0})
+
+    def test_block_rules(self):
+        make_ticket(self.bob)
+        UserBlocked.objects.create(user=self.carl, blocked_user=self.alice)
+        result = bulk.follow(self.alice, [self.bob, self.carl, self.alice])
+        self.assertEqual((result.created, result.skipped), (1, 1))
+        bulk.follow(self.bob, [self.alice])
+        self.assertInSync()
+
+        result = bulk.block(self.alice, [self.bob])
+        self.assertEqual((result.created, result.deleted), (1, 1))
+        self.assertFalse(UserFollow.objects.filter(user=self.bob).exists())
+        self.assertTrue(UserFollow.objects.filter(user=self.alice).exists())
+        self.assertInSync()
+
+        bulk.unblock(self.alice, [self.bob])
+        result = bulk.unfollow(self.alice, [self.bob, self.dave])
+        self.assertEqual((result.deleted, result.skipped), (1, 1))
+        self.assertFalse(UserFollow.objects.exists())
+        self.assertInSync()
+
+    def test_delete_rows_by_batches(self):
+        UserFollow.objects.bulk_create(
+            UserFollow(user=self.alice, following_user=user)
+            for user in self.users[1:])
+        handler = mock.Mock()
+        post_delete.connect(handler, sender=UserFollow, weak=False)
+        self.addCleanup(post_delete.disconnect, handler, sender=UserFollow)
+        deleted = bulk.delete_rows(
+            UserFollow.objects.exclude(following_user=self.dave),
+            batch_size=1)
+        self.assertEqual(deleted, 2)
+        handler.assert_not_called()
+        self.assertEqual(list(UserFollow.objects.values_list(
+            "following_user", flat=True)), [self.dave.pk])
+        self.assertEqual(bulk.delete_rows(UserFollow.objects.none()), 0)
+
+    def test_json_endpoints(self):
+        self.client.force_login(self.alice)
+        response = self.client.post(
+            reverse("reviews:bulk_follow"),
+            {"usernames": ["bob", "carl", "alice", "nobody"]},
+            content_type="application/json")
+        self.assertEqual(response.json(), {"created": 2, "deleted": 0,
+                                           "skipped": 0,
+                                           "unknown": ["nobody"]})
+        response = self.client.post(reverse("reviews:bulk_unfollow"),
+                                    {"usernames": ["carl"]},
+                                    content_type="application/json")
+        self.assertEqual(response.json()["deleted"], 1)
+        response = self.client.post(reverse("reviews:bulk_block"),
+                                    {"usernames": "bob"},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            self.client.get(reverse("reviews:bulk_block")).status_code, 405)
+
+    def test_import_command(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = Path(directory) / "graph.csv"
+        path.write_text(
+            "type,user,target,key,title,description,ticket,rating,headline\n"
+            "follow,alice,bob,,,,,,\n"
+            "follow,alice,ghost,,,,,,\n"
+            "block,bob,carl,,,,,,\n"
+            "ticket,bob,,dune,Dune,Herbert,,,\n"
+            "review,carl,,,,,dune,4,Bien\n"
+            "review,carl,,,,,dune,9,Trop\n"
+            "like,alice,bob,,,,,,\n", encoding="utf-8")
+        UserFollow.objects.create(user=self.carl, following_user=self.bob)
+        stdout, stderr = StringIO(), StringIO()
+        call_command("import_social", str(path), "--batch-size", "2",
+                     stdout=stdout, stderr=stderr)
+        self.assertIn("7 rows (3 invalid)", stdout.getvalue())
+        self.assertEqual(len(stderr.getvalue().splitlines()), 3)
+        self.assertFalse(UserFollow.objects.filter(user=self.carl).exists())
+        ticket = Ticket.objects.get(title="Dune")
+        self.assertEqual(ticket.review_count, 1)
+        self.assertInSync()
+        self.assertEqual(len(search.search_posts(self.alice, "Dune")), 1)
+
+        jsonl = Path(directory) / "posts.jsonl"
+        jsonl.write_text("\n".join([
+            json.dumps({"type": "review", "user": "dave",
+                        "ticket_id": ticket.pk, "rating": 2,
+                        "headline": "Bof"}),
+            json.dumps({"type": "review", "user": "dave",
+                        "ticket_id": ticket.pk, "rating": 2,
+                        "headline": "x" * 129}),
+            json.dumps({"type": "ticket", "user": "dave",
+                        "title": "x" * 129}),
+            "[1, 2]", "3", '"x"', "{"]) + "\n")
+        stderr = StringIO()
+        call_command("import_social", str(jsonl), stdout=StringIO(),
+                     stderr=stderr)
+        self.assertEqual(stderr.getvalue().splitlines(), [
+            "line 4: not a JSON object", "line 5: not a JSON object",
+            "line 6: not a JSON object", "line 7: not a JSON object",
+            "line 3: title over 128 characters",
+            "line 2: headline over 128 characters"])
+        self.assertFalse(Ticket.objects.filter(user=self.dave).exists())
+        ticket.refresh_from_db()
+        self.assertEqual((ticket.review_count, ticket.rating_sum), (2, 6))
+        with self.assertRaises(CommandError):
+            call_command("import_social", str(path.with_suffix(".txt")))
+
+
+class SyntheticPopulationTests(TestCase):
+    """ Tests for the synthetic populations and the benchmark suite """
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        cache.clear()
+
+    def snapshot(self):
+        return (
+            sorted(UserFollow.objects.values_list(
+                "user__username", "following_user__username")),
+            sorted(UserBlocked.objects.values_list(
+                "user__username", "blocked_user__username")),
+            sorted(Ticket.objects.values_list("user__username", "title")),
+            sorted(Review.objects.values_list("user__username", "headline",
+                                              "rating")),
+        )
+
+    def test_generate_is_deterministic(self):
+        created = synthetic.generate(40, seed=3, covers=0.5)
+        self.assertEqual(created["users"], 40)
+        self.assertEqual(created["follows"], UserFollow.objects.count())
+        self.assertTrue(Ticket.objects.exclude(image="").exists())
+        first = self.snapshot()
+        for user in User.objects.all():
+            self.assertEqual(feed.timeline_drift(user), (set(), set()))
+        self.assertEqual(counters.reconcile(check=True),
+                         {"Ticket": 0, "User": 0})
+        # the most popular user has the most followers
+        self.assertEqual(User.objects.order_by("-follower_count")[0].username,
+                         "synth000000")
+
+        call_command("generate_population", "40", "--seed", "3",
+                     "--covers", "0.5", "--replace", stdout=StringIO())
+        self.assertEqual(self.snapshot(), first)
+        with self.assertRaises(CommandError):
+            call_command("generate_population", "5", stdout=StringIO())
+
+    def test_benchmark_suite(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        output = Path(directory) / "results.json"
+        command = "reviews.management.commands.benchmark_suite.Command"
+        # the test database is already a scratch database
+        with mock.patch(f"{command}.scratch_database", contextlib.nullcontext):
+            call_command("benchmark_suite", "--scales", "15", "--requests",
+                         "3", "--profiled", "2", "--output", str(output),
+                         stdout=StringIO())
+            results = json.loads(output.read_text())
+            measures = results["scales"]["15"]["endpoints"]["feed"]
+            self.assertEqual(set(results["scales"]["15"]["endpoints"]),
+                             {"feed", "posts", "search", "search_user",
+                              "follow"})
+            self.assertGreater(measures["queries"], 0)
+            self.assertGreater(measures["peak_memory_kib"], 0)
+            self.assertLessEqual(measures["p50_ms"], measures["p99_ms"])
+
+            for scale in results["scales"].values():
+                for endpoint in scale["endpoints"].values():
+                    endpoint["queries"] = endpoint["p95_ms"] = 0.001
+            baseline = Path(directory) / "baseline.json"
+            baseline.write_text(json.dumps(results))
+            User.objects.all().delete()
+            with self.assertRaises(CommandError):
+                call_command("benchmark_suite", "--scales", "15",
+                             "--requests", "3", "--profiled", "1",
+                             "--output", str(output),
+                             "--baseline", str(baseline), stdout=StringIO())
+
+
+class InstrumentationTests(TestCase):
+    """ Tests for the per-request instrumentation middleware """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.admin = User.objects.create_user("admin", password="pwd",
+                                             is_staff=True)
+        make_ticket(cls.alice, title="Dune")
+
+    def setUp(self):
+        instrumentation.registry.reset()
+        cache.clear()
+
+    def test_server_timing_and_histograms(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse("reviews:feed"))
+        self.assertRegex(response["Server-Timing"],
+                         r'^sql;dur=[\d.]+;desc="\d+ queries", '
+                         r'render;dur=[\d.]+, total;dur=[\d.]+$')
+        metrics = instrumentation.registry.snapshot()["reviews:feed"]
+        self.assertEqual(metrics["total_ms"]["count"], 1)
+        self.assertGreater(metrics["queries"]["mean"], 0)
+        self.assertGreater(metrics["render_ms"]["mean"], 0)
+        self.assertEqual(metrics["response_bytes"]["mean"],
+                         len(response.content))
+        self.assertEqual(metrics["n_plus_one"], 0)
+
+    def test_render_timer_installed_during_requests_only(self):
+        render = Template.render
+        seen = []
+
+        def view(request):
+            seen.append(Template.render)
+            return HttpResponse("ok")
+
+        instrumentation.InstrumentationMiddleware(view)
+        self.assertIs(Template.render, render)
+        instrumentation.InstrumentationMiddleware(view)(
+            RequestFactory().get("/"))
+        self.assertIsNot(seen[0], render)
+        self.assertIs(Template.render, render)
+
+    def test_repeated_statements_flagged(self):
+        def view(request):
+            for _ in range(6):
+                User.objects.filter(pk=self.alice.pk).exists()
+            return HttpResponse("ok")
+
+        middleware = instrumentation.InstrumentationMiddleware(view)
+        with self.assertLogs("litrevu.instrumentation", "WARNING"):
+            response = middleware(RequestFactory().get("/"))
+        self.assertIn('n-plus-one;desc="1 repeated statement(s)"',
+                      response["Server-Timing"])
+        metrics = instrumentation.registry.snapshot()["unresolved"]
+        self.assertEqual(metrics["n_plus_one"], 1)
+        self.assertEqual(metrics["n_plus_one_samples"][0]["count"], 6)
+
+    def test_metrics_view_is_staff_only(self):
+        url = reverse("instrumentation")
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(self.admin)
+        self.assertIn("instrumentation", self.client.get(url).json()["views"])
+        self.client.post(url)
+        self.assertEqual(list(self.client.get(url).json()["views"]),
+                         ["instrumentation"])
+
+
+class StaticPipelineTests(TestCase):
+    """ Tests for the static files pipeline and its middleware """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.root = Path(tempfile.mkdtemp())
+        cls.addClassCleanup(shutil.rmtree, cls.root)
+        override = override_settings(STATIC_ROOT=cls.root)
+        override.enable()
+        cls.addClassCleanup(override.disable)
+        call_command("collectstatic", "--noinput", verbosity=0)
+
+    def test_minify_css(self):
+        self.assertEqual(
+            staticfiles.minify_css("/*! licence */\n/* note : l'auteur */\n"
+                                   "a > b ,\nc {\n  content: \"x , y\" ;\n"
+                                   "  color: red;\n}\n"),
+            '/*! licence */ a>b,c{content:"x , y";color:red}')
+
+    def test_collected_files(self):
+        url = staticfiles_storage.url("css/base.css")
+        self.assertRegex(url, r"^/static/css/base\.[0-9a-f]{12}\.css$")
+        hashed = self.root / url.removeprefix("/static/")
+        source = (Path(settings.BASE_DIR) / "static/css/base.css").read_text()
+        self.assertEqual(hashed.read_text(), staticfiles.minify_css(source))
+        self.assertTrue(Path(f"{hashed}.gz").exists())
+        wallpaper = self.root / staticfiles_storage.stored_name(
+            "css/gradient-wallpapers.jpg")
+        with Image.open(wallpaper) as image:
+            self.assertEqual(image.width, settings.STATIC_IMAGE_MAX_WIDTH)
+        self.assertFalse((self.root / "pictures/tickets").exists())
+        self.assertTrue((self.root / "pictures/default_pictures").exists())
+
+    def test_middleware_serves_variants(self):
+        url = staticfiles_storage.url("css/base.css")
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Cache-Control"], staticfiles.IMMUTABLE)
+        self.assertEqual(response["Vary"], "Accept-Encoding")
+        self.assertEqual(response["Content-Type"], "text/css")
+        body = gzip.decompress(b"".join(response.streaming_content))
+        self.assertEqual(body, (self.root / url.removeprefix("/static/"))
+                         .read_bytes())
+
+        response = self.client.get(url)
+        self.assertFalse(response.has_header("Content-Encoding"))
+        # explicitly refused encodings
+        for refused in ("gzip;q=0, deflate", "br;q=0, gzip;q=0",
+                        "*;q=0"):
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING=refused)
+            self.assertFalse(response.has_header("Content-Encoding"))
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="br;q=0, gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response[
+            "Last-Modified"])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get("/static/css/base.css")
+        self.assertEqual(response["Cache-Control"],
+                         staticfiles.SHORT_MAX_AGE)
+        self.assertEqual(self.client.get("/static/missing.css").status_code,
+                         404)
+
+    def test_pages_link_hashed_names(self):
+        user = User.objects.create_user("alice", password="pwd")
+        self.client.force_login(user)
+        self.assertContains(self.client.get(reverse("reviews:feed")),
+                            staticfiles_storage.url("css/base.css"))
+
+
+@override_settings(RATE_LIMITS={"autocomplete": {"rate": 1, "burst": 3},
+                                "write": {"rate": 1, "burst": 1}})
+class RateLimitTests(TestCase):
+    """ Tests for the rate limits and the admission control """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+
+    def setUp(self):
+        cache.clear()
+
+    def test_token_bucket(self):
+        results = [ratelimit.hit("autocomplete", "ip-1", now=100)
+                   for _ in range(4)]
+        self.assertEqual(results[:3], [0, 0, 0])
+        self.assertAlmostEqual(results[3], 1)
+        self.assertEqual(ratelimit.hit("autocomplete", "ip-2", now=100), 0)
+        self.assertEqual(ratelimit.hit("autocomplete", "ip-1", now=101), 0)
+        self.assertEqual(ratelimit.hit("unlimited", "ip-1", now=100), 0)
+
+    def test_limits_per_user(self):
+        url = reverse("reviews:search_user")
+        self.client.force_login(self.alice)
+        for _ in range(3):
+            self.assertEqual(self.client.get(url, {"q": "b"}).status_code,
+                             200)
+        response = self.client.get(url, {"q": "b"})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(url, {"q": "a"}).status_code, 200)
+        self.assertEqual(ratelimit.counts()["autocomplete"],
+                         {"allowed": 4, "rejected": 1})
+
+    def test_write_limits_only_posts(self):
+        url = reverse("reviews:ticket_create")
+        self.client.force_login(self.alice)
+        data = {"title": "Dune", "description": "d"}
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertEqual(self.client.post(url, data).status_code, 429)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(Ticket.objects.count(), 1)
+
+    @override_settings(ADMISSION_MAX_CONCURRENT=1, ADMISSION_MAX_QUEUE_MS=50)
+    def test_admission_sheds_queued_requests(self):
+        middleware = ratelimit.AdmissionMiddleware(
+            lambda request: HttpResponse("ok"))
+        factory = RequestFactory()
+        self.assertEqual(middleware(factory.get("/")).status_code, 200)
+        started = (timezone.now().timestamp() - 1) * 1000
+        late = factory.get("/", HTTP_X_REQUEST_START=f"t={started:.0f}")
+        self.assertEqual(middleware(late).status_code, 503)
+        middleware.slots.acquire()
+        response = middleware(factory.get("/"))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertEqual(ratelimit.counts()["admission"],
+                         {"allowed": 1, "rejected": 2})
+
+    @override_settings(ADMISSION_MAX_CONCURRENT=1, ADMISSION_MAX_QUEUE_MS=50)
+    def test_streamed_responses_hold_their_slot(self):
+        middleware = ratelimit.AdmissionMiddleware(
+            lambda request: StreamingHttpResponse(iter([b"a", b"b"])))
+        factory = RequestFactory()
+        response = middleware(factory.get("/"))
+        self.assertEqual(middleware(factory.get("/")).status_code, 503)
+        self.assertEqual(b"".join(response), b"ab")
+        response.close()
+        self.assertEqual(middleware(factory.get("/")).status_code, 200)
+
+    @override_settings(ADMISSION_MAX_CONCURRENT=1, ADMISSION_MAX_QUEUE_MS=50)
+    async def test_async_admission(self):
+        finish = asyncio.Event()
+
+        async def view(request):
+            await finish.wait()
+            return HttpResponse("ok")
+
+        middleware = ratelimit.AdmissionMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        factory = RequestFactory()
+        first = asyncio.ensure_future(middleware(factory.get("/")))
+        await asyncio.sleep(0)
+        self.assertEqual((await middleware(factory.get("/"))).status_code,
+                         503)
+        finish.set()
+        self.assertEqual((await first).status_code, 200)
+        await asyncio.sleep(0)
+        self.assertEqual((await middleware(factory.get("/"))).status_code,
+                         200)
+
+    def test_counts_in_metrics_view(self):
+        ratelimit.hit("write", "ip-1")
+        ratelimit.hit("write", "ip-1")
+        admin = User.objects.create_user("admin", password="pwd",
+                                         is_staff=True)
+        self.client.force_login(admin)
+        metrics = self.client.get(reverse("instrumentation")).json()
+        self.assertEqual(metrics["rate_limits"]["write"],
+                         {"allowed": 1, "rejected": 1})
+
+
+class DeletionTests(TestCase):
+    """ Tests for the tombstones and the background cascade deletion """
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        cache.clear()
+        self.alice = User.objects.create_user("alice", password="pwd")
+        self.bob = User.objects.create_user("bob", password="pwd")
+        self.carla = User.objects.create_user("carla", password="pwd")
+        UserFollow.objects.create(user=self.bob, following_user=self.alice)
+        UserFollow.objects.create(user=self.alice, following_user=self.carla)
+        UserBlocked.objects.create(user=self.carla, blocked_user=self.alice)
+        self.ticket = Ticket.objects.create(
+            title="Dune", description="", user=self.alice,
+            image=default_storage.save("tickets/dune.png",
+                                       image_file(50, 50)))
+        for user in (self.bob, self.carla):
+            make_review(user, self.ticket)
+        self.other = make_ticket(self.carla, "Solaris")
+        self.review = make_review(self.alice, self.other)
+
+    def assertConsistent(self):
+        self.assertEqual(counters.reconcile(check=True),
+                         {"Ticket": 0, "User": 0})
+        for user in User.objects.all():
+            self.assertEqual(feed.timeline_drift(user), (set(), set()))
+
+    def test_ticket_hidden_then_deleted_in_batches(self):
+        executor = mock.Mock()
+        self.client.force_login(self.alice)
+        with mock.patch.object(deletion, "_get_executor",
+                               return_value=executor), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("reviews:ticket_delete",
+                                     args=[self.ticket.pk]))
+        job = DeletionJob.objects.get()
+        executor.submit.assert_called_once_with(deletion._run, job.pk)
+        self.assertEqual(Review.objects.filter(ticket=self.ticket).count(), 2)
+        self.assertEqual(feed.timeline(self.bob).posts, [self.review])
+
+        with override_settings(DELETION_BATCH_SIZE=1), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(deletion.run(job))
+        job.refresh_from_db()
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(job.batches, 3)
+        self.assertFalse(Ticket.objects.filter(pk=self.ticket.pk).exists())
+        self.assertFalse(default_storage.exists(self.ticket.image.name))
+        self.assertConsistent()
+        self.assertEqual(deletion._batch_size(100, 0.4, 0.2), 50)
+        self.assertEqual(deletion._batch_size(100, 0.01, 0.2), 200)
+
+    def test_user_hidden_then_deleted(self):
+        with mock.patch.object(deletion, "schedule"), \
+                self.captureOnCommitCallbacks(execute=True):
+            job = deletion.tombstone(self.alice)
+        self.assertFalse(self.client.login(username="alice", password="pwd"))
+        self.assertEqual(username_index.complete("al", limit=10), [])
+        self.assertEqual(feed.timeline(self.carla).posts, [self.other])
+        self.assertEqual(deletion.tombstone(self.alice), job)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            deletion.run(job)
+        self.assertFalse(User.objects.filter(pk=self.alice.pk).exists())
+        self.assertFalse(Review.objects.filter(ticket=self.ticket).exists())
+        self.assertEqual(Ticket.objects.get().review_count, 0)
+        self.assertEqual(User.objects.get(pk=self.carla.pk).follower_count, 0)
+        self.assertConsistent()
+
+    def test_interrupted_job_resumes(self):
+        with mock.patch.object(deletion, "schedule"):
+            job = deletion.tombstone(self.alice)
+        failure = RuntimeError("connection lost")
+        with override_settings(DELETION_BATCH_SIZE=1), \
+                mock.patch.object(deletion, "_batch_size",
+                                  side_effect=lambda size, *args: size), \
+                mock.patch.object(counters, "reviews_removed",
+                                  side_effect=[None, failure]), \
+                self.assertRaises(RuntimeError):
+            deletion.run(job)
+        job.refresh_from_db()
+        self.assertEqual(job.error, "RuntimeError: connection lost")
+        self.assertEqual(job.step, 2)
+        self.assertIsNone(job.claimed_until)
+        self.assertEqual(Review.objects.count(), 2)
+
+        DeletionJob.objects.filter(pk=job.pk).update(
+            claimed_until=timezone.now() + timedelta(minutes=1))
+        output = StringIO()
+        call_command("run_deletions", stdout=output)
+        self.assertIn("running elsewhere", output.getvalue())
+        DeletionJob.objects.filter(pk=job.pk).update(claimed_until=None)
+        call_command("run_deletions", stdout=output)
+        self.assertIn("row(s) deleted", output.getvalue())
+        self.assertFalse(deletion.pending().exists())
+        self.assertFalse(User.objects.filter(pk=self.alice.pk).exists())
+
+
+class UploadTests(TestCase):
+    """ Tests for the streaming, content-addressed uploads """
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        cache.clear()
+        self.client.force_login(
+            User.objects.create_user("alice", password="pwd"))
+
+    def upload(self, content, name="cover.png"):
+        return self.client.post(reverse("reviews:ticket_create"), {
+            "title": "Dune", "description": "d",
+            "image": SimpleUploadedFile(name, content, "image/png")})
+
+    def test_same_cover_stored_once(self):
+        data = image_file(60, 40).read()
+        for name in ("cover.png", "copy.PNG"):
+            self.assertEqual(self.upload(data, name).status_code, 302)
+        names = set(Ticket.objects.values_list("image", flat=True))
+        self.assertEqual(len(names), 1)
+        name = names.pop()
+        self.assertRegex(name, r"^tickets/[0-9a-f]{2}/[0-9a-f]{64}\.png$")
+        self.assertEqual(StoredFile.objects.get(name=name).references, 2)
+
+        default_storage.delete(name)
+        self.assertTrue(default_storage.exists(name))
+        default_storage.delete(name)
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(StoredFile.objects.exists())
+
+    @mock.patch("reviews.images.schedule")
+    def test_replaced_and_cleared_images_released(self, schedule):
+        alice = User.objects.get(username="alice")
+        first, second = (image_file(60, 40).read(),
+                         image_file(40, 60).read())
+
+        def save(obj, field, data):
+            setattr(obj, field, data and SimpleUploadedFile(
+                "image.png", data, "image/png"))
+            with self.captureOnCommitCallbacks(execute=True):
+                obj.save()
+            return getattr(obj, field).name
+
+        ticket = make_ticket(alice)
+        old = save(ticket, "image", first)
+        # the same content uploaded again keeps one reference
+        self.assertEqual(save(ticket, "image", first), old)
+        self.assertEqual(StoredFile.objects.get(name=old).references, 1)
+        new = save(ticket, "image", second)
+        self.assertFalse(default_storage.exists(old))
+        save(ticket, "image", None)
+        self.assertFalse(default_storage.exists(new))
+
+        avatar = save(alice, "profile_picture", first)
+        save(alice, "profile_picture", second)
+        self.assertFalse(default_storage.exists(avatar))
+        # the ticket goes with its author
+        save(ticket, "image", first)
+        with self.captureOnCommitCallbacks(execute=True):
+            alice.delete()
+        self.assertFalse(StoredFile.objects.exists())
+        self.assertEqual([name for _, _, names
+                          in os.walk(settings.MEDIA_ROOT) for name in names],
+                         [])
+
+    def test_rejected_from_first_bytes(self):
+        response = self.upload(b"%PDF-1.7\n" + b"x" * 200_000)
+        self.assertContains(response, "pas une image PNG")
+        with override_settings(UPLOAD_MAX_PIXELS=1000):
+            self.assertContains(self.upload(image_file(60, 40).read()),
+                                "Image trop grande")
+        self.assertFalse(Ticket.objects.exists())
+        self.assertFalse(default_storage.exists("tickets"))
+
+        handler = uploads.ImageUploadHandler()
+        handler.new_file("image", "big.png", "image/png", None)
+        header = image_file(60, 40).read()
+        with override_settings(UPLOAD_MAX_BYTES=len(header) + 10):
+            handler.receive_data_chunk(header, 0)
+            self.assertIsNotNone(handler.file)
+            handler.receive_data_chunk(b"x" * 20, len(header))
+        self.assertIsNone(handler.file)
+        self.assertIn("trop volumineux", handler.rejection)
+        self.assertIsInstance(handler.file_complete(len(header) + 20),
+                              uploads.RejectedUpload)
+
+
+class CompressionTests(TestCase):
+    """ Tests for the compression of the dynamic responses """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", password="pwd")
+        cls.bob = User.objects.create_user("bob", password="pwd")
+        UserFollow.objects.create(user=cls.alice, following_user=cls.bob)
+        for i in range(5):
+            make_ticket(cls.bob, title=f"Ticket {i}", minutes=i)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.alice)
+
+    def test_compresses_pages(self):
+        url = reverse("reviews:feed")
+        plain = self.client.get(url)
+        self.assertFalse(plain.has_header("Content-Encoding"))
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="br;q=0, gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        # same page, but a CSRF token masked differently
+        html = gzip.decompress(response.content)
+        self.assertEqual(len(html), len(plain.content))
+        self.assertIn(b"Ticket 4", html)
+        self.assertEqual(int(response["Content-Length"]),
+                         len(response.content))
+        # the weakened ETag still validates
+        self.assertTrue(response["ETag"].startswith('W/"'))
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip",
+                                   HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(COMPRESSION_FLUSH_SIZE=1)
+    def test_streams_incrementally(self):
+        response = self.client.get(reverse("reviews:feed_api"),
+                                   HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertFalse(response.has_header("Content-Length"))
+        decompressor = zlib.decompressobj(31)
+        chunks = response.streaming_content
+        # every chunk is flushed: readable before the end of the stream
+        self.assertEqual(decompressor.decompress(next(chunks)),
+                         b'{"results":[')
+        body = b'{"results":[' + b"".join(decompressor.decompress(chunk)
+                                          for chunk in chunks)
+        self.assertEqual(len(json.loads(body)["results"]), 5)
+
+        async def content():
+            yield b"x" * 1000
+
+        middleware = compression.CompressionMiddleware(
+            lambda request: StreamingHttpResponse(content()))
+        response = middleware(RequestFactory().get(
+            "/", HTTP_ACCEPT_ENCODING="gzip"))
+
+        async def consume():
+            return b"".join([chunk async for chunk
+                             in response.streaming_content])
+        self.assertEqual(gzip.decompress(async_to_sync(consume)()),
+                         b"x" * 1000)
+
+    def test_negotiation_and_skipped_bodies(self):
+        self.assertEqual(compression.negotiate("deflate, gzip;q=0.5"),
+                         "gzip")
+        self.assertEqual(compression.negotiate("*"),
+                         next(encoding for encoding
+                              in settings.COMPRESSION_ENCODINGS
+                              if encoding in compression.encoders()))
+        for header in ("", "identity", "gzip;q=0", "*, gzip;q=0"):
+            self.assertIsNone(compression.negotiate(header))
+
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip")
+        body = b"<p>LITRevu</p>" * 100
+        for original in (HttpResponse(body[:100]),
+                         HttpResponse(body, content_type="image/png"),
+                         HttpResponse(body, headers={
+                             "Content-Encoding": "br"})):
+            content = original.content
+            response = compression.CompressionMiddleware(
+                lambda request: original)(request)
+            self.assertNotEqual(response.get("Content-Encoding"), "gzip")
+            self.assertEqual(response.content, content)
@@ -0,0 +1,248 @@
+"""
+Streaming, content-addressed uploads (ticket covers, avatars).
+
+ImageUploadHandler (FILE_UPLOAD_HANDLERS) looks at the first bytes of
+each uploaded file: anything but a PNG, JPEG, GIF or WebP image, an
+image larger than UPLOAD_MAX_PIXELS or a file over UPLOAD_MAX_BYTES is
+rejected there, and the rest of its body is dropped as it arrives
+instead of being written. Accepted files are hashed (SHA-256) while
+they are spooled, the form field (UploadImageField) reports rejections
+as validation errors.
+
+ContentAddressedStorage stores every file once, under its hash
+(tickets/3f/3f2a...c1.jpg): uploading a cover again writes nothing. The
+files are reference counted in StoredFile: each save takes a reference
+and `delete` releases one, the file goes with the last one.
+"""
+import hashlib
+import os
+import posixpath
+import tempfile
+from io import BytesIO
+
+from django import forms
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from django.db import transaction
+from django.db.models import F
+from PIL import Image, UnidentifiedImageError
+
+from .models import StoredFile
+
+# (magic bytes, format); WebP is RIFF....WEBP
+SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"RIFF", "WEBP"),
+)
+EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "GIF": ".gif", "WEBP": ".webp"}
+# the dimensions must be found within the first bytes (JPEG: after the
+# EXIF block, at most 64 KiB)
+HEADER_MAX_BYTES = 128 * 1024
+
+
+class UploadRejected(Exception):
+    """ An upload refused from its first bytes, the message is shown """
+
+
+def inspect_header(data):
+    """
+    Return the image format of a file from its first bytes, or None if
+    more bytes are needed. Raise UploadRejected if it is not an accepted
+    image or is too large.
+    """
+    if len(data) < 12:
+        return None
+    for magic, image_format in SIGNATURES:
+        if data.startswith(magic) \
+                and (image_format != "WEBP" or data[8:12] == b"WEBP"):
+            break
+    else:
+        raise UploadRejected("Ce fichier n'est pas une image PNG, JPEG, GIF "
+                             "ou WebP.")
+    try:
+        image = Image.open(BytesIO(data), formats=[image_format])
+    except Image.DecompressionBombError:
+        image = None
+    except (OSError, UnidentifiedImageError, SyntaxError):
+        if len(data) < HEADER_MAX_BYTES:
+            return None
+        raise UploadRejected("Image illisible.")
+    if image is None or image.width * image.height \
+            > settings.UPLOAD_MAX_PIXELS:
+        raise UploadRejected(
+            f"Image trop grande (au plus "
+            f"{settings.UPLOAD_MAX_PIXELS // 1_000_000} mégapixels).")
+    return image_format
+
+
+class HashedUpload(UploadedFile):
+    """ An accepted upload, spooled, with its SHA-256 and image format """
+
+    def __init__(self, file, name, content_type, size, charset,
+                 sha256, image_format):
+        super().__init__(file, name, content_type, size, charset)
+        self.sha256 = sha256
+        self.image_format = image_format
+
+
+class RejectedUpload(UploadedFile):
+    """ Placeholder of a rejected upload, carrying the reason """
+
+    def __init__(self, name, content_type, rejection):
+        super().__init__(BytesIO(), name, content_type, 0)
+        self.rejection = rejection
+
+
+class ImageUploadHandler(FileUploadHandler):
+    """
+    Check each uploaded file from its first bytes, then spool and hash
+    it chunk by chunk; the rest of a rejected file is dropped.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.header = b""
+        self.file = None
+        self.image_format = None
+        self.rejection = None
+        self.received = 0
+        self.hash = hashlib.sha256()
+        if self.content_length and \
+                self.content_length > settings.UPLOAD_MAX_BYTES:
+            self.reject_size()
+
+    def reject_size(self):
+        self.reject(f"Fichier trop volumineux (au plus "
+                    f"{settings.UPLOAD_MAX_BYTES // (1024 * 1024)} Mo).")
+
+    def reject(self, message):
+        self.rejection = message
+        self.header = b""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def accept(self, data):
+        self.hash.update(data)
+        self.file.write(data)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.rejection:
+            return None
+        self.received += len(raw_data)
+        if self.received > settings.UPLOAD_MAX_BYTES:
+            self.reject_size()
+            return None
+        if self.file is not None:
+            self.accept(raw_data)
+            return None
+        self.header += raw_data
+        try:
+            self.image_format = inspect_header(self.header)
+        except UploadRejected as error:
+            self.reject(str(error))
+            return None
+        if self.image_format is not None:
+            self.file = tempfile.SpooledTemporaryFile(
+                max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE,
+                dir=settings.FILE_UPLOAD_TEMP_DIR)
+            self.accept(self.header)
+            self.header = b""
+        return None
+
+    def file_complete(self, file_size):
+        if self.rejection is None and self.file is None:
+            # the whole file was shorter than a readable header
+            self.reject("Image illisible.")
+        if self.rejection:
+            return RejectedUpload(self.file_name, self.content_type,
+                                  self.rejection)
+        self.file.seek(0)
+        return HashedUpload(self.file, self.file_name, self.content_type,
+                            file_size, self.charset, self.hash.hexdigest(),
+                            self.image_format)
+
+    def upload_interrupted(self):
+        if getattr(self, "file", None) is not None:
+            self.file.close()
+
+
+class UploadImageField(forms.ImageField):
+    """ ImageField showing why ImageUploadHandler rejected a file """
+
+    def to_python(self, data):
+        rejection = getattr(data, "rejection", None)
+        if rejection:
+            raise ValidationError(rejection, code="rejected")
+        return super().to_python(data)
+
+
+def retain(name, count=1):
+    """ Take count more references on a stored file """
+    with transaction.atomic():
+        stored, created = StoredFile.objects.get_or_create(
+            name=name, defaults={"references": count})
+        if not created:
+            StoredFile.objects.filter(pk=stored.pk).update(
+                references=F("references") + count)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """ FileSystemStorage keeping each content once, reference counted """
+
+    def _hashed_name(self, name, digest, content):
+        directory = posixpath.dirname(name)
+        image_format = getattr(content, "image_format", None)
+        extension = EXTENSIONS.get(image_format) \
+            or os.path.splitext(name)[1].lower()
+        return posixpath.join(directory, digest[:2], digest + extension)
+
+    def _save(self, name, content):
+        digest = getattr(content, "sha256", None)
+        if digest is not None:
+            hashed = self._hashed_name(name, digest, content)
+            if self.exists(hashed):
+                retain(hashed)
+                return hashed
+        directory = self.path(posixpath.dirname(name))
+        os.makedirs(directory, exist_ok=True)
+        # hash while writing next to the destination, then rename
+        digest = hashlib.sha256()
+        descriptor, temporary = tempfile.mkstemp(dir=directory,
+                                                 suffix=".upload")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    file.write(chunk)
+            hashed = self._hashed_name(name, digest.hexdigest(), content)
+            if not self.exists(hashed):
+                os.makedirs(os.path.dirname(self.path(hashed)),
+                            exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(temporary, self.file_permissions_mode)
+                os.replace(temporary, self.path(hashed))
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        retain(hashed)
+        return hashed
+
+    def delete(self, name):
+        """ Release one reference, delete the file with the last one """
+        with transaction.atomic():
+            stored = StoredFile.objects.select_for_update() \
+                .filter(name=name).first()
+            if stored is not None and stored.references > 1:
+                StoredFile.objects.filter(pk=stored.pk).update(
+                    references=F("references") - 1)
+                return
+            if stored is not None:
+                stored.delete()
+        super().delete(name)
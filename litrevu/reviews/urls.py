@@ -1,13 +1,19 @@
+from django.conf import settings
 from django.urls import path
 from .views import (
     FeedView,
     PostView,
+    SearchView,
     FollowView,
     follow_user,
     unfollow_user,
     blocked_user,
     unblocked_user,
     search_user,
+    feed_api,
+    bulk_follow,
+    bulk_unfollow,
+    bulk_block,
     TicketCreateView,
     TicketUpdateView,
     TicketDeleteView,
@@ -16,11 +22,20 @@ from .views import (
     ReviewDeleteView
 )
 
+if settings.REVIEWS_ASYNC_VIEWS:
+    from .async_views import (  # noqa: F811
+        AsyncFeedView as FeedView,
+        AsyncPostView as PostView,
+        follow_user,
+        search_user,
+    )
+
 app_name = 'reviews'
 
 urlpatterns = [
     path("", FeedView.as_view(), name='feed'),
     path("posts/", PostView.as_view(), name='posts'),
+    path("search/", SearchView.as_view(), name='search'),
 
     # url for views follow
     path("follow/", FollowView.as_view(), name='follow'),
@@ -43,4 +58,9 @@ urlpatterns = [
          name="review_modify"),
     path("review/<int:pk>/delete/", ReviewDeleteView.as_view(),
          name="review_delete"),
+    # url for views api
+    path("api/feed/", feed_api, name="feed_api"),
+    path("api/follow/", bulk_follow, name="bulk_follow"),
+    path("api/unfollow/", bulk_unfollow, name="bulk_unfollow"),
+    path("api/block/", bulk_block, name="bulk_block"),
 ]
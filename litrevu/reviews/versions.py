@@ -0,0 +1,122 @@
+"""
+Per-user timeline versions.
+
+Every user has a version in the cache (a nanosecond timestamp) that
+changes whenever something shown by their feed, posts or follow pages
+changes: a post of their timeline is created, edited, reviewed or
+deleted, or one of their relationships changes (see reviews.signals).
+Views turn it into an ETag / Last-Modified pair (`conditional_timeline`)
+and answer revisits with a 304 before reading any post.
+
+Bumps are applied once the write commits, so a concurrent request can
+not cache the old content under the new version. A lost cache entry
+only means a new version, i.e. one full response.
+
+A page tagged with the current version must hold the current rows, so
+the views under `conditional_timeline` read the primary whenever they
+send the validators, even when marked with `replica_reads`: a page read
+from a lagging replica would otherwise be revalidated (304) until the
+next bump. Requests without validators keep their replica reads.
+"""
+import hashlib
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from litrevu.routers import use_replica
+
+from .models import UserFollow
+
+VERSION_KEY = "timeline-version:{}"
+VERSION_TIMEOUT = 60 * 60 * 24
+
+
+def get_version(user_id):
+    """ Return the current timeline version of a user """
+    return cache.get_or_set(VERSION_KEY.format(user_id), time.time_ns,
+                            VERSION_TIMEOUT)
+
+
+def bump(user_ids):
+    """ Give the users a new timeline version once the transaction commits """
+    user_ids = set(user_ids)
+    if user_ids:
+        transaction.on_commit(lambda: cache.set_many(
+            {VERSION_KEY.format(user_id): time.time_ns()
+             for user_id in user_ids}, VERSION_TIMEOUT))
+
+
+def related_users(*user_ids):
+    """ Return the users and everyone following or followed by them """
+    edges = UserFollow.objects.filter(
+        Q(user__in=user_ids) | Q(following_user__in=user_ids)) \
+        .values_list('user', 'following_user')
+    related = set(user_ids)
+    for user, following_user in edges:
+        related.update((user, following_user))
+    return related
+
+
+def last_modified(version):
+    """ Return the datetime of a version """
+    return datetime.fromtimestamp(version / 1e9, tz=timezone.utc)
+
+
+def etag(user_id, version, path):
+    """ Return the ETag of the page at path for a user and version """
+    raw = f"{user_id}:{version}:{path}"
+    return hashlib.md5(raw.encode(), usedforsecurity=False).hexdigest()
+
+
+def _timeline_condition(request):
+    """ Return the condition decorator of a request, None to bypass it """
+    if request.method not in ("GET", "HEAD") \
+            or not request.user.is_authenticated \
+            or len(get_messages(request)):
+        return None
+    version = get_version(request.user.pk)
+    return condition(
+        etag_func=lambda *_, **__: etag(request.user.pk, version,
+                                        request.get_full_path()),
+        last_modified_func=lambda *_, **__: last_modified(version),
+    )
+
+
+def conditional_timeline(view_func):
+    """
+    Decorate a GET view (sync or async) depending only on the timeline
+    version of the logged-in user: ETag and Last-Modified headers, 304
+    when current, the full response being read from the primary.
+    Requests with pending flash messages always get a full response.
+    """
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            conditional = await sync_to_async(_timeline_condition)(request)
+            if conditional is None:
+                return await view_func(request, *args, **kwargs)
+            with use_replica(False):
+                response = await conditional(view_func)(request, *args,
+                                                        **kwargs)
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return async_wrapper
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        conditional = _timeline_condition(request)
+        if conditional is None:
+            return view_func(request, *args, **kwargs)
+        with use_replica(False):
+            response = conditional(view_func)(request, *args, **kwargs)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+    return wrapper
@@ -1,22 +1,35 @@
-from itertools import chain
+import json
 from operator import attrgetter
 
 from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.mixins import UserPassesTestMixin
-from django.db.models import Value, CharField
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, get_object_or_404
 from django.urls import reverse_lazy
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
 from django.views.decorators.http import require_GET, require_POST
 from django.views.generic import TemplateView, CreateView, UpdateView, \
     DeleteView
 
+from litrevu.ratelimit import rate_limited
+from litrevu.routers import replica_reads
+
+from . import api, bulk, cards, deletion, feed, images, search
+from .autocomplete import username_index
 from .forms import ReviewForm, TicketForm, ReviewWithTicketForm
+from .graph import social_graph
 from .models import UserFollow, Ticket, Review, UserBlocked
+from .versions import conditional_timeline
 
 User = get_user_model()
 
+# seconds a browser may reuse an autocomplete response
+AUTOCOMPLETE_MAX_AGE = 30
+# usernames accepted by one bulk follow / unfollow / block request
+BULK_MAX_USERS = 500
+
 
 class UserTestCustom(UserPassesTestMixin):
     """
@@ -34,57 +47,31 @@ class UserTestCustom(UserPassesTestMixin):
         return redirect("reviews:feed")
 
 
+@method_decorator(conditional_timeline, name='get')
 class FeedView(TemplateView):
     """ View for template feed.html """
     template_name = 'reviews/feed.html'
 
     def get_context_data(self, **kwargs):
-        """ Return context data for feed.html. """
+        """
+        Return context data for feed.html.
+        Posts are read from the materialized timeline (FeedEntry), page by
+        page, following the ?cursor= parameter, and rendered as cached cards.
+        """
         context = super().get_context_data(**kwargs)
 
-        # following user
-        following_users = UserFollow.objects.filter(user=self.request.user) \
-            .values_list('following_user', flat=True)
-        # Retrieves the list of users who have blocked the logged-in user.
-        blocked_me = UserBlocked.objects.filter(
-            blocked_user=self.request.user).values_list('user', flat=True)
-        # including the logged-in user
-        users_to_include = list(following_users) + [self.request.user.id]
-
-        # Tickets management
-        tickets = (
-            Ticket.objects
-            .filter(user__in=users_to_include)
-            .exclude(user__in=blocked_me)
-            .annotate(content_type=Value("ticket", CharField()))
-        )
-
-        # Reviews management
-        # Reviews published by User and my subscriptions + reviews on User tickets & subscriptions
-        reviews_from_users = Review.objects.filter(user__in=users_to_include)
-        reviews_on_our_tickets = Review.objects.filter(
-            ticket__user__in=users_to_include)
-
-        reviews = (reviews_from_users | reviews_on_our_tickets).annotate(
-            content_type=Value("review", CharField())) \
-            .exclude(user__in=blocked_me) \
-            .distinct()
-
-        posts = sorted(
-            chain(tickets, reviews),
-            key=attrgetter('time_created'),
-            reverse=True
-        )
-
-        # Retrieves the list of ticket IDs that have already been criticized.
-        reviewed_ticket_ids = Review.objects.values_list('ticket_id', flat=True)
-
-        context['blocked_me'] = blocked_me
-        context['reviewed_ticket_ids'] = reviewed_ticket_ids
-        context['list_posts'] = posts
+        page = feed.timeline(self.request.user,
+                             cursor=self.request.GET.get('cursor'))
+        images.attach_renditions(page.posts)
+
+        context['list_posts'] = page.posts
+        context['list_cards'] = cards.render_cards(page.posts,
+                                                   self.request.user)
+        context['next_cursor'] = page.next_cursor
         return context
 
 
+@method_decorator(conditional_timeline, name='get')
 class PostView(TemplateView):
     """ View for le template posts.html """
     template_name = 'reviews/posts.html'
@@ -92,27 +79,46 @@ class PostView(TemplateView):
     def get_context_data(self, **kwargs):
         """
         Return context data for posts.html
-        Tickets & reviews from logged-in user.
+        Tickets & reviews from logged-in user, page by page.
         """
         context = super().get_context_data(**kwargs)
 
         tickets = Ticket.objects.filter(user=self.request.user)
         reviews = Review.objects.filter(user=self.request.user)
-        tickets = tickets.annotate(content_type=Value("ticket", CharField()))
-        reviews = reviews.annotate(content_type=Value("review", CharField()))
-
-        posts = sorted(
-            chain(tickets, reviews),
-            key=attrgetter('time_created'),
-            reverse=True
-        )
-        context['posts'] = posts
+        page = feed.paginate(tickets, reviews,
+                             cursor=self.request.GET.get('cursor'))
+        images.attach_renditions(page.posts)
+
+        context['posts'] = page.posts
+        context['next_cursor'] = page.next_cursor
+        return context
+
+
+@method_decorator(rate_limited('search'), name='dispatch')
+class SearchView(TemplateView):
+    """ View for template search.html """
+    template_name = 'reviews/search.html'
+
+    def get_context_data(self, **kwargs):
+        """
+        Return context data for search.html
+        Posts of the feed matching ?q=, best match first.
+        """
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.get('q', '').strip()
+        posts = search.search_posts(self.request.user, query) if query else []
+        images.attach_renditions(posts)
+
+        context['query'] = query
+        context['list_cards'] = cards.render_cards(posts, self.request.user)
         return context
 
 
 # ================================================================ #
 #                         Ticket                                   #
 # ================================================================ #
+@method_decorator(rate_limited('write', methods=('POST',)),
+                  name='dispatch')
 class TicketCreateView(CreateView):
     """ View for create un ticket """
     template_name = 'reviews/ticket_form.html'
@@ -128,22 +134,29 @@ class TicketCreateView(CreateView):
         return response
 
 
+@method_decorator(rate_limited('write', methods=('POST',)),
+                  name='dispatch')
 class TicketUpdateView(UserTestCustom, UpdateView):
     """ View for update ticket """
     template_name = 'reviews/ticket_form.html'
     success_url = reverse_lazy('reviews:posts')
     model = Ticket
+    queryset = Ticket.objects.filter(deleted_at__isnull=True)
     form_class = TicketForm
 
     def form_valid(self, form):
         """ Validate form data + message """
+        cards.invalidate_cards(self.object)
         messages.success(self.request, 'Ticket modifié avec succès!')
         return super().form_valid(form)
 
 
+@method_decorator(rate_limited('write', methods=('POST',)),
+                  name='dispatch')
 class TicketDeleteView(UserTestCustom, DeleteView):
     """ View for delete ticket """
     model = Ticket
+    queryset = Ticket.objects.filter(deleted_at__isnull=True)
     template_name = 'reviews/ticket_delete.html'
     success_url = reverse_lazy('reviews:posts')
 
@@ -152,10 +165,21 @@ class TicketDeleteView(UserTestCustom, DeleteView):
         messages.success(request, 'Ticket supprimé avec succès!')
         return super().delete(request, *args, **kwargs)
 
+    def form_valid(self, form):
+        """
+        Drop the cached card of the post, hide the ticket and delete its
+        reviews in the background (reviews.deletion)
+        """
+        cards.invalidate_cards(self.object)
+        deletion.tombstone(self.object)
+        return redirect(self.get_success_url())
+
 
 # ================================================================ #
 #                         Critique                                 #
 # ================================================================ #
+@method_decorator(rate_limited('write', methods=('POST',)),
+                  name='dispatch')
 class ReviewCreateView(CreateView):
     """ View to create a review (in response to a ticket or freely) """
 
@@ -176,7 +200,9 @@ class ReviewCreateView(CreateView):
         """ Return the ticket or None"""
         tickets_id = self.kwargs.get('ticket_id')
         if tickets_id:
-            return get_object_or_404(Ticket, pk=tickets_id)
+            return get_object_or_404(Ticket, pk=tickets_id,
+                                     deleted_at__isnull=True,
+                                     user__deleted_at__isnull=True)
         else:
             return None
 
@@ -206,6 +232,8 @@ class ReviewCreateView(CreateView):
             return redirect(self.success_url)
 
 
+@method_decorator(rate_limited('write', methods=('POST',)),
+                  name='dispatch')
 class ReviewUpdateView(UserTestCustom, UpdateView):
     """View to update review """
 
@@ -222,10 +250,13 @@ class ReviewUpdateView(UserTestCustom, UpdateView):
 
     def form_valid(self, form):
         """ Validate form data + message"""
+        cards.invalidate_cards(self.object)
         messages.success(self.request, 'Critique modifiée avec succès!')
         return super().form_valid(form)
 
 
+@method_decorator(rate_limited('write', methods=('POST',)),
+                  name='dispatch')
 class ReviewDeleteView(UserTestCustom, DeleteView):
     """ View to delete review """
     model = Review
@@ -237,26 +268,42 @@ class ReviewDeleteView(UserTestCustom, DeleteView):
         messages.success(request, 'Critique supprimée avec succès!')
         return super().delete(request, *args, **kwargs)
 
+    def form_valid(self, form):
+        """ Drop the cached card of the post before deleting it """
+        cards.invalidate_cards(self.object)
+        return super().form_valid(form)
+
 
 # ================================================================ #
 #                         Abonnements                              #
 # ================================================================ #
+@method_decorator(conditional_timeline, name='get')
 class FollowView(TemplateView):
     """ View for template follow.html """
     template_name = 'reviews/follow.html'
 
     def get_context_data(self, **kwargs):
-        """ Return context data for follow.html """
+        """
+        Return context data for follow.html
+        The relations come from the social graph, the users from one query.
+        """
         context = super().get_context_data(**kwargs)
-        context['followed_users'] = User.objects.filter(
-            followers__user=self.request.user)
-        context['followers'] = User.objects.filter(
-            following__following_user=self.request.user)
-        context['blocked_users'] = User.objects.filter(
-            blocked_by__user=self.request.user)
+        graph = social_graph.sets(self.request.user)
+        users = User.objects.in_bulk(
+            graph['following'] | graph['followers'] | graph['blocking'])
+
+        def users_of(relation):
+            return sorted((users[pk] for pk in graph[relation]
+                           if pk in users and users[pk].deleted_at is None),
+                          key=attrgetter('username'))
+
+        context['followed_users'] = users_of('following')
+        context['followers'] = users_of('followers')
+        context['blocked_users'] = users_of('blocking')
         return context
 
 
+@rate_limited('follow')
 def unfollow_user(request, user_id):
     """ function view to unfollow user + message """
     user_to_unfollow = User.objects.get(pk=user_id)
@@ -268,6 +315,7 @@ def unfollow_user(request, user_id):
 
 
 @require_POST
+@rate_limited('follow')
 def follow_user(request):
     """
     function view to follow user + message
@@ -280,37 +328,30 @@ def follow_user(request):
     return JsonResponse({"success": True})
 
 
+@replica_reads
 @require_GET
+@rate_limited('autocomplete')
 def search_user(request):
     """
-    View to search for a user.
-    Filter based on user input, excluding users who are already subscribed,
-    yourself, and those who are blocked.
+    View to search for a user (autocomplete).
+    Usernames starting with the user input, excluding users who are
+    already subscribed, yourself, and those who are blocked. Served from
+    the in-memory username index and the cached social graph.
     """
 
     query = request.GET.get("q", "")
-    followed_ids = UserFollow.objects.filter(user=request.user) \
-        .values_list('following_user_id', flat=True)
-    blocked_user = UserBlocked.objects.filter(user=request.user).values_list(
-        'blocked_user_id', flat=True)
-
-    users = User.objects.filter(username__icontains=query) \
-        .exclude(pk__in=followed_ids) \
-        .exclude(pk=request.user.pk) \
-        .exclude(pk__in=blocked_user)[:10]
-
-    dir_default_img = "/static/pictures/default_pictures/default.png"
-    data = [
-        {
-            "username": user.username,
-            "image": user.profile_picture.url if user.profile_picture else dir_default_img,
-        }
-        for user in users
-    ]
-    return JsonResponse(data, safe=False)
+    graph = social_graph.sets(request.user)
+    exclude = graph['following'] | graph['blocking'] | {request.user.pk}
+
+    data = username_index.complete(query, limit=10, exclude=exclude)
+    response = JsonResponse(data, safe=False)
+    patch_cache_control(response, private=True,
+                        max_age=AUTOCOMPLETE_MAX_AGE)
+    return response
 
 
 @require_POST
+@rate_limited('follow')
 def blocked_user(request, user_id):
     """ function view to block user + message """
     user_to_blocked = User.objects.get(pk=user_id)
@@ -325,6 +366,7 @@ def blocked_user(request, user_id):
 
 
 @require_POST
+@rate_limited('follow')
 def unblocked_user(request, user_id):
     """ function view to unblock user + message """
     unblocked_user = User.objects.get(pk=user_id)
@@ -333,3 +375,73 @@ def unblocked_user(request, user_id):
     messages.success(request,
                      f"Vous avez débloqué {unblocked_user.username}")
     return redirect('reviews:follow')
+
+
+# ================================================================ #
+#                         API                                      #
+# ================================================================ #
+@require_GET
+@conditional_timeline
+def feed_api(request):
+    """
+    JSON feed of the logged-in user, streamed batch by batch.
+    ?cursor= continues from the next_cursor of a previous response and
+    ?limit= sets the number of posts (max api.API_MAX_PAGE_SIZE).
+    Answers 304 while the user's timeline version is unchanged.
+    """
+    return StreamingHttpResponse(
+        api.stream_timeline(request.user,
+                            cursor=request.GET.get("cursor"),
+                            limit=api.page_size(request.GET.get("limit"))),
+        content_type="application/json")
+
+
+def _bulk_relation(request, operation):
+    """
+    Apply a bulk operation to the users of the JSON body
+    {"usernames": [...]} and return the counts as JSON.
+    """
+    try:
+        usernames = json.loads(request.body)["usernames"]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"error": "Corps JSON {\"usernames\": [...]} "
+                                      "attendu."}, status=400)
+    if not isinstance(usernames, list) or len(usernames) > BULK_MAX_USERS:
+        return JsonResponse({"error": f"Au plus {BULK_MAX_USERS} noms "
+                                      f"d'utilisateur par requête."},
+                            status=400)
+    users = User.objects.filter(username__in=usernames) \
+        .exclude(pk=request.user.pk)
+    result = operation(request.user, users.values_list('pk', flat=True))
+    found = set(users.values_list('username', flat=True))
+    return JsonResponse({
+        "created": result.created,
+        "deleted": result.deleted,
+        "skipped": result.skipped,
+        "unknown": sorted(set(map(str, usernames)) - found
+                          - {request.user.username}),
+    })
+
+
+@require_POST
+@rate_limited('follow')
+def bulk_follow(request):
+    """ Follow every user of {"usernames": [...]} (JSON) """
+    return _bulk_relation(request, bulk.follow)
+
+
+@require_POST
+@rate_limited('follow')
+def bulk_unfollow(request):
+    """ Unfollow every user of {"usernames": [...]} (JSON) """
+    return _bulk_relation(request, bulk.unfollow)
+
+
+@require_POST
+@rate_limited('follow')
+def bulk_block(request):
+    """
+    Block every user of {"usernames": [...]} (JSON), which also removes
+    their follows of the logged-in user.
+    """
+    return _bulk_relation(request, bulk.block)